@@ -1,95 +1,169 @@
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, jsonify, session, Response, abort, g, make_response
 
-import subprocess
+import importlib
 import os
-import pyodbc
-import sqlite3
+import sys
 import datetime
 import logging
+import threading
+import time
 from werkzeug.utils import secure_filename
-import wave
-import tempfile
 import hashlib
-import requests
+import hmac
+import json
 import uuid
-import qrcode
 from functools import wraps
-try:
-    import speech_recognition as sr
-except ImportError:
-    sr = None
+import click
+
+import btc_rate
+import concurrency
+import db
+import derived
+import jobs
+import logs
+import maintenance
+import metrics
+import media
+import media_catalog
+import movement
+import movement_analytics
+import movement_blocks
+import movement_spatial
+import movement_stream
+import orders
+import pagination
+import qr_cache
+import response_cache
+import script_pool
+import transcription as transcription_pipeline
+import uploads
+from logs import SQLLogHandler
 
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'change_me')
 app.logger.setLevel('DEBUG')
+app.config['USE_X_SENDFILE'] = media.MEDIA_SENDFILE == 'x-sendfile'
+
+log_handler = SQLLogHandler()
+log_handler.setLevel(logging.INFO)
+app.logger.addHandler(log_handler)
+# Failures in background maintenance runs and movement flushes are stored
+# with the app's logs
+maintenance.logger.addHandler(log_handler)
+movement_stream.logger.addHandler(log_handler)
+
+
+# --- Startup ---
+# Importing this module does no I/O.  Schema migration and warm-up run in a
+# background thread per process, so the login page is served immediately.
+DB_MIGRATE_ON_START = os.environ.get('DB_MIGRATE_ON_START', '1') == '1'
+WARMUP_ON_START = os.environ.get('WARMUP_ON_START', '1') == '1'
+SCHEMA_WAIT_TIMEOUT = float(os.environ.get('SCHEMA_WAIT_TIMEOUT', '30'))
+# Endpoints that never touch the database and need not wait for the schema
+NO_DB_ENDPOINTS = {'login', 'static'}
+
+schema_ready = threading.Event()
+
+
+def migrate_schema():
+    """Create or upgrade all tables; run once per deploy or process start."""
+    try:
+        db.init_schema()
+    except Exception:
+        app.logger.exception('Database schema initialisation failed')
+    finally:
+        schema_ready.set()
+
+
+def _warm_pools():
+    for db_name in db.SCHEMA:
+        with db.connection(db_name) as conn:
+            conn.cursor().execute('SELECT 1')
+
+
+def _warm_qr():
+    qr_cache.create_qr_code('warm-up')  # loads qrcode and PIL
+    qr_cache.cache.evict_disk()  # measures the disk cache
 
-# --- Utility functions for database connections ---
-def get_sql_connection(db_name):
-    """Return a connection to the given database either on Azure SQL or local SQLite."""
-    if os.environ.get('WEBSITE_SITE_NAME'):
-        server = os.environ.get('AZURE_SQL_SERVER')
-        username = os.environ.get('AZURE_SQL_USER')
-        password = os.environ.get('AZURE_SQL_PASSWORD')
-        port = os.environ.get('AZURE_SQL_PORT', '1433')
-        conn_str = (
-            f'DRIVER={{ODBC Driver 17 for SQL Server}};'
-            f'SERVER={server},{port};'
-            f'DATABASE={db_name};'
-            f'UID={username};PWD={password}'
-        )
-        return pyodbc.connect(conn_str)
-    else:
-        return sqlite3.connect(f"{db_name.lower()}.db")
 
+# (name, function) pairs run in order by warm_up
+WARMUP_STEPS = [
+    ('database pools', _warm_pools),
+    ('media catalog', media_catalog.backfill),
+    ('btc rate refresher', btc_rate.provider.start),
+    ('script workers', script_pool.pool.start),
+    ('qr codes', _warm_qr),
+    ('numpy', lambda: importlib.import_module('numpy')),
+    ('maintenance scheduler', maintenance.start_scheduler),
+]
 
-class SQLLogHandler(logging.Handler):
-    """Logging handler that stores log records in the Log database."""
 
-    def emit(self, record):
-        msg = self.format(record)
-        ts = datetime.datetime.now().isoformat()
+def warm_up():
+    """Migrate (if enabled) and pre-initialise pools, caches and heavy imports.
+
+    Returns the seconds spent per step.
+    """
+    timings = {}
+    started = time.perf_counter()
+    if DB_MIGRATE_ON_START:
+        migrate_schema()
+        timings['schema'] = time.perf_counter() - started
+    for name, step in WARMUP_STEPS:
+        started = time.perf_counter()
         try:
-            conn = get_sql_connection('Log')
-            cursor = conn.cursor()
-            if isinstance(conn, sqlite3.Connection):
-                cursor.execute(
-                    'CREATE TABLE IF NOT EXISTS Logs ('
-                    'id INTEGER PRIMARY KEY AUTOINCREMENT,'
-                    'timestamp TEXT,'
-                    'level TEXT,'
-                    'message TEXT)'
-                )
-                cursor.execute(
-                    'INSERT INTO Logs (timestamp, level, message) VALUES (?, ?, ?)',
-                    (ts, record.levelname, msg),
-                )
-            else:
-                cursor.execute(
-                    'IF NOT EXISTS (SELECT * FROM sysobjects WHERE name="Logs" AND xtype="U") '
-                    'CREATE TABLE Logs ('
-                    'id INT IDENTITY(1,1) PRIMARY KEY,'
-                    'timestamp NVARCHAR(50),'
-                    'level NVARCHAR(20),'
-                    'message NVARCHAR(MAX))'
-                )
-                conn.commit()
-                cursor.execute(
-                    'INSERT INTO Logs (timestamp, level, message) VALUES (?, ?, ?)',
-                    ts,
-                    record.levelname,
-                    msg,
-                )
-            conn.commit()
-            conn.close()
+            step()
         except Exception:
-            # Avoid recursion if logging fails
-            pass
+            app.logger.exception(f'Warm-up step {name} failed')
+        timings[name] = time.perf_counter() - started
+    return timings
 
 
-log_handler = SQLLogHandler()
-log_handler.setLevel(logging.INFO)
-app.logger.addHandler(log_handler)
+def start_background_startup():
+    """Run warm-up (or just the migration) off the request path in this process."""
+    schema_ready.clear()
+    if not DB_MIGRATE_ON_START:
+        schema_ready.set()
+    if WARMUP_ON_START:
+        target = warm_up
+    elif DB_MIGRATE_ON_START:
+        target = migrate_schema
+    else:
+        return
+    threading.Thread(target=target, name='warm-up', daemon=True).start()
+
+
+# Set by the flask command for every subcommand, including ``flask run``
+FLASK_CLI = os.environ.get('FLASK_RUN_FROM_CLI') == 'true'
+
+# Spawned job and script workers import this module as __mp_main__; they
+# must not start their own warm-up
+if __name__ != '__mp_main__':
+    if FLASK_CLI:
+        # CLI commands run right after import: migrate first instead of
+        # racing them, and leave the rest to first use
+        if DB_MIGRATE_ON_START:
+            migrate_schema()
+        else:
+            schema_ready.set()
+    else:
+        start_background_startup()
+        # Threads do not survive fork: a preforked worker warms itself up
+        os.register_at_fork(after_in_child=start_background_startup)
+
+
+@app.before_request
+def wait_for_schema():
+    if request.endpoint not in NO_DB_ENDPOINTS and not schema_ready.is_set():
+        schema_ready.wait(SCHEMA_WAIT_TIMEOUT)
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Create or upgrade the database schema (run once per deploy)."""
+    started = time.perf_counter()
+    db.init_schema()
+    click.echo(f'Schema up to date ({(time.perf_counter() - started) * 1000:.0f} ms)')
 
 # Precomputed SHA3-512 hash of the allowed password
 HASHED_PASSWORD = "16725c4d35c707477e09bee390fbb27e3e294fe84a807940c8e8349891b6ef3137bf18be05144e9adb869436c96b3ba1c1a8b70c2543c5ade24e54b8644f3a47"
@@ -109,6 +183,58 @@ def login_required(func):
         return func(*args, **kwargs)
     return wrapper
 
+# --- Metrics ---
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+metrics.gauge('job_queue_depth', jobs.queue.depth, 'Jobs queued or running in the process pool.')
+metrics.gauge('movement_buffer_rows', movement_stream.buffer.pending_rows, 'Movement rows waiting to be written.')
+metrics.gauge('log_queue_depth', lambda: log_handler.stats()['queued'], 'Log records waiting to be written.')
+metrics.gauge('script_workers_busy', script_pool.pool.busy, 'Script workers currently running a script.')
+metrics.gauge('dependency_in_flight', concurrency.in_flight, 'Slots in use per dependency limit.')
+metrics.gauge('qr_cache_lookups', lambda: {
+    (('result', result),): qr_cache.cache.stats[result] for result in ('memory_hits', 'disk_hits', 'misses')
+}, 'QR code lookups by result since the worker started.')
+metrics.gauge('qr_cache_evictions', lambda: {
+    (('tier', tier),): qr_cache.cache.stats[f'{tier}_evictions'] for tier in ('memory', 'disk')
+}, 'QR codes evicted from each cache tier.')
+metrics.gauge('qr_cache_bytes', lambda: {
+    (('tier', tier),): qr_cache.cache.metrics()[f'{tier}_bytes'] or 0 for tier in ('memory', 'disk')
+}, 'Bytes held by each QR cache tier.')
+metrics.gauge('btc_rate_age_seconds', lambda: btc_rate.provider.get(wake=False).age or 0,
+              'Age of the cached BTC rate.')
+
+
+@app.before_request
+def start_request_timer():
+    metrics.registry.ensure_flusher()
+    g.request_started = time.perf_counter()
+    if metrics.METRICS_PROFILE and request.headers.get('X-Profile') == '1':
+        g.profiler = metrics.SamplingProfiler(threading.get_ident()).start()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - started,
+                        route=route, method=request.method, status=str(response.status_code))
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        response.headers['X-Profile-Id'] = metrics.save_profile(profiler.stop())
+    return response
+
+
+def metrics_access(func):
+    """Allow scrapers with ``Authorization: Bearer $METRICS_TOKEN``, else require login."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        supplied = request.headers.get('Authorization', '')
+        if METRICS_TOKEN and hmac.compare_digest(supplied, f'Bearer {METRICS_TOKEN}'):
+            return func(*args, **kwargs)
+        return login_required(func)(*args, **kwargs)
+    return wrapper
+
 # ...existing code...
 
 # --- Video recording endpoint ---
@@ -116,180 +242,299 @@ def login_required(func):
 @login_required
 def record_video():
     video = request.files['video']
-    filename = f"video_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.webm"
+    save_path = new_video_path()
+    video.save(save_path)
+    return register_video(save_path)
+
+def new_video_path():
+    # Suffix keeps uploads in the same second from overwriting each other
+    filename = f"video_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:6]}.webm"
     videos_dir = os.path.join('recordings', 'videos')
     os.makedirs(videos_dir, exist_ok=True)
-    save_path = os.path.join(videos_dir, filename)
-    video.save(save_path)
-    return jsonify({'status': 'ok'})
+    return os.path.join(videos_dir, filename)
+
+def register_video(save_path):
+    media_id = media_catalog.add('video', save_path)
+    return jsonify({'status': 'ok', 'media_id': media_id})
 
 # --- List recorded videos ---
 @app.route('/get_videos')
 @login_required
+@response_cache.cached('media')
 def get_videos():
-    videos_dir = os.path.join('recordings', 'videos')
+    """List videos from the media catalog, newest first, paged by ``before_id``."""
+    before_id, limit = pagination.parse_page_args(request.args, default_limit=50)
+    conditions, params = ["kind = 'video'"], []
+    if before_id is not None:
+        conditions.append('id < ?')
+        params.append(before_id)
+    sql = pagination.page_sql(('id', 'path'), 'Media', conditions, limit)
+    with db.connection('Recordings') as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
     videos = []
-    if os.path.exists(videos_dir):
-        for fname in sorted(os.listdir(videos_dir), reverse=True):
-            if fname.endswith('.webm'):
-                url = url_for('static', filename=f'../recordings/videos/{fname}')
-                videos.append({'url': url, 'name': fname})
-    return jsonify({'videos': videos})
+    for media_id, path in rows:
+        fname = path.rsplit('/', 1)[-1]
+        videos.append({'id': media_id, 'url': url_for('media_file', root='videos', filename=fname), 'name': fname})
+    next_before_id = rows[-1][0] if len(rows) == limit else None
+    return jsonify({'videos': videos, 'next_before_id': next_before_id})
+
+@app.route('/get_media')
+@login_required
+@response_cache.cached('media')
+def get_media():
+    """Stream catalog rows newest first, filtered by ``kind`` and ``from``/``to``."""
+    before_id, limit = pagination.parse_page_args(request.args)
+    kind = request.args.get('kind')
+    if kind is not None and kind not in media_catalog.KINDS:
+        raise pagination.PaginationError(f'kind must be one of {tuple(media_catalog.KINDS)}')
+    start = pagination.parse_time_arg(request.args.get('from'), 'from')
+    end = pagination.parse_time_arg(request.args.get('to'), 'to')
+    conditions, params = [], []
+    if kind is not None:
+        conditions.append('kind = ?')
+        params.append(kind)
+    if before_id is not None:
+        conditions.append('id < ?')
+        params.append(before_id)
+    if start is not None:
+        conditions.append('created_at >= ?')
+        params.append(start.isoformat())
+    if end is not None:
+        conditions.append('created_at <= ?')
+        params.append(end.isoformat())
+    columns = ('id', 'kind', 'path', 'bytes', 'duration', 'codec', 'created_at', 'recording_id')
+    sql = pagination.page_sql(columns, 'Media', conditions, limit)
+    return pagination.stream_page('Recordings', sql, params, columns, limit, key='media')
+
+@app.cli.command('reconcile-media')
+def reconcile_media_command():
+    """Rebuild the media catalog from the files on disk."""
+    report = media_catalog.reconcile()
+    click.echo(
+        f"Scanned {report['files']} file(s): {report['added']} added, "
+        f"{report['updated']} updated, {report['removed']} removed"
+    )
+
+# --- Media files (recordings, videos, QR images) ---
+@app.route('/media/<root>/<filename>')
+@login_required
+def media_file(root, filename):
+    """Serve a media file with Range, ETag/Last-Modified and cache headers."""
+    if root == 'recordings' and filename.endswith('.wav') and media.resolve(root, filename) is None:
+        # Wavs are derived from the webm when first downloaded
+        webm_path = media.resolve(root, filename[:-len('.wav')] + '.webm')
+        if webm_path is None:
+            abort(404)
+        derived.wav_for(webm_path)
+        return media.send_media('derived', filename)
+    return media.send_media(root, filename)
+
+@app.errorhandler(pagination.PaginationError)
+def pagination_error(exc):
+    return jsonify({'status': 'error', 'error': str(exc)}), 400
 
 @app.route('/get_movement')
 @login_required
+@response_cache.cached('movement')
 def get_movement():
-    records = []
-    if os.environ.get('WEBSITE_SITE_NAME'):
-        # Azure SQL
-        conn_str = os.environ.get('AZURE_SQL_CONNECTIONSTRING')
-        if not conn_str:
-            server = os.environ.get('AZURE_SQL_SERVER')
-            database = os.environ.get('AZURE_SQL_DATABASE')
-            username = os.environ.get('AZURE_SQL_USER')
-            password = os.environ.get('AZURE_SQL_PASSWORD')
-            port = os.environ.get('AZURE_SQL_PORT', '1433')
-            conn_str = (
-                f'DRIVER={{ODBC Driver 17 for SQL Server}};'
-                f'SERVER={server},{port};'
-                f'DATABASE={database};'
-                f'UID={username};PWD={password}'
-            )
-        conn = pyodbc.connect(conn_str)
-        cursor = conn.cursor()
-        cursor.execute('SELECT timestamp, lat, lon, gx, gy, gz FROM Movement ORDER BY id DESC')
-        for row in cursor.fetchall():
-            records.append({
-                'timestamp': row[0],
-                'lat': row[1],
-                'lon': row[2],
-                'gx': row[3],
-                'gy': row[4],
-                'gz': row[5]
-            })
-        conn.close()
-    else:
-        # Local SQLite
-        conn = sqlite3.connect('recordings.db')
-        c = conn.cursor()
-        c.execute('SELECT timestamp, lat, lon, gx, gy, gz FROM Movement ORDER BY id DESC')
-        for row in c.fetchall():
-            records.append({
-                'timestamp': row[0],
-                'lat': row[1],
-                'lon': row[2],
-                'gx': row[3],
-                'gy': row[4],
-                'gz': row[5]
-            })
-        conn.close()
-    return jsonify({'records': records})
+    """Stream Movement rows newest first, paged by ``before_id`` and filtered by ``from``/``to``."""
+    before_id, limit = pagination.parse_page_args(request.args)
+    start = pagination.parse_time_arg(request.args.get('from'), 'from')
+    end = pagination.parse_time_arg(request.args.get('to'), 'to')
+    conditions, params = [], []
+    if before_id is not None:
+        conditions.append('id < ?')
+        params.append(before_id)
+    if start is not None:
+        conditions.append('timestamp >= ?')
+        params.append(pagination.epoch_ms(start))
+    if end is not None:
+        conditions.append('timestamp <= ?')
+        params.append(pagination.epoch_ms(end))
+    columns = ('id', 'timestamp', 'lat', 'lon', 'gx', 'gy', 'gz')
+    sql = pagination.page_sql(columns, 'Movement', conditions, limit)
+    return pagination.stream_page('Recordings', sql, params, columns, limit)
 
 @app.route('/record_movement', methods=['POST'])
 @login_required
 def record_movement():
-    data = request.get_json().get('data', [])
-    # Use Azure SQL if running in Azure, else use SQLite
-    if os.environ.get('WEBSITE_SITE_NAME'):
-        # Azure SQL
-        conn_str = os.environ.get('AZURE_SQL_CONNECTIONSTRING')
-        if not conn_str:
-            server = os.environ.get('AZURE_SQL_SERVER')
-            database = os.environ.get('AZURE_SQL_DATABASE')
-            username = os.environ.get('AZURE_SQL_USER')
-            password = os.environ.get('AZURE_SQL_PASSWORD')
-            port = os.environ.get('AZURE_SQL_PORT', '1433')
-            conn_str = (
-                f'DRIVER={{ODBC Driver 17 for SQL Server}};'
-                f'SERVER={server},{port};'
-                f'DATABASE={database};'
-                f'UID={username};PWD={password}'
-            )
-        conn = pyodbc.connect(conn_str)
-        cursor = conn.cursor()
-        cursor.execute('''
-            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='Movement' AND xtype='U')
-            CREATE TABLE Movement (
-                id INT IDENTITY(1,1) PRIMARY KEY,
-                timestamp BIGINT,
-                lat FLOAT,
-                lon FLOAT,
-                gx FLOAT,
-                gy FLOAT,
-                gz FLOAT
-            )
-        ''')
-        conn.commit()
-        for entry in data:
-            cursor.execute('''INSERT INTO Movement (timestamp, lat, lon, gx, gy, gz) VALUES (?, ?, ?, ?, ?, ?)''',
-                           entry.get('timestamp'), entry.get('lat'), entry.get('lon'), entry.get('gx'), entry.get('gy'), entry.get('gz'))
-        conn.commit()
-        conn.close()
-    else:
-        # Local SQLite
-        conn = sqlite3.connect('recordings.db')
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS Movement (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp INTEGER,
-            lat REAL,
-            lon REAL,
-            gx REAL,
-            gy REAL,
-            gz REAL
-        )''')
-        for entry in data:
-            c.execute('INSERT INTO Movement (timestamp, lat, lon, gx, gy, gz) VALUES (?, ?, ?, ?, ?, ?)',
-                      (entry.get('timestamp'), entry.get('lat'), entry.get('lon'), entry.get('gx'), entry.get('gy'), entry.get('gz')))
-        conn.commit()
-        conn.close()
-    return jsonify({'status': 'ok'})
+    payload = request.get_json(silent=True) or {}
+    try:
+        result = movement.store_samples(payload.get('data', []))
+    except movement.MovementValidationError as exc:
+        return jsonify({'status': 'error', 'error': str(exc)}), 400
+    return jsonify({'status': 'ok', **result})
+
+@app.route('/record_movement/stream', methods=['POST'])
+@login_required
+def record_movement_chunk():
+    """Accept one numbered chunk of a recording session as JSON or NDJSON."""
+    try:
+        if request.mimetype == 'application/x-ndjson':
+            session_id = request.args.get('session_id')
+            seq = request.args.get('seq')
+            samples = movement_stream.parse_ndjson(request.stream)
+        else:
+            payload = request.get_json(silent=True) or {}
+            session_id = payload.get('session_id')
+            seq = payload.get('seq')
+            samples = movement_stream.check_chunk_size(payload.get('data', []))
+        session_id = movement_stream.validate_session_id(session_id)
+        seq = movement_stream.validate_seq(seq)
+        accepted = movement_stream.buffer.add(session_id, seq, samples)
+    except movement.MovementValidationError as exc:
+        return jsonify({'status': 'error', 'error': str(exc)}), 400
+    return jsonify({
+        'status': 'accepted' if accepted else 'duplicate',
+        'session_id': session_id,
+        'seq': seq,
+    }), 202
+
+@app.route('/record_movement/stream/<session_id>/finish', methods=['POST'])
+@login_required
+def finish_movement_session(session_id):
+    """Flush buffered chunks and report what has been stored for the session."""
+    try:
+        movement_stream.validate_session_id(session_id)
+    except movement.MovementValidationError as exc:
+        return jsonify({'status': 'error', 'error': str(exc)}), 400
+    try:
+        movement_stream.buffer.flush()
+    except movement_stream.MovementFlushError as exc:
+        parked = exc.seqs(session_id, parked=True)
+        if parked:
+            return jsonify({
+                'status': 'error',
+                'error': 'some chunks of this session could not be stored; resend them',
+                'session_id': session_id,
+                'failed_seqs': parked,
+            }), 500
+        if exc.seqs(session_id):
+            return jsonify({
+                'status': 'busy',
+                'error': 'some chunks of this session could not be written yet',
+                'session_id': session_id,
+            }), 503, {'Retry-After': '1'}
+    if movement.MOVEMENT_STORAGE in ('blocks', 'both'):
+        movement_blocks.compact_session(session_id)
+    return jsonify({'status': 'ok', **movement_stream.session_summary(session_id)})
+
+@app.route('/get_movement_blocks')
+@login_required
+def get_movement_blocks():
+    """Return one session's samples as columns decoded from MovementBlocks."""
+    session_id = request.args.get('session_id')
+    try:
+        movement_stream.validate_session_id(session_id)
+    except movement.MovementValidationError as exc:
+        return jsonify({'status': 'error', 'error': str(exc)}), 400
+    start = pagination.parse_time_arg(request.args.get('from'), 'from')
+    end = pagination.parse_time_arg(request.args.get('to'), 'to')
+    columns = movement_blocks.read_range(
+        session_id,
+        pagination.epoch_ms(start) if start else None,
+        pagination.epoch_ms(end) if end else None,
+    )
+    return jsonify({
+        'session_id': session_id,
+        'count': len(columns['timestamp']),
+        'columns': movement_blocks.columns_to_json(columns),
+    })
+
+@app.route('/movement_analytics/<session_id>')
+@login_required
+def get_movement_analytics(session_id):
+    """Distance, speed and g-force statistics for one session, optionally downsampled."""
+    method = request.args.get('method', 'lttb')
+    try:
+        movement_stream.validate_session_id(session_id)
+        points = pagination.int_arg(request.args, 'points')
+    except (movement.MovementValidationError, pagination.PaginationError) as exc:
+        return jsonify({'status': 'error', 'error': str(exc)}), 400
+    if method not in movement_analytics.DOWNSAMPLE_METHODS:
+        return jsonify({'status': 'error', 'error': f'method must be one of {movement_analytics.DOWNSAMPLE_METHODS}'}), 400
+    if points is not None and not 2 <= points <= pagination.MAX_PAGE_SIZE:
+        return jsonify({'status': 'error', 'error': f'points must be between 2 and {pagination.MAX_PAGE_SIZE}'}), 400
+    return jsonify(movement_analytics.session_analytics(session_id, points, method))
+
+@app.route('/get_movement_bbox')
+@login_required
+@response_cache.cached('movement')
+def get_movement_bbox():
+    """Stream Movement rows inside ``bbox`` newest first, paged like ``/get_movement``."""
+    bbox = movement_spatial.parse_bbox(request.args.get('bbox'))
+    before_id, limit = pagination.parse_page_args(request.args)
+    start = pagination.parse_time_arg(request.args.get('from'), 'from')
+    end = pagination.parse_time_arg(request.args.get('to'), 'to')
+    conditions, params = movement_spatial.bbox_conditions(bbox)
+    if before_id is not None:
+        conditions.append('id < ?')
+        params.append(before_id)
+    if start is not None:
+        conditions.append('timestamp >= ?')
+        params.append(pagination.epoch_ms(start))
+    if end is not None:
+        conditions.append('timestamp <= ?')
+        params.append(pagination.epoch_ms(end))
+    columns = ('id', 'timestamp', 'lat', 'lon', 'gx', 'gy', 'gz')
+    sql = pagination.page_sql(columns, 'Movement', conditions, limit)
+    return pagination.stream_page('Recordings', sql, params, columns, limit)
+
+@app.route('/movement_grid')
+@login_required
+@response_cache.cached('movement')
+def movement_grid():
+    """Count Movement points per map tile at ``zoom`` inside ``bbox``."""
+    bbox = movement_spatial.parse_bbox(request.args.get('bbox'))
+    zoom = pagination.int_arg(request.args, 'zoom')
+    if zoom is None:
+        raise pagination.PaginationError('zoom is required')
+    start = pagination.parse_time_arg(request.args.get('from'), 'from')
+    end = pagination.parse_time_arg(request.args.get('to'), 'to')
+    cells = movement_spatial.grid(
+        bbox, zoom,
+        pagination.epoch_ms(start) if start else None,
+        pagination.epoch_ms(end) if end else None,
+    )
+    return jsonify({
+        'zoom': zoom,
+        'total': sum(count for _, _, count in cells),
+        'cells': [
+            {'x': x, 'y': y, 'count': count, 'bounds': movement_spatial.tile_bounds(zoom, x, y)}
+            for x, y, count in cells
+        ],
+    })
+
+@app.cli.command('pack-movement')
+@click.option('--session', 'session_id', default=None, help='Only pack this session.')
+def pack_movement_command(session_id):
+    """Copy row-per-sample Movement data into compressed MovementBlocks."""
+    packed = movement_blocks.pack_rows(session_id)
+    click.echo(f'Packed {packed} session(s)')
 
 @app.route('/get_archive')
 @login_required
+@response_cache.cached('recordings')
 def get_archive():
-    # Use Azure SQL if running in Azure, else use SQLite
-    records = []
-    if os.environ.get('WEBSITE_SITE_NAME'):
-        # Azure SQL
-        conn_str = os.environ.get('AZURE_SQL_CONNECTIONSTRING')
-        if not conn_str:
-            server = os.environ.get('AZURE_SQL_SERVER')
-            database = os.environ.get('AZURE_SQL_DATABASE')
-            username = os.environ.get('AZURE_SQL_USER')
-            password = os.environ.get('AZURE_SQL_PASSWORD')
-            port = os.environ.get('AZURE_SQL_PORT', '1433')
-            conn_str = (
-                f'DRIVER={{ODBC Driver 17 for SQL Server}};'
-                f'SERVER={server},{port};'
-                f'DATABASE={database};'
-                f'UID={username};PWD={password}'
-            )
-        conn = pyodbc.connect(conn_str)
-        cursor = conn.cursor()
-        cursor.execute('SELECT date, filename, length, transcription FROM Recordings ORDER BY id DESC')
-        for row in cursor.fetchall():
-            records.append({
-                'date': row[0],
-                'filename': row[1],
-                'length': row[2],
-                'transcription': row[3]
-            })
-        conn.close()
-    else:
-        # Local SQLite
-        conn = sqlite3.connect('recordings.db')
-        c = conn.cursor()
-        c.execute('SELECT date, filename, length, transcription FROM Recordings ORDER BY id DESC')
-        for row in c.fetchall():
-            records.append({
-                'date': row[0],
-                'filename': row[1],
-                'length': row[2],
-                'transcription': row[3]
-            })
-        conn.close()
-    return jsonify({'records': records})
+    """Stream Recordings rows newest first, paged by ``before_id`` and filtered by ``from``/``to``."""
+    before_id, limit = pagination.parse_page_args(request.args)
+    start = pagination.parse_time_arg(request.args.get('from'), 'from')
+    end = pagination.parse_time_arg(request.args.get('to'), 'to')
+    conditions, params = [], []
+    if before_id is not None:
+        conditions.append('id < ?')
+        params.append(before_id)
+    if start is not None:
+        conditions.append('date >= ?')
+        params.append(start.isoformat())
+    if end is not None:
+        conditions.append('date <= ?')
+        params.append(end.isoformat())
+    columns = ('id', 'date', 'filename', 'length', 'transcription')
+    sql = pagination.page_sql(columns, 'Recordings', conditions, limit)
+    return pagination.stream_page('Recordings', sql, params, columns, limit)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -320,103 +565,44 @@ def functions1():
 def show_smiley():
     return render_template('smiley.html')
 
+@app.errorhandler(concurrency.DependencyBusy)
+def dependency_busy(exc):
+    return jsonify({'status': 'busy', 'error': str(exc)}), 503, {'Retry-After': '1'}
+
+@app.errorhandler(script_pool.ScriptPoolBusy)
+def script_pool_busy(exc):
+    return jsonify({'status': 'busy', 'error': str(exc)}), 503, {'Retry-After': '1'}
+
+@app.errorhandler(script_pool.ScriptTimeout)
+def script_timeout(exc):
+    return jsonify({'status': 'error', 'error': str(exc)}), 504
+
 @app.route('/run_script_no_args', methods=['POST'])
 @login_required
 def run_script_no_args():
     # Replace 'script_no_args.py' with your script name
-    result = subprocess.run(['python', 'script_no_args.py'], capture_output=True, text=True)
-    return jsonify({'output': result.stdout})
+    result = script_pool.pool.run('script_no_args.py')
+    return jsonify({'output': result['stdout'], 'exit_code': result['exit_code']})
 
 @app.route('/run_script_with_args', methods=['POST'])
 @login_required
 def run_script_with_args():
     arg = request.form.get('arg')
     # Replace 'script_with_args.py' with your script name
-    result = subprocess.run(['python', 'script_with_args.py', arg], capture_output=True, text=True)
-    return jsonify({'output': result.stdout})
+    result = script_pool.pool.run('script_with_args.py', [arg] if arg is not None else [])
+    return jsonify({'output': result['stdout'], 'exit_code': result['exit_code']})
 
 
 # --- Simple ecommerce demo ---
-def fetch_btc_rate():
-    """Fetch current BTC rate in EUR. Fallback to a fixed value on error."""
-    try:
-        resp = requests.get('https://api.coindesk.com/v1/bpi/currentprice/EUR.json', timeout=5)
-        data = resp.json()
-        rate = float(data['bpi']['EUR']['rate'].replace(',', ''))
-        return rate
-    except Exception:
-        return 30000.0
+@app.errorhandler(orders.OrderError)
+def order_error(exc):
+    return jsonify({'status': 'error', 'error': str(exc)}), exc.status
 
 
-def create_qr_code(data, path):
-    """Generate a QR code image with high error correction."""
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_H,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(data)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    img.save(path)
-
-
-def record_purchase(apples, bananas, name, address, email, total_eur, total_btc, tx_hash):
-    """Store purchase information in the Purchases database."""
-    ts = datetime.datetime.now().isoformat()
-    conn = get_sql_connection('Purchases')
-    cursor = conn.cursor()
-    if isinstance(conn, sqlite3.Connection):
-        cursor.execute(
-            'CREATE TABLE IF NOT EXISTS Purchases ('
-            'id INTEGER PRIMARY KEY AUTOINCREMENT,'
-            'timestamp TEXT,'
-            'apples INTEGER,'
-            'bananas INTEGER,'
-            'name TEXT,'
-            'address TEXT,'
-            'email TEXT,'
-            'total_eur REAL,'
-            'total_btc REAL,'
-            'tx_hash TEXT)'
-        )
-        cursor.execute(
-            'INSERT INTO Purchases (timestamp, apples, bananas, name, address, email, total_eur, total_btc, tx_hash) '
-            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
-            (ts, apples, bananas, name, address, email, total_eur, total_btc, tx_hash),
-        )
-    else:
-        cursor.execute(
-            'IF NOT EXISTS (SELECT * FROM sysobjects WHERE name="Purchases" AND xtype="U") '
-            'CREATE TABLE Purchases ('
-            'id INT IDENTITY(1,1) PRIMARY KEY,'
-            'timestamp NVARCHAR(50),'
-            'apples INT,'
-            'bananas INT,'
-            'name NVARCHAR(255),'
-            'address NVARCHAR(255),'
-            'email NVARCHAR(255),'
-            'total_eur FLOAT,'
-            'total_btc FLOAT,'
-            'tx_hash NVARCHAR(64))'
-        )
-        conn.commit()
-        cursor.execute(
-            'INSERT INTO Purchases (timestamp, apples, bananas, name, address, email, total_eur, total_btc, tx_hash) '
-            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
-            ts,
-            apples,
-            bananas,
-            name,
-            address,
-            email,
-            total_eur,
-            total_btc,
-            tx_hash,
-        )
-    conn.commit()
-    conn.close()
+def payment_qr_filename(total_btc):
+    btc_uri = f"bitcoin:{BTC_ADDRESS}?amount={total_btc}"
+    qr_key, _ = qr_cache.cache.get(btc_uri)
+    return f"{qr_key}.png"
 
 
 @app.route('/ecommerce')
@@ -428,53 +614,28 @@ def ecommerce():
 @app.route('/checkout', methods=['POST'])
 @login_required
 def checkout():
-    apples = int(request.form.get('apples', 0))
-    bananas = int(request.form.get('bananas', 0))
+    apples = orders.quantity(request.form.get('apples'), 'apples')
+    bananas = orders.quantity(request.form.get('bananas'), 'bananas')
     name = request.form.get('name')
     address = request.form.get('address')
     email = request.form.get('email')
     app.logger.debug('Checkout requested')
 
-    total_eur = apples * 1 + bananas * 2
-    rate = fetch_btc_rate()
-    total_btc = round(total_eur / rate, 8)
-
-    # Create a unique hash for this transaction
-    tx_seed = f"{name}|{address}|{email}|{apples}|{bananas}|{total_eur}|{total_btc}|{uuid.uuid4().hex}"
-    tx_hash = hashlib.sha256(tx_seed.encode()).hexdigest()
-
-    # Generate a QR code for payment
-    btc_uri = f"bitcoin:{BTC_ADDRESS}?amount={total_btc}"
-    qr_dir = os.path.join('static', 'qrcodes')
-    os.makedirs(qr_dir, exist_ok=True)
-    qr_filename = f"{tx_hash}.png"
-    qr_path = os.path.join(qr_dir, qr_filename)
-    create_qr_code(btc_uri, qr_path)
-
-    record_purchase(
-        apples,
-        bananas,
-        name,
-        address,
-        email,
-        total_eur,
-        total_btc,
-        tx_hash,
-    )
+    rate_info = btc_rate.provider.get()
+    # The order is stored once here; update_payment only reprices it
+    order = orders.create(apples, bananas, name, address, email, rate_info.value)
 
     return render_template(
         'checkout.html',
-        total_eur=total_eur,
-        total_btc=total_btc,
+        order_id=order['order_id'],
+        total_eur=order['total_eur'],
+        total_btc=order['total_btc'],
         btc_address=BTC_ADDRESS,
-        btc_rate=rate,
-        tx_hash=tx_hash,
-        qr_filename=qr_filename,
-        apples=apples,
-        bananas=bananas,
-        name=name,
-        address=address,
-        email=email,
+        btc_rate=order['btc_rate'],
+        btc_rate_age=rate_info.age,
+        btc_rate_source=rate_info.source,
+        tx_hash=order['tx_hash'],
+        qr_filename=payment_qr_filename(order['total_btc']),
     )
 
 
@@ -482,46 +643,44 @@ def checkout():
 @login_required
 def update_payment():
     data = request.get_json(force=True)
-    apples = int(data.get('apples', 0))
-    bananas = int(data.get('bananas', 0))
-    name = data.get('name')
-    address = data.get('address')
-    email = data.get('email')
     app.logger.debug('Updating payment')
 
-    total_eur = apples * 1 + bananas * 2
-    rate = fetch_btc_rate()
-    total_btc = round(total_eur / rate, 8)
-
-    tx_seed = f"{name}|{address}|{email}|{apples}|{bananas}|{total_eur}|{total_btc}|{uuid.uuid4().hex}"
-    tx_hash = hashlib.sha256(tx_seed.encode()).hexdigest()
-
-    btc_uri = f"bitcoin:{BTC_ADDRESS}?amount={total_btc}"
-    qr_dir = os.path.join('static', 'qrcodes')
-    os.makedirs(qr_dir, exist_ok=True)
-    qr_filename = f"{tx_hash}.png"
-    qr_path = os.path.join(qr_dir, qr_filename)
-    create_qr_code(btc_uri, qr_path)
-    record_purchase(
-        apples,
-        bananas,
-        name,
-        address,
-        email,
-        total_eur,
-        total_btc,
-        tx_hash,
-    )
-    app.logger.debug(f"New tx hash {tx_hash}")
+    rate_info = btc_rate.provider.get()
+    order, changed = orders.reprice(data.get('order_id'), rate_info.value)
+    if changed:
+        app.logger.debug(f"New tx hash {order['tx_hash']}")
 
     return jsonify({
-        'tx_hash': tx_hash,
-        'qr_filename': qr_filename,
-        'total_btc': total_btc,
-        'btc_rate': rate,
+        'order_id': order['order_id'],
+        'tx_hash': order['tx_hash'],
+        'changed': changed,
+        'qr_filename': payment_qr_filename(order['total_btc']),
+        'total_btc': order['total_btc'],
+        'btc_rate': order['btc_rate'],
+        'btc_rate_age': rate_info.age,
+        'btc_rate_source': rate_info.source,
     })
 
 
+@app.route('/orders/<order_id>')
+@login_required
+def get_order(order_id):
+    order = orders.get(order_id)
+    if order is None:
+        return jsonify({'status': 'error', 'error': 'order not found'}), 404
+    return jsonify(order)
+
+
+@app.route('/orders')
+@login_required
+def find_order():
+    """Look up the order holding a transaction hash (``?tx_hash=``)."""
+    order = orders.find_by_tx_hash(request.args.get('tx_hash'))
+    if order is None:
+        return jsonify({'status': 'error', 'error': 'order not found'}), 404
+    return jsonify(order)
+
+
 # --- Generic QR generator page ---
 @app.route('/qr', methods=['GET', 'POST'])
 @login_required
@@ -542,103 +701,335 @@ def qr_generator():
                 if amount:
                     data += f'?amount={amount}'
         if data:
-            qr_dir = os.path.join('static', 'qrcodes')
-            os.makedirs(qr_dir, exist_ok=True)
-            qr_filename = f"{uuid.uuid4().hex}.png"
-            qr_path = os.path.join(qr_dir, qr_filename)
-            create_qr_code(data, qr_path)
+            qr_key, _ = qr_cache.cache.get(data)
+            qr_filename = f"{qr_key}.png"
     return render_template('qr_generator.html', qr_filename=qr_filename)
 
 
+@app.route('/qrcodes/<key>.png')
+@login_required
+def qr_image(key):
+    """Serve a cached QR PNG; the key is a content hash, so the image never changes."""
+    if len(key) != 64 or any(ch not in '0123456789abcdef' for ch in key):
+        abort(404)
+    png = qr_cache.cache.memory(key)
+    if png is None:
+        if qr_cache.cache.touch(key):
+            return media.send_media('qrcodes', f'{key}.png')
+        abort(404)
+    etag = f'"{key}"'
+    headers = {'ETag': etag, 'Cache-Control': f'private, max-age={media.IMMUTABLE_MAX_AGE}, immutable'}
+    if etag in request.headers.get('If-None-Match', ''):
+        return '', 304, headers
+    return Response(png, mimetype='image/png', headers=headers)
+
+
 # --- Audio recording endpoint ---
 @app.route('/record_message', methods=['POST'])
 @login_required
 def record_message():
     audio = request.files['audio']
-    filename = secure_filename(f"recording_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.webm")
+    save_path = new_message_path()
+    audio.save(save_path)
+    return register_message(save_path)
+
+def new_message_path():
+    filename = secure_filename(
+        f"recording_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:6]}.webm"
+    )
     recordings_dir = os.path.join('recordings')
     os.makedirs(recordings_dir, exist_ok=True)
-    save_path = os.path.join(recordings_dir, filename)
-    audio.save(save_path)
+    return os.path.join(recordings_dir, filename)
+
+def register_message(save_path, discard=os.remove):
+    """Record an uploaded message; returns the response.
+
+    When the conversion queue is full the message is not recorded and
+    ``discard(save_path)`` disposes of the file.
+
+    The length comes from the webm's container metadata.  A wav is only
+    derived, on the job queue, when the message is transcribed or the
+    metadata had no usable duration.
+    """
+    filename = os.path.basename(save_path)
+    probed = media_catalog.probe(save_path)
+    length = probed[0]
+
+    transcription = ''
+    with db.connection('Recordings') as conn:
+        recording_id = db.insert_returning_id(
+            conn.cursor(),
+            'INSERT INTO Recordings (date, filename, length, transcription) VALUES (?, ?, ?, ?)',
+            (datetime.datetime.now().isoformat(), filename, length, transcription),
+        )
+        conn.commit()
+    response_cache.bump('recordings')
+    media_catalog.add('audio', save_path, recording_id, probed=probed)
+
+    transcribe = transcription_pipeline.TRANSCRIBE_ON_UPLOAD
+    if length is not None and not transcribe:
+        return jsonify({
+            'status': 'ok',
+            'job_id': None,
+            'recording_id': recording_id,
+            'length': length,
+            'transcription': transcription,
+        }), 201
+
+    def set_length(length):
+        with db.connection('Recordings') as conn:
+            conn.cursor().execute('UPDATE Recordings SET length = ? WHERE id = ?', (length, recording_id))
+            conn.commit()
+        response_cache.bump('recordings')
+        media_catalog.set_duration(recording_id, length)
+
+    def converted(result):
+        metrics.observe('ffmpeg_seconds', result['ffmpeg_seconds'])
+        if length is None and result['length'] is not None:
+            set_length(result['length'])
+        transcription_job_id = None
+        if transcribe:
+            try:
+                transcription_job_id = transcription_pipeline.submit(recording_id, result['wav'])
+            except jobs.JobQueueFull:
+                # Picked up later by `flask transcribe-backfill`
+                pass
+        return {
+            **result,
+            'length': length if length is not None else result['length'],
+            'transcription_job_id': transcription_job_id,
+        }
 
-    # Convert webm to wav for transcription (if possible)
-    wav_path = None
     try:
-        import ffmpeg
-        wav_path = os.path.join(recordings_dir, filename.replace('.webm', '.wav'))
-        (
-            ffmpeg
-            .input(save_path)
-            .output(wav_path)
-            .run(overwrite_output=True, quiet=True)
+        job_id = derived.submit(
+            save_path,
+            recording_id=recording_id,
+            on_done=converted,
+            on_error=lambda exc: set_length(0) if length is None else None,
         )
-    except Exception:
-        wav_path = None
-
-    # Get audio length
-    length = 0
-    if wav_path and os.path.exists(wav_path):
-        with wave.open(wav_path, 'rb') as wf:
-            frames = wf.getnframes()
-            rate = wf.getframerate()
-            length = round(frames / float(rate), 2)
-    else:
-        length = 0
+    except jobs.JobQueueFull:
+        # Undo the upload so the client can simply retry later
+        with db.connection('Recordings') as conn:
+            conn.cursor().execute('DELETE FROM Recordings WHERE id = ?', (recording_id,))
+            conn.commit()
+        response_cache.bump('recordings')
+        media_catalog.remove(save_path)
+        discard(save_path)
+        return jsonify({'status': 'busy', 'error': 'conversion queue is full'}), 503, {'Retry-After': '5'}
 
-    # Prepare transcription value
-    transcription = ''
+    return jsonify({
+        'status': 'queued',
+        'job_id': job_id,
+        'recording_id': recording_id,
+        'length': length,
+        'transcription': transcription,
+    }), 202
 
 
-    # Use Azure SQL if running in Azure, else use SQLite
-    if os.environ.get('WEBSITE_SITE_NAME'):
-        # Azure SQL
-        conn_str = os.environ.get('AZURE_SQL_CONNECTIONSTRING')
-        if not conn_str:
-            server = os.environ.get('AZURE_SQL_SERVER')
-            database = os.environ.get('AZURE_SQL_DATABASE')
-            username = os.environ.get('AZURE_SQL_USER')
-            password = os.environ.get('AZURE_SQL_PASSWORD')
-            port = os.environ.get('AZURE_SQL_PORT', '1433')
-            conn_str = (
-                f'DRIVER={{ODBC Driver 17 for SQL Server}};'
-                f'SERVER={server},{port};'
-                f'DATABASE={database};'
-                f'UID={username};PWD={password}'
-            )
-        conn = pyodbc.connect(conn_str)
-        cursor = conn.cursor()
-        cursor.execute('''
-            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='Recordings' AND xtype='U')
-            CREATE TABLE Recordings (
-                id INT IDENTITY(1,1) PRIMARY KEY,
-                date NVARCHAR(50),
-                filename NVARCHAR(255),
-                length FLOAT,
-                transcription NVARCHAR(MAX)
+# --- Resumable uploads ---
+@app.errorhandler(uploads.UploadError)
+def upload_error(exc):
+    return jsonify({'status': 'error', 'error': str(exc), **exc.extra}), exc.status
+
+@app.route('/uploads', methods=['POST'])
+@login_required
+def create_upload():
+    payload = request.get_json(silent=True) or {}
+    return jsonify(uploads.create(payload.get('kind'))), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    return jsonify(uploads.status(upload_id))
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    """Append one chunk; the body is streamed to disk, never held in memory."""
+    offset = request.args.get('offset')
+    if offset is None or not offset.isdigit():
+        raise uploads.UploadError('offset must be a non-negative integer')
+    new_offset = uploads.write_chunk(
+        upload_id, int(offset), request.stream, request.content_length,
+        request.headers.get('X-Chunk-Sha256'),
+    )
+    return jsonify({'upload_id': upload_id, 'offset': new_offset})
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload(upload_id):
+    """Store a completed upload; repeating the call returns the first success."""
+    fresh = {}
+
+    def store(kind, part_path):
+        if kind == 'video':
+            save_path = new_video_path()
+            os.replace(part_path, save_path)
+            response = make_response(register_video(save_path))
+        else:
+            save_path = new_message_path()
+            os.replace(part_path, save_path)
+            # When the queue is full the file goes back, so finalize can be retried
+            response = make_response(
+                register_message(save_path, discard=lambda path: os.replace(path, part_path))
             )
-        ''')
-        conn.commit()
-        cursor.execute('''INSERT INTO Recordings (date, filename, length, transcription) VALUES (?, ?, ?, ?)''',
-                       datetime.datetime.now().isoformat(), filename, length, transcription)
-        conn.commit()
-        conn.close()
-    else:
-        # Local SQLite
-        conn = sqlite3.connect('recordings.db')
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS Recordings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT,
-            filename TEXT,
-            length REAL,
-            transcription TEXT
-        )''')
-        c.execute('INSERT INTO Recordings (date, filename, length, transcription) VALUES (?, ?, ?, ?)',
-                  (datetime.datetime.now().isoformat(), filename, length, transcription))
-        conn.commit()
-        conn.close()
+        fresh['response'] = response
+        return response.get_json(), response.status_code
+
+    body, status_code = uploads.finalize(upload_id, store)
+    # A repeated finalize rebuilds the saved response
+    return fresh.get('response') or (jsonify(body), status_code)
+
+
+@app.route('/metrics')
+@metrics_access
+def metrics_endpoint():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/profiles/<profile_id>')
+@metrics_access
+def metrics_profile(profile_id):
+    """Collapsed stacks of a request sent with ``X-Profile: 1``."""
+    text = metrics.get_profile(profile_id)
+    if text is None:
+        abort(404)
+    return Response(text, mimetype='text/plain')
+
+
+# --- Log queries ---
+def log_filters(args):
+    return {
+        'level': args.get('level'),
+        'start': pagination.parse_time_arg(args.get('from'), 'from'),
+        'end': pagination.parse_time_arg(args.get('to'), 'to'),
+        'text': args.get('q'),
+    }
+
+@app.route('/logs')
+@login_required
+def get_logs():
+    """Stream log records newest first, filtered by ``level``, ``from``/``to`` and ``q``."""
+    before_id, limit = pagination.parse_page_args(request.args)
+    conditions, params = logs.filter_conditions(**log_filters(request.args))
+    if before_id is not None:
+        conditions.append('id < ?')
+        params.append(before_id)
+    sql = pagination.page_sql(logs.COLUMNS, 'Logs', conditions, limit)
+    return pagination.stream_page('Log', sql, params, logs.COLUMNS, limit, key='logs')
+
+@app.route('/logs/tail')
+@login_required
+def tail_logs():
+    """Stream the last ``backlog`` matching records, then new ones, as NDJSON."""
+    filters = log_filters(request.args)
+    # Validate before the response starts streaming
+    logs.filter_conditions(**filters)
+    backlog = pagination.int_arg(request.args, 'backlog', 20)
+    if backlog < 0:
+        raise pagination.PaginationError('backlog must not be negative')
+    records = logs.follow(backlog=min(backlog, pagination.MAX_PAGE_SIZE), **filters)
+
+    def generate():
+        for record in records:
+            # Empty lines are keep-alives; they also detect closed connections
+            yield json.dumps(record, default=str) + '\n' if record else '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.cli.command('logs')
+@click.option('--level', help='Minimum level, e.g. WARNING.')
+@click.option('--since', help='Epoch milliseconds or ISO 8601 timestamp.')
+@click.option('--until', help='Epoch milliseconds or ISO 8601 timestamp.')
+@click.option('-q', '--search', help='Words the message must contain; end a word with * to match a prefix.')
+@click.option('--limit', type=int, default=50, show_default=True, help='Records per page.')
+@click.option('--before-id', type=int, default=None, help='Show records older than this id.')
+@click.option('-f', '--follow', is_flag=True, help='Keep printing records as they are stored.')
+def logs_command(level, since, until, search, limit, before_id, follow):
+    """Print stored log records, oldest first."""
+    try:
+        filters = {
+            'level': level,
+            'start': pagination.parse_time_arg(since, 'since'),
+            'end': pagination.parse_time_arg(until, 'until'),
+            'text': search,
+        }
+        if follow:
+            for record in logs.follow(backlog=limit, max_seconds=0, **filters):
+                if record:
+                    click.echo(format_log_record(record))
+            return
+        records = logs.query(before_id=before_id, limit=limit, **filters)
+    except pagination.PaginationError as exc:
+        raise click.UsageError(str(exc))
+    for record in reversed(records):
+        click.echo(format_log_record(record))
+    if len(records) == limit:
+        click.echo(f"-- older records: --before-id {records[-1]['id']}")
+
+def format_log_record(record):
+    return f"{record['id']:>8} {record['timestamp']} {record['level']:<8} {record['message']}"
+
+
+# --- Maintenance ---
+@app.route('/maintenance/report')
+@login_required
+def maintenance_report():
+    """Report of the last retention/compaction run on this host."""
+    report = maintenance.last_report()
+    if report is None:
+        return jsonify({'status': 'error', 'error': 'maintenance has not run yet'}), 404
+    return jsonify(report)
+
+@app.cli.command('maintenance')
+@click.option('--step', 'steps', multiple=True, type=click.Choice([name for name, _ in maintenance.STEPS]),
+              help='Run only this step; repeat for several.')
+@click.option('--full-vacuum', is_flag=True,
+              help='Rewrite the SQLite databases once to enable incremental vacuum; blocks writers meanwhile.')
+def maintenance_command(steps, full_vacuum):
+    """Apply retention, roll up old movement, prune media and compact the databases."""
+    if full_vacuum:
+        if db.is_azure():
+            raise click.ClickException('--full-vacuum applies to SQLite databases only')
+        sizes = maintenance.full_vacuum()
+        if sizes is None:
+            raise click.ClickException('maintenance is already running in another process')
+        for db_name, size in sizes.items():
+            click.echo(f"{db_name}: {size['before']} -> {size['after']} bytes")
+        return
+    report = maintenance.run_exclusive(only=steps or None)
+    if report is None:
+        raise click.ClickException('maintenance is already running in another process')
+    click.echo(maintenance.format_report(report))
+
+
+@app.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'error': 'unknown job'}), 404
+    return jsonify(job)
+
+@app.cli.command('transcribe-backfill')
+@click.option('--limit', type=int, default=None, help='Transcribe at most this many recordings.')
+@click.option('--workers', type=int, default=jobs.JOB_WORKERS, show_default=True, help='Worker processes.')
+@click.option('--backend', default=transcription_pipeline.TRANSCRIBE_BACKEND, show_default=True,
+              help='sphinx, vosk or module:function.')
+def transcribe_backfill_command(limit, workers, backend):
+    """Transcribe recordings that have an empty transcription."""
+    report = transcription_pipeline.backfill(workers=workers, limit=limit, backend=backend)
+    click.echo(
+        f"Transcribed {report['transcribed']} recording(s), {report['failed']} failed; "
+        f"{report['audio_seconds']}s of audio in {report['wall_seconds']}s "
+        f"({report['audio_seconds_per_second']} audio s/s)"
+    )
 
-    return jsonify({'status': 'ok', 'length': length, 'transcription': transcription})
 
 if __name__ == '__main__':
+    if '--startup-report' in sys.argv:
+        import startup
+        text, total_ms = startup.report()
+        print(text)
+        sys.exit(1 if startup.STARTUP_BUDGET_MS and total_ms > startup.STARTUP_BUDGET_MS else 0)
     app.run(host='0.0.0.0', port=8000)
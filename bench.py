@@ -0,0 +1,442 @@
+"""Offline benchmark of the app's main routes.
+
+Runs the app in-process against a throwaway working directory with local
+SQLite databases, a stub coindesk server and a fake ``ffmpeg`` on ``PATH``, so
+results do not depend on the network or on Azure.  The databases are seeded
+(Movement and Recordings rows), then a seeded, shuffled mix of requests is
+driven from several threads: logins, movement uploads, paged movement and
+archive reads, checkout/update_payment bursts, QR generation and message
+uploads.  Per-route latency percentiles and throughput are written as JSON;
+``--compare`` checks a run against an earlier one.
+
+    python bench.py                       # full profile, bench_output.json
+    python bench.py --profile quick
+    python bench.py --compare baseline.json --max-regression 0.25
+
+``--url`` drives an already running server instead (no seeding; pass the
+login password with ``--password``).
+"""
+
+import argparse
+import collections
+import datetime
+import hashlib
+import http.server
+import io
+import json
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_PASSWORD = 'bench'
+STUB_RATE = '61,234.5678'
+
+PROFILES = {
+    'full': {'requests': 600, 'movement_samples': 10000, 'movement_rows': 100000, 'archive_rows': 100000},
+    'quick': {'requests': 120, 'movement_samples': 1000, 'movement_rows': 10000, 'archive_rows': 10000},
+}
+
+# Relative frequency of each operation in the mix
+MIX = {
+    'login': 1,
+    'record_movement': 2,
+    'get_movement': 4,
+    'get_archive': 6,
+    'checkout_burst': 3,
+    'qr': 4,
+    'record_message': 1,
+}
+
+FAKE_FFMPEG = '''#!{python}
+import sys, wave
+out = [a for a in sys.argv if a.endswith('.wav')][-1]
+with wave.open(out, 'wb') as w:
+    w.setnchannels(1)
+    w.setsampwidth(2)
+    w.setframerate(16000)
+    w.writeframes(b'\\0\\0' * 16000 * 5)
+'''
+
+
+# --- Environment ---
+class _RateHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps({'bpi': {'EUR': {'rate': STUB_RATE}}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_rate_stub():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _RateHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def prepare_workdir(workdir, rate_url):
+    """Point the app at ``workdir``, the stub rate server and a fake ffmpeg."""
+    bin_dir = os.path.join(workdir, 'bin')
+    os.makedirs(bin_dir)
+    ffmpeg_path = os.path.join(bin_dir, 'ffmpeg')
+    with open(ffmpeg_path, 'w') as fh:
+        fh.write(FAKE_FFMPEG.format(python=sys.executable))
+    os.chmod(ffmpeg_path, 0o755)
+    for script in ('script_no_args.py', 'script_with_args.py'):
+        shutil.copy(os.path.join(REPO_DIR, script), workdir)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+    os.environ['BTC_RATE_URL'] = rate_url
+    os.environ['TRANSCRIBE_ON_UPLOAD'] = '0'
+    os.environ.pop('WEBSITE_SITE_NAME', None)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+
+
+def seed(db, movement_rows, archive_rows, batch=10000):
+    """Fill Movement and Recordings so reads page through realistic tables."""
+    start = int(time.time() * 1000) - movement_rows * 100
+    with db.connection('Recordings') as conn:
+        cursor = conn.cursor()
+        for offset in range(0, movement_rows, batch):
+            rows = [
+                (start + i * 100, 52.0 + i * 1e-6, 4.9 + i * 1e-6, 0.1, 0.2, 9.8, 'seed')
+                for i in range(offset, min(offset + batch, movement_rows))
+            ]
+            cursor.executemany(
+                'INSERT INTO Movement (timestamp, lat, lon, gx, gy, gz, session_id) VALUES (?, ?, ?, ?, ?, ?, ?)', rows
+            )
+        day = datetime.datetime(2024, 1, 1)
+        for offset in range(0, archive_rows, batch):
+            rows = [
+                ((day + datetime.timedelta(minutes=i)).isoformat(), f'recording_seed_{i}.webm', 12.5, 'seeded row')
+                for i in range(offset, min(offset + batch, archive_rows))
+            ]
+            cursor.executemany(
+                'INSERT INTO Recordings (date, filename, length, transcription) VALUES (?, ?, ?, ?)', rows
+            )
+        conn.commit()
+
+
+# --- Clients ---
+class LocalClient:
+    """Calls the Flask app in-process through its test client."""
+
+    def __init__(self, flask_app):
+        self.client = flask_app.test_client()
+
+    def request(self, method, path, form=None, json=None, files=None):
+        data = dict(form or {})
+        for name, (filename, payload) in (files or {}).items():
+            data[name] = (io.BytesIO(payload), filename)
+        response = self.client.open(path, method=method, data=data or None, json=json)
+        body = response.get_data()
+        response.close()
+        return response.status_code, body
+
+
+class HttpClient:
+    """Calls a running server over HTTP."""
+
+    def __init__(self, base_url):
+        import requests
+        self.session = requests.Session()
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, form=None, json=None, files=None):
+        response = self.session.request(
+            method, self.base_url + path, data=form, json=json, files=files, allow_redirects=False
+        )
+        return response.status_code, response.content
+
+
+class Recorder:
+    """Collects per-route latencies and unexpected statuses."""
+
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self._lock = threading.Lock()
+
+    def call(self, client, label, method, path, expect=(200,), **kwargs):
+        started = time.perf_counter()
+        status, body = client.request(method, path, **kwargs)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.samples[label].append(elapsed)
+            if status not in expect:
+                self.errors[label] += 1
+        return status, body
+
+
+# --- Operations ---
+def op_login(client, rng, rec, ctx):
+    rec.call(client, 'POST /login', 'POST', '/login', expect=(302,), form={'password': ctx['password']})
+
+
+def op_record_movement(client, rng, rec, ctx):
+    base = int(time.time() * 1000)
+    data = [
+        {'timestamp': base + i * 20, 'lat': 52.0 + rng.random() * 1e-3, 'lon': 4.9 + rng.random() * 1e-3,
+         'gx': rng.random(), 'gy': rng.random(), 'gz': 9.8}
+        for i in range(ctx['movement_samples'])
+    ]
+    rec.call(client, 'POST /record_movement', 'POST', '/record_movement', json={'data': data})
+
+
+def _page_path(path, rng, rows):
+    if rows and rng.random() < 0.5:
+        return f'{path}?before_id={rng.randint(1, rows)}'
+    return path
+
+
+def op_get_movement(client, rng, rec, ctx):
+    rec.call(client, 'GET /get_movement', 'GET', _page_path('/get_movement', rng, ctx['movement_rows']))
+
+
+def op_get_archive(client, rng, rec, ctx):
+    rec.call(client, 'GET /get_archive', 'GET', _page_path('/get_archive', rng, ctx['archive_rows']))
+
+
+def op_checkout_burst(client, rng, rec, ctx):
+    order = {
+        'apples': rng.randint(0, 10),
+        'bananas': rng.randint(1, 10),
+        'name': 'Bench User',
+        'address': 'Benchstraat 1',
+        'email': 'bench@example.com',
+    }
+    status, body = rec.call(client, 'POST /checkout', 'POST', '/checkout', form={k: str(v) for k, v in order.items()})
+    match = re.search(rb'id="order-id" value="([0-9a-f]{32})"', body)
+    if not match:
+        return
+    order_id = match.group(1).decode()
+    for _ in range(3):
+        rec.call(client, 'POST /update_payment', 'POST', '/update_payment', json={'order_id': order_id})
+    rec.call(client, 'GET /orders/<id>', 'GET', f'/orders/{order_id}')
+
+
+def op_qr(client, rng, rec, ctx):
+    # Half the payloads repeat, so both cache hits and misses are measured
+    text = f'bench-{rng.randint(0, 9)}' if rng.random() < 0.5 else f'bench-{rng.random()}'
+    status, body = rec.call(client, 'POST /qr', 'POST', '/qr', form={'qr_type': 'text', 'text': text})
+    match = re.search(rb'/qrcodes/([0-9a-f]{64})\.png', body)
+    if match:
+        rec.call(client, 'GET /qrcodes/<key>.png', 'GET', f'/qrcodes/{match.group(1).decode()}.png')
+
+
+def op_record_message(client, rng, rec, ctx):
+    payload = os.urandom(32 * 1024)
+    rec.call(client, 'POST /record_message', 'POST', '/record_message', expect=(202, 503),
+             files={'audio': ('bench.webm', payload)})
+
+
+OPERATIONS = {
+    'login': op_login,
+    'record_movement': op_record_movement,
+    'get_movement': op_get_movement,
+    'get_archive': op_get_archive,
+    'checkout_burst': op_checkout_burst,
+    'qr': op_qr,
+    'record_message': op_record_message,
+}
+
+
+def build_plan(total, seed_value):
+    """Return a reproducible, shuffled list of operation names."""
+    weight_sum = sum(MIX.values())
+    plan = []
+    for name, weight in MIX.items():
+        plan.extend([name] * max(1, round(total * weight / weight_sum)))
+    random.Random(seed_value).shuffle(plan)
+    return plan
+
+
+def run_plan(make_client, plan, concurrency, ctx, seed_value):
+    rec = Recorder()
+    clients = []
+    for _ in range(concurrency):
+        client = make_client()
+        op_login(client, random.Random(seed_value), Recorder(), ctx)
+        clients.append(client)
+    # One untimed pass so imports and caches warm up outside the measurement
+    for name in MIX:
+        OPERATIONS[name](clients[0], random.Random(seed_value), Recorder(), ctx)
+
+    def worker(index):
+        rng = random.Random(seed_value + index)
+        for name in plan[index::concurrency]:
+            OPERATIONS[name](clients[index], rng, rec, ctx)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return rec, time.perf_counter() - started
+
+
+# --- Reporting ---
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(rec, wall_seconds):
+    routes = {}
+    for label, values in sorted(rec.samples.items()):
+        values = sorted(values)
+        routes[label] = {
+            'count': len(values),
+            'errors': rec.errors[label],
+            'throughput': round(len(values) / wall_seconds, 2),
+            'mean_ms': round(sum(values) / len(values) * 1000, 3),
+            'p50_ms': round(percentile(values, 50) * 1000, 3),
+            'p95_ms': round(percentile(values, 95) * 1000, 3),
+            'p99_ms': round(percentile(values, 99) * 1000, 3),
+            'max_ms': round(values[-1] * 1000, 3),
+        }
+    total = sum(r['count'] for r in routes.values())
+    return {
+        'totals': {
+            'requests': total,
+            'errors': sum(r['errors'] for r in routes.values()),
+            'wall_seconds': round(wall_seconds, 3),
+            'throughput': round(total / wall_seconds, 2),
+        },
+        'routes': routes,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline, max_regression):
+    """Print p50/p95 changes per route; return the routes whose p95 regressed."""
+    regressions = []
+    print(f"{'route':32} {'p50 ms':>18} {'p95 ms':>18}")
+    for label, now in current['routes'].items():
+        before = baseline.get('routes', {}).get(label)
+        if before is None:
+            print(f'{label:32} {"(new)":>18}')
+            continue
+        change = (now['p95_ms'] - before['p95_ms']) / before['p95_ms'] if before['p95_ms'] else 0.0
+        print(f"{label:32} {before['p50_ms']:>8} -> {now['p50_ms']:<7} "
+              f"{before['p95_ms']:>8} -> {now['p95_ms']:<7} {change:+.0%}")
+        if change > max_regression and now['count'] >= 20:
+            regressions.append(label)
+    return regressions
+
+
+def print_report(report):
+    print(f"{'route':32} {'count':>6} {'err':>4} {'req/s':>8} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for label, r in report['routes'].items():
+        print(f"{label:32} {r['count']:>6} {r['errors']:>4} {r['throughput']:>8} "
+              f"{r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9}")
+    t = report['totals']
+    print(f"{t['requests']} requests, {t['errors']} errors in {t['wall_seconds']}s ({t['throughput']} req/s)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmark of the app routes.')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='full')
+    parser.add_argument('--requests', type=int, help='Operations in the mix (overrides the profile).')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--compare', help='Earlier JSON report to compare against.')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='Fail when a route p95 grows by more than this fraction.')
+    parser.add_argument('--url', help='Benchmark a running server instead of the in-process app.')
+    parser.add_argument('--password', default=BENCH_PASSWORD, help='Login password with --url.')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary working directory.')
+    args = parser.parse_args(argv)
+
+    settings = dict(PROFILES[args.profile])
+    if args.requests:
+        settings['requests'] = args.requests
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+    ctx = {'password': args.password, **settings}
+    plan = build_plan(settings['requests'], args.seed)
+    workdir = None
+
+    if args.url:
+        ctx['movement_rows'] = ctx['archive_rows'] = 0
+        rec, wall = run_plan(lambda: HttpClient(args.url), plan, args.concurrency, ctx, args.seed)
+    else:
+        stub = start_rate_stub()
+        workdir = tempfile.mkdtemp(prefix='bench-')
+        prepare_workdir(workdir, f'http://127.0.0.1:{stub.server_port}/rate.json')
+        import app as app_module
+        import db
+        from flask.logging import default_handler
+        # Records still go to the Logs table; only the console copy is dropped
+        app_module.app.logger.removeHandler(default_handler)
+        app_module.HASHED_PASSWORD = hashlib.sha3_512(BENCH_PASSWORD.encode()).hexdigest()
+        ctx['password'] = BENCH_PASSWORD
+        app_module.btc_rate.provider.refresh()
+        db.init_schema()
+        seed(db, settings['movement_rows'], settings['archive_rows'])
+        try:
+            rec, wall = run_plan(lambda: LocalClient(app_module.app), plan, args.concurrency, ctx, args.seed)
+        finally:
+            app_module.jobs.queue.shutdown()
+            app_module.script_pool.pool.shutdown()
+            stub.shutdown()
+
+    report = {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'profile': args.profile,
+            'target': args.url or 'in-process',
+            'concurrency': args.concurrency,
+            'seed': args.seed,
+            **settings,
+        },
+        **summarize(rec, wall),
+    }
+    print_report(report)
+    with open(output, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    print(f'Wrote {output}')
+    if workdir and not args.keep:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if baseline_path:
+        with open(baseline_path) as fh:
+            baseline = json.load(fh)
+        regressions = compare(report, baseline, args.max_regression)
+        if regressions:
+            print(f"p95 regressed by more than {args.max_regression:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
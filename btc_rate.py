@@ -0,0 +1,143 @@
+"""Cached BTC/EUR exchange rate with background refresh.
+
+Request handlers call :meth:`RateProvider.get`, which never performs network
+I/O: it returns the cached rate (with its age) and, when the value is older
+than the TTL, wakes the background refresher.  Only one upstream fetch runs at
+a time; concurrent :meth:`RateProvider.refresh` callers share its result.
+When the upstream fails the last known good rate keeps being served, and only
+a worker that has never fetched successfully falls back to ``FALLBACK_RATE``.
+"""
+
+import collections
+import os
+import threading
+import time
+
+import metrics
+
+BTC_RATE_URL = os.environ.get('BTC_RATE_URL', 'https://api.coindesk.com/v1/bpi/currentprice/EUR.json')
+BTC_RATE_TTL = float(os.environ.get('BTC_RATE_TTL', '60'))
+BTC_RATE_REFRESH_INTERVAL = float(os.environ.get('BTC_RATE_REFRESH_INTERVAL', '30'))
+BTC_RATE_TIMEOUT = float(os.environ.get('BTC_RATE_TIMEOUT', '5'))
+FALLBACK_RATE = 30000.0
+
+Rate = collections.namedtuple('Rate', 'value age source')
+Rate.__doc__ = """A rate in EUR per BTC, its age in seconds and where it came from.
+
+``source`` is ``'live'`` (fresher than the TTL), ``'stale'`` (older than the
+TTL, e.g. while the upstream is failing) or ``'fallback'``.
+"""
+
+
+class RateProvider:
+    """TTL cache around the coindesk rate with single-flight refreshes."""
+
+    def __init__(self, url=BTC_RATE_URL, ttl=BTC_RATE_TTL, refresh_interval=BTC_RATE_REFRESH_INTERVAL,
+                 timeout=BTC_RATE_TIMEOUT, fallback=FALLBACK_RATE):
+        self.url = url
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        self.fallback = fallback
+        self.fetches = 0
+        self.errors = 0
+        self._value = None
+        self._fetched_at = None
+        self._last_error = None
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._inflight = None
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def fetch(self):
+        """Perform one upstream request and return the parsed rate."""
+        import requests
+        resp = requests.get(self.url, timeout=self.timeout)
+        resp.raise_for_status()
+        data = resp.json()
+        return float(str(data['bpi']['EUR']['rate']).replace(',', ''))
+
+    def refresh(self):
+        """Fetch a new rate, joining a fetch already in flight. Returns ``get()``."""
+        with self._lock:
+            inflight = self._inflight
+            leader = inflight is None
+            if leader:
+                inflight = self._inflight = threading.Event()
+        if not leader:
+            inflight.wait(self.timeout + 1)
+            return self.get(wake=False)
+        try:
+            self.fetches += 1
+            with metrics.timer('btc_rate_fetch_seconds'):
+                value = self.fetch()
+            self._value, self._fetched_at = value, time.monotonic()
+            self._last_error = None
+        except Exception as exc:
+            self.errors += 1
+            metrics.inc('btc_rate_fetch_errors_total')
+            self._last_error = exc
+        finally:
+            with self._lock:
+                self._inflight = None
+            inflight.set()
+        return self.get(wake=False)
+
+    def get(self, wake=True):
+        """Return the cached :class:`Rate` without any network I/O."""
+        if wake:
+            self._ensure_refresher()
+        value, fetched_at = self._value, self._fetched_at
+        if value is None:
+            if wake:
+                self._wake.set()
+            return Rate(self.fallback, None, 'fallback')
+        age = time.monotonic() - fetched_at
+        if age >= self.ttl:
+            if wake:
+                self._wake.set()
+            return Rate(value, age, 'stale')
+        return Rate(value, age, 'live')
+
+    def _ensure_refresher(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run, name='btc-rate-refresher', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            self.refresh()
+            if self._last_error is not None:
+                # Upstream is failing: back off instead of retrying on every stale read
+                time.sleep(self.refresh_interval)
+            else:
+                self._wake.wait(self.refresh_interval)
+            self._wake.clear()
+
+    def start(self):
+        """Start the background refresher (and first fetch) in this process."""
+        self._ensure_refresher()
+
+    def status(self):
+        rate = self.get(wake=False)
+        return {
+            'rate': rate.value,
+            'age': rate.age,
+            'source': rate.source,
+            'fetches': self.fetches,
+            'errors': self.errors,
+            'last_error': repr(self._last_error) if self._last_error else None,
+        }
+
+
+provider = RateProvider()
@@ -0,0 +1,158 @@
+"""Per-dependency concurrency limits and gevent support.
+
+With ``gthread`` or ``gevent`` workers (see ``gunicorn.conf.py``) one process
+has many requests in flight.  Every dependency a request can wait on gets a
+named ``Limit``: a bounded semaphore that callers wait on for at most its
+timeout before ``DependencyBusy`` (a 503 with ``Retry-After``) is raised.  The
+database limit is the connection pool itself.
+
+Under gevent, sockets, subprocesses and sleeps yield to other greenlets, but C
+extensions that block inside the driver (pyodbc, sqlite3) and ``flock`` would
+stall the whole worker.  ``offload`` runs such calls on gevent's native thread
+pool, and ``Cooperative`` wraps database connections so that every blocking
+DB-API call is offloaded.  Without gevent both are pass-throughs.
+"""
+
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+CONCURRENCY_FFMPEG = int(os.environ.get('CONCURRENCY_FFMPEG', '2'))
+CONCURRENCY_WAIT = float(os.environ.get('CONCURRENCY_WAIT', '30'))
+
+metrics.describe('dependency_wait_seconds', 'histogram', 'Time spent waiting for a dependency slot.')
+metrics.describe('dependency_busy_total', 'counter', 'Calls refused because a dependency stayed at its limit.')
+
+
+class DependencyBusy(TimeoutError):
+    """Raised when no slot for a dependency frees up within its timeout."""
+
+    def __init__(self, dependency, timeout):
+        super().__init__(f'{dependency} is busy: no slot free after {timeout:g}s')
+        self.dependency = dependency
+
+
+def cooperative():
+    """True in a worker whose sockets were monkey-patched by gevent."""
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('socket')
+
+
+def offload(fn, *args, **kwargs):
+    """Call ``fn`` on a native thread under gevent, directly otherwise."""
+    if not cooperative():
+        return fn(*args, **kwargs)
+    import gevent
+    return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+
+
+# --- Limits ---
+class Limit:
+    """A named bounded semaphore with a wait timeout and in-flight counts."""
+
+    def __init__(self, name, size, timeout=CONCURRENCY_WAIT):
+        self.name = name
+        self.size = size
+        self.timeout = timeout
+        self.in_flight = 0
+        self._slots = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _semaphore(self):
+        # Made on first use in each process, after gevent has patched threading
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._slots = threading.BoundedSemaphore(self.size)
+                    self.in_flight = 0
+                    self._pid = os.getpid()
+        return self._slots
+
+    def acquire(self):
+        slots = self._semaphore()
+        started = time.perf_counter()
+        if not slots.acquire(timeout=self.timeout):
+            metrics.inc('dependency_busy_total', dependency=self.name)
+            raise DependencyBusy(self.name, self.timeout)
+        metrics.observe('dependency_wait_seconds', time.perf_counter() - started, dependency=self.name)
+        with self._lock:
+            self.in_flight += 1
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+limits = {}
+
+
+def register(name, size, timeout=CONCURRENCY_WAIT):
+    """Create (or return) the process-wide limit for a dependency."""
+    limit = limits.get(name)
+    if limit is None:
+        limit = limits[name] = Limit(name, size, timeout)
+    return limit
+
+
+def limit(name):
+    """Context manager holding one slot of a registered dependency."""
+    return limits[name].slot()
+
+
+def in_flight():
+    """``{labels: count}`` of slots in use, for the metrics gauge."""
+    return {(('dependency', name),): entry.in_flight for name, entry in limits.items()}
+
+
+register('ffmpeg', CONCURRENCY_FFMPEG)
+
+
+# --- Cooperative database calls ---
+# DB-API methods that can block in the driver
+_BLOCKING = frozenset({
+    'execute', 'executemany', 'fetchone', 'fetchmany', 'fetchall', 'nextset', 'commit', 'rollback', 'close',
+})
+
+
+class Cooperative:
+    """Proxy for a connection or cursor whose blocking calls are offloaded."""
+
+    def __init__(self, target):
+        object.__setattr__(self, '_target', target)
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name == 'cursor':
+            return lambda *args, **kwargs: Cooperative(value(*args, **kwargs))
+        if name not in _BLOCKING:
+            return value
+
+        def call(*args, **kwargs):
+            result = offload(value, *args, **kwargs)
+            if result is self._target:
+                return self
+            if name == 'execute' and result is not None:
+                # sqlite3 Connection.execute returns a new cursor
+                return Cooperative(result)
+            return result
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, value)
+
+    def __iter__(self):
+        return iter(self.fetchall())
@@ -0,0 +1,765 @@
+"""Shared database access layer for Azure SQL and local SQLite.
+
+Connections are pooled per logical database (``Recordings``, ``Log`` and
+``Purchases``).  On Azure a bounded pool of pyodbc connections is kept with
+periodic health checks; locally every thread reuses its own SQLite connection
+in WAL mode.  Under gevent, connections are handed out wrapped in
+``concurrency.Cooperative`` so driver calls run off the event loop.  Schema
+creation happens once through :func:`init_schema`.
+"""
+
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import concurrency
+import metrics
+
+# --- Configuration ---
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '30'))
+# Idle pyodbc connections older than this are checked with SELECT 1 before reuse
+HEALTHCHECK_INTERVAL = float(os.environ.get('DB_HEALTHCHECK_INTERVAL', '30'))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+_pyodbc = None
+
+
+def odbc():
+    """Import pyodbc on first use; only Azure deployments need it."""
+    global _pyodbc
+    if _pyodbc is None:
+        import pyodbc
+        pyodbc.pooling = True
+        _pyodbc = pyodbc
+    return _pyodbc
+
+
+def is_azure():
+    """Return True when running inside Azure App Service."""
+    return bool(os.environ.get('WEBSITE_SITE_NAME'))
+
+
+def azure_connection_string(db_name):
+    """Build the ODBC connection string for a logical database on Azure SQL."""
+    if db_name == 'Recordings':
+        conn_str = os.environ.get('AZURE_SQL_CONNECTIONSTRING')
+        if conn_str:
+            return conn_str
+        database = os.environ.get('AZURE_SQL_DATABASE')
+    else:
+        database = db_name
+    server = os.environ.get('AZURE_SQL_SERVER')
+    username = os.environ.get('AZURE_SQL_USER')
+    password = os.environ.get('AZURE_SQL_PASSWORD')
+    port = os.environ.get('AZURE_SQL_PORT', '1433')
+    return (
+        f'DRIVER={{ODBC Driver 17 for SQL Server}};'
+        f'SERVER={server},{port};'
+        f'DATABASE={database};'
+        f'UID={username};PWD={password}'
+    )
+
+
+def sqlite_path(db_name):
+    """Return the SQLite file used for a logical database."""
+    return f"{db_name.lower()}.db"
+
+
+class PyodbcPool:
+    """Bounded, thread-safe pool of pyodbc connections to one database."""
+
+    def __init__(self, conn_str, size=POOL_SIZE, timeout=POOL_TIMEOUT,
+                 healthcheck_interval=HEALTHCHECK_INTERVAL, name='database'):
+        self.conn_str = conn_str
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._idle = queue.LifoQueue()
+        # The pool size is the database's concurrency limit in this process
+        self._slots = concurrency.register(name, size, timeout)
+
+    def _healthy(self, conn):
+        try:
+            conn.cursor().execute('SELECT 1').fetchone()
+            return True
+        except odbc().Error:
+            return False
+
+    def acquire(self):
+        # Raises concurrency.DependencyBusy, a TimeoutError, when all are in use
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    conn, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return concurrency.offload(odbc().connect, self.conn_str)
+                idle_for = time.monotonic() - last_used
+                if idle_for < self.healthcheck_interval or concurrency.offload(self._healthy, conn):
+                    return conn
+                _close_quietly(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, failed=False):
+        try:
+            if failed and not concurrency.offload(_rolled_back, conn):
+                _close_quietly(conn)
+            else:
+                self._idle.put((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            _close_quietly(conn)
+
+
+class SQLitePool:
+    """Hands every thread its own long-lived SQLite connection.
+
+    Nested ``connection()`` blocks on one thread share that connection and
+    its transaction; it is only rolled back when the outermost block exits.
+    """
+
+    def __init__(self, path, busy_timeout_ms=SQLITE_BUSY_TIMEOUT_MS):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._all = []
+        self._lock = threading.Lock()
+        # Under gevent threading.local is per greenlet, i.e. per request:
+        # connections are lent from an idle stack instead
+        self._idle = queue.LifoQueue() if concurrency.cooperative() else None
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path, timeout=self.busy_timeout_ms / 1000.0, check_same_thread=self._idle is None,
+        )
+        # Takes effect only on a new, empty file; older files need maintenance.full_vacuum
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA busy_timeout={self.busy_timeout_ms}')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with self._lock:
+            self._all.append(conn)
+        return conn
+
+    def acquire(self):
+        if self._idle is not None:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                return concurrency.offload(self._connect)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            self._local.depth = 0
+        self._local.depth += 1
+        return conn
+
+    def release(self, conn, failed=False):
+        if self._idle is None:
+            self._local.depth -= 1
+            if self._local.depth:
+                # An outer block on this thread is still using the connection
+                return
+        # Never leave a half-finished transaction on a reused connection
+        if (failed or conn.in_transaction) and not _rolled_back(conn):
+            if self._idle is None:
+                self._local.conn = None
+            _close_quietly(conn)
+            return
+        if self._idle is not None:
+            self._idle.put(conn)
+
+    def close(self):
+        with self._lock:
+            conns, self._all = self._all, []
+        for conn in conns:
+            _close_quietly(conn)
+        self._local = threading.local()
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def _rolled_back(conn):
+    """Roll back ``conn``; False when it is broken and must be discarded."""
+    try:
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+
+def get_pool(db_name):
+    """Return the process-wide pool for a logical database."""
+    global _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            # Forked worker: never share the parent's sockets or file handles
+            _pools.clear()
+            _pools_pid = os.getpid()
+        pool = _pools.get(db_name)
+        if pool is None:
+            if is_azure():
+                pool = PyodbcPool(azure_connection_string(db_name), name=f'database_{db_name}')
+            else:
+                pool = SQLitePool(sqlite_path(db_name))
+            _pools[db_name] = pool
+        return pool
+
+
+def close_pools():
+    """Close every pooled connection in this process."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def connection(db_name, site=None):
+    """Borrow a pooled connection; uncommitted work is rolled back on error.
+
+    Time spent is recorded per call site, which defaults to the name of the
+    calling function.
+    """
+    if site is None:
+        site = sys._getframe(1).f_code.co_name
+    return _connection(db_name, site)
+
+
+@contextmanager
+def _connection(db_name, site):
+    pool = get_pool(db_name)
+    with metrics.timer('db_connect_seconds', db=db_name):
+        conn = pool.acquire()
+    failed = False
+    started = time.perf_counter()
+    try:
+        yield concurrency.Cooperative(conn) if concurrency.cooperative() else conn
+    except Exception:
+        metrics.inc('db_errors_total', db=db_name, site=site)
+        failed = True
+        raise
+    finally:
+        metrics.observe('db_query_seconds', time.perf_counter() - started, db=db_name, site=site)
+        # The pool rolls back uncommitted work after an error
+        pool.release(conn, failed)
+
+
+def insert_returning_id(cursor, sql, params):
+    """Run an ``INSERT ... VALUES`` and return the new row's identity."""
+    if is_azure():
+        cursor.execute(sql.replace(' VALUES ', ' OUTPUT INSERTED.id VALUES ', 1), params)
+        return cursor.fetchone()[0]
+    cursor.execute(sql, params)
+    return cursor.lastrowid
+
+
+# --- Schema ---
+class AddColumn:
+    """SQLite schema step adding a column unless the table already has it."""
+
+    def __init__(self, table, column, declaration):
+        self.table = table
+        self.column = column
+        self.declaration = declaration
+
+    def apply(self, cursor):
+        cursor.execute(f'PRAGMA table_info({self.table})')
+        if self.column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f'ALTER TABLE {self.table} ADD COLUMN {self.column} {self.declaration}')
+
+
+class Fts5Index:
+    """SQLite step adding an external-content FTS5 index over one text column.
+
+    Triggers keep the index in step with inserts and deletes.  On SQLite
+    builds without FTS5 the step does nothing and searches fall back to LIKE.
+    """
+
+    def __init__(self, table, column, name):
+        self.table = table
+        self.column = column
+        self.name = name
+
+    def apply(self, cursor):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (self.name,))
+        if cursor.fetchone():
+            return
+        try:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE {self.name} USING fts5({self.column}, "
+                f"content='{self.table}', content_rowid='id')"
+            )
+        except sqlite3.OperationalError:
+            return
+        cursor.execute(
+            f'CREATE TRIGGER IF NOT EXISTS {self.name}_ai AFTER INSERT ON {self.table} BEGIN '
+            f'INSERT INTO {self.name} (rowid, {self.column}) VALUES (new.id, new.{self.column}); END'
+        )
+        cursor.execute(
+            f'CREATE TRIGGER IF NOT EXISTS {self.name}_ad AFTER DELETE ON {self.table} BEGIN '
+            f"INSERT INTO {self.name} ({self.name}, rowid, {self.column}) VALUES ('delete', old.id, old.{self.column}); END"
+        )
+        # Index the rows written before the index existed
+        cursor.execute(f"INSERT INTO {self.name} ({self.name}) VALUES ('rebuild')")
+
+
+class FullTextIndex:
+    """Azure SQL step adding a full-text index over one column.
+
+    Full-text DDL cannot run inside a transaction, so it is issued in
+    autocommit mode.  Where full-text search is unavailable the step is
+    skipped and searches fall back to LIKE.
+    """
+
+    def __init__(self, table, column, catalog):
+        self.table = table
+        self.column = column
+        self.catalog = catalog
+
+    def apply(self, cursor):
+        cursor.execute('SELECT 1 FROM sys.fulltext_indexes WHERE object_id = OBJECT_ID(?)', (self.table,))
+        if cursor.fetchone():
+            return
+        cursor.execute(
+            'SELECT name FROM sys.indexes WHERE object_id = OBJECT_ID(?) AND is_primary_key = 1', (self.table,)
+        )
+        key_index = cursor.fetchone()[0]
+        conn = cursor.connection
+        conn.commit()
+        conn.autocommit = True
+        try:
+            cursor.execute(
+                f"IF NOT EXISTS (SELECT * FROM sys.fulltext_catalogs WHERE name='{self.catalog}') "
+                f'CREATE FULLTEXT CATALOG {self.catalog}'
+            )
+            cursor.execute(
+                f'CREATE FULLTEXT INDEX ON {self.table} ({self.column}) KEY INDEX {key_index} '
+                f'ON {self.catalog} WITH CHANGE_TRACKING AUTO'
+            )
+        except odbc().Error:
+            pass
+        finally:
+            conn.autocommit = False
+
+
+class RTreeIndex:
+    """SQLite step adding an R*Tree over a table's lat/lon points.
+
+    Each row with both coordinates becomes a zero-area box keyed by the row
+    id.  Triggers keep the index in step with inserts and deletes.  On
+    SQLite builds without the R*Tree module the step does nothing and spatial
+    queries scan the table.
+    """
+
+    def __init__(self, table, name, lat='lat', lon='lon'):
+        self.table = table
+        self.name = name
+        self.lat = lat
+        self.lon = lon
+
+    def apply(self, cursor):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (self.name,))
+        if cursor.fetchone():
+            return
+        try:
+            cursor.execute(f'CREATE VIRTUAL TABLE {self.name} USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+        except sqlite3.OperationalError:
+            return
+        cursor.execute(
+            f'CREATE TRIGGER IF NOT EXISTS {self.name}_ai AFTER INSERT ON {self.table} '
+            f"WHEN {self._present('new.')} BEGIN "
+            f"INSERT INTO {self.name} VALUES ({self._values('new.')}); END"
+        )
+        cursor.execute(
+            f'CREATE TRIGGER IF NOT EXISTS {self.name}_ad AFTER DELETE ON {self.table} BEGIN '
+            f'DELETE FROM {self.name} WHERE id = old.id; END'
+        )
+        # Index the rows written before the index existed
+        cursor.execute(
+            f"INSERT INTO {self.name} SELECT {self._values('')} FROM {self.table} WHERE {self._present('')}"
+        )
+
+    def _values(self, prefix):
+        lat, lon = prefix + self.lat, prefix + self.lon
+        return ', '.join([prefix + 'id', lat, lat, lon, lon])
+
+    def _present(self, prefix):
+        return f'{prefix}{self.lat} IS NOT NULL AND {prefix}{self.lon} IS NOT NULL'
+
+
+class SpatialIndex:
+    """Azure SQL step adding a persisted point column and a spatial index on it.
+
+    Points are ``geometry`` with x = longitude and y = latitude, so a bounding
+    box in degrees is a plain rectangle.  The DDL runs in autocommit mode;
+    where it fails the step is skipped and spatial queries use lat/lon
+    filters only.
+    """
+
+    def __init__(self, table, column, name, lat='lat', lon='lon'):
+        self.table = table
+        self.column = column
+        self.name = name
+        self.lat = lat
+        self.lon = lon
+
+    def apply(self, cursor):
+        cursor.execute('SELECT 1 FROM sys.spatial_indexes WHERE name = ?', (self.name,))
+        if cursor.fetchone():
+            return
+        conn = cursor.connection
+        conn.commit()
+        conn.autocommit = True
+        try:
+            cursor.execute(
+                f"IF COL_LENGTH('{self.table}', '{self.column}') IS NULL "
+                f'ALTER TABLE {self.table} ADD {self.column} AS '
+                f'(CASE WHEN {self.lat} IS NOT NULL AND {self.lon} IS NOT NULL '
+                f'THEN geometry::Point({self.lon}, {self.lat}, 0) END) PERSISTED'
+            )
+            cursor.execute(
+                f'CREATE SPATIAL INDEX {self.name} ON {self.table} ({self.column}) '
+                f'USING GEOMETRY_AUTO_GRID WITH (BOUNDING_BOX = (-180, -90, 180, 90))'
+            )
+        except odbc().Error:
+            pass
+        finally:
+            conn.autocommit = False
+
+
+# Each entry is a (SQLite, Azure SQL) pair of idempotent statements, applied in
+# order.  A step on either side may also be an object with an ``apply(cursor)``
+# method.
+SCHEMA = {
+    'Recordings': [
+        (
+            'CREATE TABLE IF NOT EXISTS Movement ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            'timestamp INTEGER,'
+            'lat REAL,'
+            'lon REAL,'
+            'gx REAL,'
+            'gy REAL,'
+            'gz REAL)',
+            "IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='Movement' AND xtype='U') "
+            'CREATE TABLE Movement ('
+            'id INT IDENTITY(1,1) PRIMARY KEY,'
+            'timestamp BIGINT,'
+            'lat FLOAT,'
+            'lon FLOAT,'
+            'gx FLOAT,'
+            'gy FLOAT,'
+            'gz FLOAT)',
+        ),
+        (
+            'CREATE TABLE IF NOT EXISTS Recordings ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            'date TEXT,'
+            'filename TEXT,'
+            'length REAL,'
+            'transcription TEXT)',
+            "IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='Recordings' AND xtype='U') "
+            'CREATE TABLE Recordings ('
+            'id INT IDENTITY(1,1) PRIMARY KEY,'
+            'date NVARCHAR(50),'
+            'filename NVARCHAR(255),'
+            'length FLOAT,'
+            'transcription NVARCHAR(MAX))',
+        ),
+        (
+            'CREATE INDEX IF NOT EXISTS ix_movement_timestamp ON Movement (timestamp)',
+            "IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='ix_movement_timestamp') "
+            'CREATE INDEX ix_movement_timestamp ON Movement (timestamp)',
+        ),
+        (
+            'CREATE INDEX IF NOT EXISTS ix_recordings_date ON Recordings (date)',
+            "IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='ix_recordings_date') "
+            'CREATE INDEX ix_recordings_date ON Recordings (date)',
+        ),
+        (
+            AddColumn('Movement', 'session_id', 'TEXT'),
+            "IF COL_LENGTH('Movement', 'session_id') IS NULL "
+            'ALTER TABLE Movement ADD session_id NVARCHAR(64)',
+        ),
+        (
+            'CREATE INDEX IF NOT EXISTS ix_movement_session ON Movement (session_id, id)',
+            "IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='ix_movement_session') "
+            'CREATE INDEX ix_movement_session ON Movement (session_id, id)',
+        ),
+        (
+            RTreeIndex('Movement', 'MovementRtree'),
+            SpatialIndex('Movement', 'geo', 'sx_movement_geo'),
+        ),
+        (
+            'CREATE TABLE IF NOT EXISTS MovementChunks ('
+            'session_id TEXT NOT NULL,'
+            'seq INTEGER NOT NULL,'
+            'row_count INTEGER,'
+            'received_at TEXT,'
+            'PRIMARY KEY (session_id, seq))',
+            "IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='MovementChunks' AND xtype='U') "
+            'CREATE TABLE MovementChunks ('
+            'session_id NVARCHAR(64) NOT NULL,'
+            'seq INT NOT NULL,'
+            'row_count INT,'
+            'received_at NVARCHAR(50),'
+            'PRIMARY KEY (session_id, seq))',
+        ),
+        (
+            'CREATE TABLE IF NOT EXISTS MovementBlocks ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            'session_id TEXT NOT NULL,'
+            'start_ts INTEGER,'
+            'end_ts INTEGER,'
+            'sample_count INTEGER,'
+            'min_lat REAL,'
+            'max_lat REAL,'
+            'min_lon REAL,'
+            'max_lon REAL,'
+            'payload BLOB)',
+            "IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='MovementBlocks' AND xtype='U') "
+            'CREATE TABLE MovementBlocks ('
+            'id INT IDENTITY(1,1) PRIMARY KEY,'
+            'session_id NVARCHAR(64) NOT NULL,'
+            'start_ts BIGINT,'
+            'end_ts BIGINT,'
+            'sample_count INT,'
+            'min_lat FLOAT,'
+            'max_lat FLOAT,'
+            'min_lon FLOAT,'
+            'max_lon FLOAT,'
+            'payload VARBINARY(MAX))',
+        ),
+        (
+            'CREATE INDEX IF NOT EXISTS ix_movementblocks_session ON MovementBlocks (session_id, start_ts)',
+            "IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='ix_movementblocks_session') "
+            'CREATE INDEX ix_movementblocks_session ON MovementBlocks (session_id, start_ts)',
+        ),
+        # Per-minute aggregates of Movement rows past their retention.  Sums
+        # rather than means, so partial rows for one minute can be added up.
+        (
+            'CREATE TABLE IF NOT EXISTS MovementMinutes ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            'minute INTEGER NOT NULL,'
+            'session_id TEXT NOT NULL,'
+            'samples INTEGER,'
+            'sum_lat REAL,'
+            'sum_lon REAL,'
+            'min_lat REAL,'
+            'max_lat REAL,'
+            'min_lon REAL,'
+            'max_lon REAL,'
+            'sum_gx REAL,'
+            'sum_gy REAL,'
+            'sum_gz REAL)',
+            "IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='MovementMinutes' AND xtype='U') "
+            'CREATE TABLE MovementMinutes ('
+            'id INT IDENTITY(1,1) PRIMARY KEY,'
+            'minute BIGINT NOT NULL,'
+            'session_id NVARCHAR(64) NOT NULL,'
+            'samples INT,'
+            'sum_lat FLOAT,'
+            'sum_lon FLOAT,'
+            'min_lat FLOAT,'
+            'max_lat FLOAT,'
+            'min_lon FLOAT,'
+            'max_lon FLOAT,'
+            'sum_gx FLOAT,'
+            'sum_gy FLOAT,'
+            'sum_gz FLOAT)',
+        ),
+        (
+            'CREATE INDEX IF NOT EXISTS ix_movementminutes_session ON MovementMinutes (session_id, minute)',
+            "IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='ix_movementminutes_session') "
+            'CREATE INDEX ix_movementminutes_session ON MovementMinutes (session_id, minute)',
+        ),
+        (
+            'CREATE INDEX IF NOT EXISTS ix_movementminutes_minute ON MovementMinutes (minute)',
+            "IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='ix_movementminutes_minute') "
+            'CREATE INDEX ix_movementminutes_minute ON MovementMinutes (minute)',
+        ),
+        (
+            'CREATE TABLE IF NOT EXISTS Jobs ('
+            'id TEXT PRIMARY KEY,'
+            'kind TEXT,'
+            'status TEXT,'
+            'recording_id INTEGER,'
+            'result TEXT,'
+            'error TEXT,'
+            'created_at TEXT,'
+            'updated_at TEXT)',
+            "IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='Jobs' AND xtype='U') "
+            'CREATE TABLE Jobs ('
+            'id NVARCHAR(32) PRIMARY KEY,'
+            'kind NVARCHAR(50),'
+            'status NVARCHAR(20),'
+            'recording_id INT,'
+            'result NVARCHAR(MAX),'
+            'error NVARCHAR(MAX),'
+            'created_at NVARCHAR(50),'
+            'updated_at NVARCHAR(50))',
+        ),
+        (
+            'CREATE TABLE IF NOT EXISTS Media ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            'kind TEXT NOT NULL,'
+            'path TEXT NOT NULL,'
+            'bytes INTEGER,'
+            'duration REAL,'
+            'codec TEXT,'
+            'created_at TEXT,'
+            'recording_id INTEGER)',
+            "IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='Media' AND xtype='U') "
+            'CREATE TABLE Media ('
+            'id INT IDENTITY(1,1) PRIMARY KEY,'
+            'kind NVARCHAR(20) NOT NULL,'
+            'path NVARCHAR(400) NOT NULL,'
+            'bytes BIGINT,'
+            'duration FLOAT,'
+            'codec NVARCHAR(100),'
+            'created_at NVARCHAR(50),'
+            'recording_id INT)',
+        ),
+        (
+            'CREATE UNIQUE INDEX IF NOT EXISTS ix_media_path ON Media (path)',
+            "IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='ix_media_path') "
+            'CREATE UNIQUE INDEX ix_media_path ON Media (path)',
+        ),
+        (
+            'CREATE INDEX IF NOT EXISTS ix_media_kind ON Media (kind, id)',
+            "IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='ix_media_kind') "
+            'CREATE INDEX ix_media_kind ON Media (kind, id)',
+        ),
+        (
+            'CREATE INDEX IF NOT EXISTS ix_media_created ON Media (created_at)',
+            "IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='ix_media_created') "
+            'CREATE INDEX ix_media_created ON Media (created_at)',
+        ),
+    ],
+    'Log': [
+        (
+            'CREATE TABLE IF NOT EXISTS Logs ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            'timestamp TEXT,'
+            'level TEXT,'
+            'message TEXT)',
+            "IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='Logs' AND xtype='U') "
+            'CREATE TABLE Logs ('
+            'id INT IDENTITY(1,1) PRIMARY KEY,'
+            'timestamp NVARCHAR(50),'
+            'level NVARCHAR(20),'
+            'message NVARCHAR(MAX))',
+        ),
+        (
+            'CREATE INDEX IF NOT EXISTS ix_logs_timestamp_level ON Logs (timestamp, level)',
+            "IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='ix_logs_timestamp_level') "
+            'CREATE INDEX ix_logs_timestamp_level ON Logs (timestamp, level)',
+        ),
+        (
+            Fts5Index('Logs', 'message', 'LogsFts'),
+            FullTextIndex('Logs', 'message', 'ft_logs'),
+        ),
+    ],
+    'Purchases': [
+        (
+            'CREATE TABLE IF NOT EXISTS Purchases ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            'timestamp TEXT,'
+            'apples INTEGER,'
+            'bananas INTEGER,'
+            'name TEXT,'
+            'address TEXT,'
+            'email TEXT,'
+            'total_eur REAL,'
+            'total_btc REAL,'
+            'tx_hash TEXT)',
+            "IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='Purchases' AND xtype='U') "
+            'CREATE TABLE Purchases ('
+            'id INT IDENTITY(1,1) PRIMARY KEY,'
+            'timestamp NVARCHAR(50),'
+            'apples INT,'
+            'bananas INT,'
+            'name NVARCHAR(255),'
+            'address NVARCHAR(255),'
+            'email NVARCHAR(255),'
+            'total_eur FLOAT,'
+            'total_btc FLOAT,'
+            'tx_hash NVARCHAR(64))',
+        ),
+        (
+            AddColumn('Purchases', 'order_id', 'TEXT'),
+            "IF COL_LENGTH('Purchases', 'order_id') IS NULL "
+            'ALTER TABLE Purchases ADD order_id NVARCHAR(32)',
+        ),
+        (
+            AddColumn('Purchases', 'btc_rate', 'REAL'),
+            "IF COL_LENGTH('Purchases', 'btc_rate') IS NULL "
+            'ALTER TABLE Purchases ADD btc_rate FLOAT',
+        ),
+        (
+            AddColumn('Purchases', 'updated_at', 'TEXT'),
+            "IF COL_LENGTH('Purchases', 'updated_at') IS NULL "
+            'ALTER TABLE Purchases ADD updated_at NVARCHAR(50)',
+        ),
+        # Rows written before orders existed have no order_id
+        (
+            'CREATE UNIQUE INDEX IF NOT EXISTS ux_purchases_order_id ON Purchases (order_id) '
+            'WHERE order_id IS NOT NULL',
+            "IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='ux_purchases_order_id') "
+            'CREATE UNIQUE INDEX ux_purchases_order_id ON Purchases (order_id) WHERE order_id IS NOT NULL',
+        ),
+        (
+            'CREATE UNIQUE INDEX IF NOT EXISTS ux_purchases_tx_hash ON Purchases (tx_hash) '
+            'WHERE tx_hash IS NOT NULL',
+            "IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='ux_purchases_tx_hash') "
+            'CREATE UNIQUE INDEX ux_purchases_tx_hash ON Purchases (tx_hash) WHERE tx_hash IS NOT NULL',
+        ),
+    ],
+}
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def init_schema():
+    """Create all tables once per process. Safe to call repeatedly."""
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        azure = is_azure()
+        for db_name, statements in SCHEMA.items():
+            with connection(db_name) as conn:
+                cursor = conn.cursor()
+                for sqlite_step, azure_step in statements:
+                    step = azure_step if azure else sqlite_step
+                    if isinstance(step, str):
+                        cursor.execute(step)
+                    else:
+                        step.apply(cursor)
+                conn.commit()
+        _schema_ready = True
@@ -0,0 +1,152 @@
+"""Size-bounded cache of wavs derived from stored recordings.
+
+Uploads are kept as webm only.  A wav is made when something needs PCM
+(transcription or a wav download) and kept in ``DERIVED_DIR``; once the
+directory grows past ``DERIVED_CACHE_BYTES`` the least recently used wavs are
+evicted.  Each use refreshes a wav's mtime, and the webm stays the source, so
+an evicted wav is simply converted again.
+"""
+
+import fcntl
+import os
+import time
+import wave
+
+import concurrency
+import jobs
+import tasks
+
+DERIVED_DIR = os.path.join('recordings', 'derived')
+DERIVED_CACHE_BYTES = int(os.environ.get('DERIVED_CACHE_BYTES', str(1024 * 1024 * 1024)))
+# Partial conversions older than this were left behind by a crashed worker
+_PARTIAL_MAX_AGE = 3600
+
+
+def wav_path(webm_path):
+    """Where the wav derived from ``webm_path`` is cached."""
+    name = os.path.splitext(os.path.basename(webm_path))[0]
+    return os.path.join(DERIVED_DIR, name + '.wav')
+
+
+def cached_wav(webm_path):
+    """Return the cached wav for ``webm_path`` (marking it used), or None."""
+    path = wav_path(webm_path)
+    try:
+        os.utime(path)
+    except OSError:
+        return None
+    return path
+
+
+def wav_for(webm_path):
+    """Return the wav for ``webm_path``, converting in this process on a miss.
+
+    A lock file makes concurrent requests for the same wav wait for one
+    conversion instead of each running ffmpeg, and at most
+    ``CONCURRENCY_FFMPEG`` conversions run in a process at once.
+    """
+    path = cached_wav(webm_path)
+    if path is not None:
+        return path
+    path = wav_path(webm_path)
+    os.makedirs(DERIVED_DIR, exist_ok=True)
+    with concurrency.limit('ffmpeg'):
+        # flock and the conversion block; keep them off a gevent event loop
+        concurrency.offload(_convert_locked, webm_path, path)
+    trim()
+    return path
+
+
+def _wav_length(path):
+    try:
+        with wave.open(path, 'rb') as wf:
+            return round(wf.getnframes() / float(wf.getframerate()), 2)
+    except (OSError, EOFError, wave.Error):
+        return None
+
+
+def _convert_locked(webm_path, path):
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(path):
+                tasks.convert_recording(webm_path, path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            _remove_quietly(path + '.lock')
+
+
+def submit(webm_path, recording_id=None, on_done=None, on_error=None):
+    """Derive the wav on the job queue; ``on_done`` gets the conversion result.
+
+    Cache hits finish immediately without a job and return None; their length
+    is read from the cached wav (None if it was evicted meanwhile).
+    """
+    path = cached_wav(webm_path)
+    if path is not None:
+        if on_done is not None:
+            on_done({'wav': path, 'length': _wav_length(path), 'ffmpeg_seconds': 0.0})
+        return None
+    os.makedirs(DERIVED_DIR, exist_ok=True)
+
+    def converted(result):
+        trim()
+        if on_done is not None:
+            return on_done(result)
+
+    return jobs.queue.submit(
+        'convert', tasks.convert_recording, (webm_path, wav_path(webm_path)),
+        recording_id=recording_id, on_done=converted, on_error=on_error,
+    )
+
+
+def trim(max_bytes=None):
+    """Evict least recently used wavs until the cache fits its bound.
+
+    Returns ``(files_removed, bytes_freed)``.
+    """
+    max_bytes = DERIVED_CACHE_BYTES if max_bytes is None else max_bytes
+    now = time.time()
+    entries = []
+    removed = freed = 0
+    try:
+        scanned = list(os.scandir(DERIVED_DIR))
+    except FileNotFoundError:
+        return 0, 0
+    for entry in scanned:
+        try:
+            st = entry.stat()
+        except OSError:
+            continue
+        if tasks.PARTIAL_SUFFIX in entry.name:
+            if now - st.st_mtime > _PARTIAL_MAX_AGE and _remove_quietly(entry.path):
+                removed += 1
+                freed += st.st_size
+        elif entry.name.endswith('.wav'):
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    if total > max_bytes:
+        # Trim to 90% so the next conversions do not each trigger an eviction
+        target = max_bytes * 0.9
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            if _remove_quietly(path):
+                total -= size
+                removed += 1
+                freed += size
+    return removed, freed
+
+
+def adopt(path):
+    """Move a wav stored next to its webm (older uploads) into the cache."""
+    os.makedirs(DERIVED_DIR, exist_ok=True)
+    os.replace(path, os.path.join(DERIVED_DIR, os.path.basename(path)))
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        return False
+    return True
@@ -0,0 +1,41 @@
+"""gunicorn settings; ``gunicorn app:app`` reads this file from the working directory.
+
+``GUNICORN_WORKER_CLASS`` selects the concurrency mode:
+
+* ``gthread`` (default): ``GUNICORN_THREADS`` requests per worker on native
+  threads.  pyodbc, sqlite3 and ffmpeg release the GIL while they wait.
+* ``gevent``: ``GUNICORN_WORKER_CONNECTIONS`` requests per worker on
+  greenlets; requires ``pip install gevent``.  Database and ffmpeg calls are
+  moved to gevent's thread pool by ``concurrency.offload``.
+* ``sync``: one request per worker, the old behaviour.
+
+In every mode the database pool (``DB_POOL_SIZE``) and ``CONCURRENCY_FFMPEG``
+cap what a worker sends to those dependencies.
+"""
+
+import multiprocessing
+import os
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY', str(min(multiprocessing.cpu_count() * 2 + 1, 8))))
+threads = int(os.environ.get('GUNICORN_THREADS', '32'))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '500'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', '5'))
+
+# gevent must patch the worker before the app is imported, so the app is
+# loaded in each worker (it warms itself up there) rather than in the master
+preload_app = False
+
+
+def post_worker_init(worker):
+    mode = worker_class
+    if worker_class == 'gevent':
+        import concurrency
+        if not concurrency.cooperative():
+            worker.log.warning('gevent worker without patched sockets; I/O will block the worker')
+        mode = f'gevent, {worker_connections} connections'
+    elif worker_class == 'gthread':
+        mode = f'gthread, {threads} threads'
+    worker.log.info(f'Worker {worker.pid} serving ({mode})')
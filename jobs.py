@@ -0,0 +1,190 @@
+"""Bounded background job queue backed by a process pool.
+
+Jobs are recorded in the Jobs table so their status can be queried from any
+worker.  The pool uses the ``spawn`` start method: gunicorn workers are
+multi-threaded, and forking them would copy locks held by other threads.
+"""
+
+import atexit
+import concurrent.futures
+import datetime
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+
+import db
+import metrics
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', str(os.cpu_count() or 1)))
+# Maximum jobs queued or running per web worker before submissions are refused
+JOB_QUEUE_LIMIT = int(os.environ.get('JOB_QUEUE_LIMIT', '32'))
+
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted while the queue is at its limit."""
+
+
+def _raise(exc):
+    raise exc
+
+
+def _now():
+    return datetime.datetime.now().isoformat()
+
+
+class JobQueue:
+    """Runs task functions in worker processes and records their outcome."""
+
+    def __init__(self, workers=JOB_WORKERS, limit=JOB_QUEUE_LIMIT):
+        self.workers = workers
+        self.limit = limit
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.limit)
+        self._pending = 0
+
+    def _pool(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context('spawn'),
+                    )
+                    self._pid = os.getpid()
+        return self._executor
+
+    def depth(self):
+        """Number of jobs queued or running in this process."""
+        return self._pending
+
+    def _start(self, kind, recording_id):
+        if not self._slots.acquire(blocking=False):
+            raise JobQueueFull(f'{self.limit} jobs already pending')
+        job_id = uuid.uuid4().hex
+        try:
+            with db.connection('Recordings') as conn:
+                conn.cursor().execute(
+                    'INSERT INTO Jobs (id, kind, status, recording_id, created_at, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (job_id, kind, 'queued', recording_id, _now(), _now()),
+                )
+                conn.commit()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending += 1
+        return job_id
+
+    def submit(self, kind, fn, args=(), recording_id=None, on_done=None, on_error=None):
+        """Queue ``fn(*args)`` and return the new job id.
+
+        ``on_done(result)`` or ``on_error(exc)`` run in the web process once
+        the job finishes, before its status is recorded.  If ``on_done``
+        returns a value, that value is stored as the job result instead.
+        """
+        return self._submit(kind, fn, [args], recording_id, on_done, on_error, single=True)
+
+    def submit_many(self, kind, fn, arg_list, recording_id=None, on_done=None, on_error=None):
+        """Queue ``fn(*args)`` for every ``args`` in ``arg_list`` as one job.
+
+        The calls run in parallel across the pool; ``on_done`` receives their
+        results in order once all of them have finished.
+        """
+        return self._submit(kind, fn, arg_list, recording_id, on_done, on_error, single=False)
+
+    def _submit(self, kind, fn, arg_list, recording_id, on_done, on_error, single):
+        job_id = self._start(kind, recording_id)
+        started = time.perf_counter()
+        try:
+            futures = [self._pool().submit(fn, *args) for args in arg_list]
+        except Exception as exc:
+            self._finished(job_id, kind, started, lambda exc=exc: _raise(exc), on_done, on_error)
+            raise
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def collect():
+            if single:
+                return futures[0].result()
+            return [future.result() for future in futures]
+
+        def one_done(_):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self._finished(job_id, kind, started, collect, on_done, on_error)
+
+        if not futures:
+            self._finished(job_id, kind, started, collect, on_done, on_error)
+        for future in futures:
+            future.add_done_callback(one_done)
+        return job_id
+
+    def _finished(self, job_id, kind, started, collect, on_done, on_error):
+        status, result, error = 'done', None, None
+        try:
+            result = collect()
+            if on_done is not None:
+                value = on_done(result)
+                if value is not None:
+                    result = value
+        except Exception as exc:
+            status, error = 'failed', repr(exc)
+            if on_error is not None:
+                try:
+                    on_error(exc)
+                except Exception:
+                    pass
+        finally:
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+        metrics.observe('job_duration_seconds', time.perf_counter() - started, kind=kind, status=status)
+        try:
+            with db.connection('Recordings') as conn:
+                conn.cursor().execute(
+                    'UPDATE Jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?',
+                    (status, json.dumps(result) if result is not None else None, error, _now(), job_id),
+                )
+                conn.commit()
+        except Exception:
+            pass
+
+    def shutdown(self):
+        """Let queued jobs finish and stop the worker processes."""
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._pid = None
+
+
+def get_job(job_id):
+    """Return a job's status row as a dict, or None."""
+    with db.connection('Recordings') as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT id, kind, status, recording_id, result, error, created_at, updated_at FROM Jobs WHERE id = ?',
+            (job_id,),
+        )
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    job = dict(zip(('id', 'kind', 'status', 'recording_id', 'result', 'error', 'created_at', 'updated_at'), row))
+    if job['result']:
+        job['result'] = json.loads(job['result'])
+    return job
+
+
+queue = JobQueue()
+atexit.register(queue.shutdown)
@@ -0,0 +1,286 @@
+"""Storage of application log records in the Logs table, and queries over them.
+
+Queries filter by minimum level and time range (indexed on ``timestamp,
+level``), search message text through SQLite FTS5 or Azure SQL full-text
+search, page newest first by ``before_id`` and can follow new rows.
+"""
+
+import datetime
+import logging
+import os
+import queue
+import threading
+import time
+
+import db
+import pagination
+
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', '200'))
+LOG_FLUSH_INTERVAL_MS = int(os.environ.get('LOG_FLUSH_INTERVAL_MS', '500'))
+# 'drop' discards records when the queue is full, 'block' waits for room
+LOG_OVERFLOW = os.environ.get('LOG_OVERFLOW', 'drop')
+LOG_TAIL_POLL_MS = int(os.environ.get('LOG_TAIL_POLL_MS', '1000'))
+# A followed stream ends after this long so it cannot hold a worker forever
+LOG_TAIL_MAX_SECONDS = float(os.environ.get('LOG_TAIL_MAX_SECONDS', '300'))
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+COLUMNS = ('id', 'timestamp', 'level', 'message')
+
+_STOP = object()
+
+
+class SQLLogHandler(logging.Handler):
+    """Logging handler that stores log records in the Log database.
+
+    ``emit`` only formats the record and puts it on a bounded queue.  A
+    background thread writes queued records with ``executemany`` whenever
+    ``batch_size`` records are waiting or ``flush_interval_ms`` has passed.
+    """
+
+    def __init__(self, db_name='Log', capacity=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE,
+                 flush_interval_ms=LOG_FLUSH_INTERVAL_MS, overflow=LOG_OVERFLOW, level=logging.NOTSET):
+        super().__init__(level)
+        if overflow not in ('drop', 'block'):
+            raise ValueError(f'Unknown overflow policy {overflow!r}')
+        self.db_name = db_name
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.overflow = overflow
+        self.dropped = 0
+        self.flushed = 0
+        self.failed = 0
+        self._queue = None
+        self._thread = None
+        self._writer_pid = None
+        self._start_lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._forget_writer)
+
+    def _forget_writer(self):
+        # The writer thread does not survive fork(); the child starts its own
+        self._queue = None
+        self._thread = None
+        self._writer_pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_writer(self):
+        if self._writer_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.capacity)
+            self._thread = threading.Thread(target=self._run, name='sql-log-writer', daemon=True)
+            self._thread.start()
+            self._writer_pid = os.getpid()
+
+    def emit(self, record):
+        try:
+            ts = datetime.datetime.fromtimestamp(record.created).isoformat()
+            item = (ts, record.levelname, self.format(record))
+        except Exception:
+            self.handleError(record)
+            return
+        self._ensure_writer()
+        try:
+            if self.overflow == 'block':
+                self._queue.put(item)
+            else:
+                self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        q = self._queue
+        stopping = False
+        while not stopping:
+            try:
+                first = q.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            item = first
+            while True:
+                if item is _STOP:
+                    stopping = True
+                else:
+                    batch.append(item)
+                if stopping or len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                try:
+                    item = q.get(timeout=remaining) if remaining > 0 else q.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+            for _ in range(len(batch) + (1 if stopping else 0)):
+                q.task_done()
+
+    def _write(self, batch):
+        try:
+            with db.connection(self.db_name) as conn:
+                conn.cursor().executemany(
+                    'INSERT INTO Logs (timestamp, level, message) VALUES (?, ?, ?)',
+                    batch,
+                )
+                conn.commit()
+            self.flushed += len(batch)
+        except Exception:
+            # Never log from the writer thread; that would feed back into this queue
+            self.failed += len(batch)
+
+    def flush(self, timeout=5.0):
+        """Wait until every queued record has been written or ``timeout`` passes."""
+        q = self._queue
+        if q is None or self._writer_pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        with q.all_tasks_done:
+            while q.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                q.all_tasks_done.wait(remaining)
+
+    def close(self):
+        """Drain the queue and stop the writer thread."""
+        if self._thread is not None and self._writer_pid == os.getpid():
+            self._queue.put(_STOP)
+            self._thread.join(timeout=10)
+        self._forget_writer()
+        super().close()
+
+    def stats(self):
+        """Return counters describing the handler's queue and throughput."""
+        q = self._queue
+        return {
+            'queued': q.qsize() if q is not None else 0,
+            'flushed': self.flushed,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+
+# --- Queries ---
+_search_backend = None
+
+
+def search_backend():
+    """Return ``'fts5'``, ``'fulltext'`` or ``'like'`` for this database."""
+    global _search_backend
+    if _search_backend is None:
+        with db.connection('Log') as conn:
+            cursor = conn.cursor()
+            if db.is_azure():
+                cursor.execute("SELECT 1 FROM sys.fulltext_indexes WHERE object_id = OBJECT_ID('Logs')")
+                _search_backend = 'fulltext' if cursor.fetchone() else 'like'
+            else:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='LogsFts'")
+                _search_backend = 'fts5' if cursor.fetchone() else 'like'
+    return _search_backend
+
+
+def _search_condition(text):
+    """Translate whitespace-separated words (``word*`` for a prefix) into SQL."""
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*').replace('"', '')
+        if word:
+            terms.append((word, prefix))
+    if not terms:
+        raise pagination.PaginationError('q must contain at least one word')
+    backend = search_backend()
+    if backend == 'fts5':
+        match = ' '.join(f'"{word}"' + ('*' if prefix else '') for word, prefix in terms)
+        return ['id IN (SELECT rowid FROM LogsFts WHERE LogsFts MATCH ?)'], [match]
+    if backend == 'fulltext':
+        match = ' AND '.join(f'"{word}*"' if prefix else f'"{word}"' for word, prefix in terms)
+        return ['CONTAINS(message, ?)'], [match]
+    escaped = [word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') for word, _ in terms]
+    return ["message LIKE ? ESCAPE '\\'"] * len(terms), [f'%{word}%' for word in escaped]
+
+
+def filter_conditions(level=None, start=None, end=None, text=None):
+    """Build ``(conditions, params)`` for the level, time range and text filters.
+
+    ``level`` is a minimum: ``WARNING`` also matches ERROR and CRITICAL.
+    ``start`` and ``end`` are datetimes compared with the stored ISO timestamps.
+    """
+    conditions, params = [], []
+    if level:
+        level = level.upper()
+        if level not in LEVELS:
+            raise pagination.PaginationError(f'level must be one of {LEVELS}')
+        names = LEVELS[LEVELS.index(level):]
+        conditions.append(f"level IN ({', '.join('?' * len(names))})")
+        params.extend(names)
+    if start is not None:
+        conditions.append('timestamp >= ?')
+        params.append(start.isoformat())
+    if end is not None:
+        conditions.append('timestamp <= ?')
+        params.append(end.isoformat())
+    if text:
+        search, search_params = _search_condition(text)
+        conditions.extend(search)
+        params.extend(search_params)
+    return conditions, params
+
+
+def query(before_id=None, limit=pagination.DEFAULT_PAGE_SIZE, **filters):
+    """Return one page of log records, newest first."""
+    conditions, params = filter_conditions(**filters)
+    if before_id is not None:
+        conditions.append('id < ?')
+        params.append(before_id)
+    with db.connection('Log') as conn:
+        cursor = conn.cursor()
+        cursor.execute(pagination.page_sql(COLUMNS, 'Logs', conditions, limit), params)
+        return [dict(zip(COLUMNS, row)) for row in cursor.fetchall()]
+
+
+def _rows_after(after_id, conditions, params, limit):
+    where = ' AND '.join(['id > ?', *conditions])
+    cols = ', '.join(COLUMNS)
+    if db.is_azure():
+        sql = f'SELECT TOP {int(limit)} {cols} FROM Logs WHERE {where} ORDER BY id'
+    else:
+        sql = f'SELECT {cols} FROM Logs WHERE {where} ORDER BY id LIMIT {int(limit)}'
+    with db.connection('Log') as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql, [after_id, *params])
+        return [dict(zip(COLUMNS, row)) for row in cursor.fetchall()]
+
+
+def follow(backlog=20, poll_ms=LOG_TAIL_POLL_MS, max_seconds=LOG_TAIL_MAX_SECONDS, **filters):
+    """Yield the last ``backlog`` matching records, then new ones as they are stored.
+
+    A connection is only borrowed for each poll.  ``None`` is yielded after
+    every poll that found nothing, so callers can send keep-alives.  Stops
+    after ``max_seconds`` (0 means never).
+    """
+    conditions, params = filter_conditions(**filters)
+    recent = query(limit=backlog, **filters) if backlog else []
+    yield from reversed(recent)
+    if recent:
+        after_id = recent[0]['id']
+    else:
+        with db.connection('Log') as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT MAX(id) FROM Logs')
+            after_id = cursor.fetchone()[0] or 0
+    deadline = time.monotonic() + max_seconds if max_seconds else None
+    while deadline is None or time.monotonic() < deadline:
+        rows = _rows_after(after_id, conditions, params, pagination.MAX_PAGE_SIZE)
+        if rows:
+            after_id = rows[-1]['id']
+            yield from rows
+            if len(rows) == pagination.MAX_PAGE_SIZE:
+                continue
+        else:
+            yield None
+        time.sleep(poll_ms / 1000.0)
@@ -0,0 +1,479 @@
+"""Retention, rollup and compaction of the databases and media directories.
+
+A run goes through ``STEPS`` in order and reports, per step, the rows and
+files it removed and the bytes that freed:
+
+* ``logs``, ``movement_chunks`` and ``purchases`` delete rows past their
+  retention, ``MAINTENANCE_BATCH_ROWS`` per transaction with a short pause in
+  between, so writers never wait on one long lock.
+* ``movement`` rolls Movement rows past their retention into per-minute
+  MovementMinutes aggregates and deletes them, one window at a time.
+* ``recordings`` deletes cataloged media files past their retention together
+  with their Media and Recordings rows.
+* ``wavs`` moves wavs that older uploads kept next to their webm into the
+  derived-wav cache and trims that cache to ``DERIVED_CACHE_BYTES``.
+* ``qrcodes`` and ``uploads`` prune QR images nobody requested lately and
+  abandoned resumable uploads.
+* ``compact`` returns freed database pages to the file system (incremental
+  VACUUM and a WAL checkpoint on SQLite, index reorganisation on Azure SQL)
+  and refreshes planner statistics.  SQLite files created before incremental
+  auto-vacuum was enabled need one ``full_vacuum``, which rewrites the file
+  under a write lock and so only runs when asked for from the CLI.
+
+A retention of ``0`` keeps data forever, which is the default for everything
+users recorded; only chunk duplicate markers expire unless configured.  With
+``MAINTENANCE_INTERVAL_HOURS`` set, a scheduler thread in the web process
+starts a run at that interval; a lock file makes sure only one process on the
+host runs it, and the report of the last run, kept in ``MAINTENANCE_REPORT``,
+decides when the next one is due.
+"""
+
+import datetime
+import fcntl
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+import time
+
+import db
+import derived
+import logs
+import media_catalog
+import metrics
+import qr_cache
+import response_cache
+import uploads
+
+RETENTION_LOGS_DAYS = float(os.environ.get('RETENTION_LOGS_DAYS', '0'))
+# Raw Movement rows; older rows survive as MovementMinutes aggregates
+RETENTION_MOVEMENT_DAYS = float(os.environ.get('RETENTION_MOVEMENT_DAYS', '0'))
+# Duplicate-detection markers of streamed movement chunks
+RETENTION_MOVEMENT_CHUNKS_DAYS = float(os.environ.get('RETENTION_MOVEMENT_CHUNKS_DAYS', '7'))
+RETENTION_PURCHASES_DAYS = float(os.environ.get('RETENTION_PURCHASES_DAYS', '0'))
+RETENTION_RECORDINGS_DAYS = float(os.environ.get('RETENTION_RECORDINGS_DAYS', '0'))
+QR_RETENTION_DAYS = float(os.environ.get('QR_RETENTION_DAYS', '0'))
+UPLOAD_RETENTION_HOURS = float(os.environ.get('UPLOAD_RETENTION_HOURS', '0'))
+
+MAINTENANCE_INTERVAL_HOURS = float(os.environ.get('MAINTENANCE_INTERVAL_HOURS', '0'))
+# Delay before a freshly started process first checks whether a run is due
+MAINTENANCE_START_DELAY = float(os.environ.get('MAINTENANCE_START_DELAY', '300'))
+MAINTENANCE_BATCH_ROWS = int(os.environ.get('MAINTENANCE_BATCH_ROWS', '1000'))
+MAINTENANCE_BATCH_PAUSE_MS = int(os.environ.get('MAINTENANCE_BATCH_PAUSE_MS', '50'))
+MAINTENANCE_ROLLUP_WINDOW_MINUTES = int(os.environ.get('MAINTENANCE_ROLLUP_WINDOW_MINUTES', '10'))
+# Pages returned to the file system per incremental VACUUM step
+MAINTENANCE_VACUUM_PAGES = int(os.environ.get('MAINTENANCE_VACUUM_PAGES', '2000'))
+MAINTENANCE_REPORT = os.environ.get('MAINTENANCE_REPORT', 'maintenance_report.json')
+
+RECORDINGS_DIR = 'recordings'
+_MINUTE_MS = 60000
+
+_ROLLUP_SQL = (
+    'INSERT INTO MovementMinutes (minute, session_id, samples, sum_lat, sum_lon, min_lat, max_lat, '
+    'min_lon, max_lon, sum_gx, sum_gy, sum_gz) '
+    'SELECT timestamp - (timestamp % 60000), COALESCE(session_id, \'\'), COUNT(*), SUM(lat), SUM(lon), '
+    'MIN(lat), MAX(lat), MIN(lon), MAX(lon), SUM(gx), SUM(gy), SUM(gz) '
+    'FROM Movement WHERE timestamp >= ? AND timestamp < ? '
+    'GROUP BY timestamp - (timestamp % 60000), COALESCE(session_id, \'\')'
+)
+
+logger = logging.getLogger(__name__)
+
+metrics.describe('maintenance_bytes_reclaimed_total', 'counter', 'Bytes freed by maintenance runs per step.')
+metrics.describe('maintenance_rows_deleted_total', 'counter', 'Rows deleted by maintenance runs per step.')
+
+
+def _pause():
+    time.sleep(MAINTENANCE_BATCH_PAUSE_MS / 1000.0)
+
+
+def _cutoff(days):
+    return datetime.datetime.now() - datetime.timedelta(days=days)
+
+
+def _first_rows_sql(columns, table, where, limit):
+    if db.is_azure():
+        return f'SELECT TOP {int(limit)} {columns} FROM {table} WHERE {where}'
+    return f'SELECT {columns} FROM {table} WHERE {where} LIMIT {int(limit)}'
+
+
+def delete_in_batches(db_name, table, where, params, batch_rows=None):
+    """Delete rows matching ``where`` in short transactions; returns the count."""
+    batch_rows = batch_rows or MAINTENANCE_BATCH_ROWS
+    if db.is_azure():
+        sql = f'DELETE TOP ({int(batch_rows)}) FROM {table} WHERE {where}'
+    else:
+        sql = f'DELETE FROM {table} WHERE rowid IN ({_first_rows_sql("rowid", table, where, batch_rows)})'
+    deleted = 0
+    while True:
+        with db.connection(db_name, site=f'maintenance_{table}') as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            count = cursor.rowcount
+            conn.commit()
+        deleted += count
+        if count < batch_rows:
+            return deleted
+        _pause()
+
+
+# --- Steps ---
+def expire_logs():
+    if not RETENTION_LOGS_DAYS:
+        return {}
+    cutoff = _cutoff(RETENTION_LOGS_DAYS).isoformat()
+    return {'rows': delete_in_batches('Log', 'Logs', 'timestamp < ?', (cutoff,))}
+
+
+def rollup_movement():
+    """Aggregate and delete Movement rows older than the retention."""
+    if not RETENTION_MOVEMENT_DAYS:
+        return {}
+    cutoff_ms = int(_cutoff(RETENTION_MOVEMENT_DAYS).timestamp() * 1000)
+    # Windows start and end on whole minutes, so a minute is never split
+    cutoff_ms -= cutoff_ms % _MINUTE_MS
+    window_ms = MAINTENANCE_ROLLUP_WINDOW_MINUTES * _MINUTE_MS
+    rows = minutes = 0
+    while True:
+        with db.connection('Recordings', site='maintenance_Movement') as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT MIN(timestamp) FROM Movement WHERE timestamp < ?', (cutoff_ms,))
+            start = cursor.fetchone()[0]
+            if start is None:
+                break
+            start -= start % _MINUTE_MS
+            end = min(start + window_ms, cutoff_ms)
+            cursor.execute(_ROLLUP_SQL, (start, end))
+            minutes += cursor.rowcount
+            cursor.execute('DELETE FROM Movement WHERE timestamp >= ? AND timestamp < ?', (start, end))
+            rows += cursor.rowcount
+            conn.commit()
+        response_cache.bump('movement')
+        _pause()
+    return {'rows': rows, 'minutes': minutes}
+
+
+def expire_movement_chunks():
+    if not RETENTION_MOVEMENT_CHUNKS_DAYS:
+        return {}
+    cutoff = _cutoff(RETENTION_MOVEMENT_CHUNKS_DAYS).isoformat()
+    return {'rows': delete_in_batches('Recordings', 'MovementChunks', 'received_at < ?', (cutoff,))}
+
+
+def expire_purchases():
+    if not RETENTION_PURCHASES_DAYS:
+        return {}
+    cutoff = _cutoff(RETENTION_PURCHASES_DAYS).isoformat()
+    return {'rows': delete_in_batches('Purchases', 'Purchases', 'timestamp < ?', (cutoff,))}
+
+
+def _remove(path):
+    """Delete a file and return its size, or 0 if it was already gone."""
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return size
+
+
+def expire_recordings():
+    """Delete cataloged media past the retention, files first, then rows."""
+    if not RETENTION_RECORDINGS_DAYS:
+        return {}
+    cutoff = _cutoff(RETENTION_RECORDINGS_DAYS).isoformat()
+    sql = _first_rows_sql('id, path, recording_id', 'Media', 'created_at < ?', MAINTENANCE_BATCH_ROWS)
+    rows = files = freed = 0
+    while True:
+        with db.connection('Recordings', site='maintenance_Media') as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, (cutoff,))
+            batch = cursor.fetchall()
+            for _, path, _ in batch:
+                for candidate in (path, os.path.splitext(path)[0] + '.wav', derived.wav_path(path)):
+                    size = _remove(candidate)
+                    files += 1 if size else 0
+                    freed += size
+            cursor.executemany('DELETE FROM Media WHERE id = ?', [(media_id,) for media_id, _, _ in batch])
+            recording_ids = [(rid,) for _, _, rid in batch if rid is not None]
+            if recording_ids:
+                cursor.executemany('DELETE FROM Recordings WHERE id = ?', recording_ids)
+            conn.commit()
+        response_cache.bump('media', 'recordings')
+        rows += len(batch) + len(recording_ids)
+        if len(batch) < MAINTENANCE_BATCH_ROWS:
+            break
+        _pause()
+    return {'rows': rows, 'files': files, 'bytes': freed}
+
+
+def trim_wavs():
+    """Move wavs stored beside their webm into the derived cache, then trim it."""
+    try:
+        entries = list(os.scandir(RECORDINGS_DIR))
+    except FileNotFoundError:
+        entries = []
+    for entry in entries:
+        base, ext = os.path.splitext(entry.name)
+        # A wav without its webm is the only copy of that recording
+        if ext == '.wav' and os.path.exists(os.path.join(RECORDINGS_DIR, base + media_catalog.MEDIA_EXTENSION)):
+            derived.adopt(entry.path)
+    files, freed = derived.trim()
+    return {'files': files, 'bytes': freed}
+
+
+def prune_qrcodes():
+    if not QR_RETENTION_DAYS:
+        return {}
+    files, freed = qr_cache.cache.prune(QR_RETENTION_DAYS * 86400)
+    return {'files': files, 'bytes': freed}
+
+
+def prune_uploads():
+    if not UPLOAD_RETENTION_HOURS:
+        return {}
+    files, freed = uploads.prune_stale(UPLOAD_RETENTION_HOURS * 3600)
+    return {'files': files, 'bytes': freed}
+
+
+def database_bytes(db_name):
+    """Storage used by one logical database (files on SQLite, pages on Azure)."""
+    if db.is_azure():
+        with db.connection(db_name, site='maintenance_size') as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT SUM(reserved_page_count) * 8192 FROM sys.dm_db_partition_stats')
+            return int(cursor.fetchone()[0] or 0)
+    path = db.sqlite_path(db_name)
+    total = 0
+    for candidate in (path, path + '-wal'):
+        try:
+            total += os.path.getsize(candidate)
+        except OSError:
+            pass
+    return total
+
+
+def _compact_sqlite(db_name):
+    """Compact one SQLite database; returns False when it needs a full VACUUM first."""
+    with db.connection(db_name, site='maintenance_compact') as conn:
+        conn.commit()
+        incremental = conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+        while incremental and conn.execute('PRAGMA freelist_count').fetchone()[0]:
+            conn.execute(f'PRAGMA incremental_vacuum({MAINTENANCE_VACUUM_PAGES})').fetchall()
+            _pause()
+        if db_name == 'Log' and logs.search_backend() == 'fts5':
+            # Merge the FTS5 segments left behind by inserts and deletes
+            conn.execute("INSERT INTO LogsFts (LogsFts) VALUES ('optimize')")
+            conn.commit()
+        conn.execute('PRAGMA optimize')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+    return incremental
+
+
+def _compact_azure(db_name):
+    with db.connection(db_name, site='maintenance_compact') as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT name FROM sys.tables')
+        tables = [name for (name,) in cursor.fetchall()]
+        conn.commit()
+        # Index maintenance cannot run inside a user transaction
+        conn.autocommit = True
+        try:
+            for table in tables:
+                cursor.execute(f'ALTER INDEX ALL ON {table} REORGANIZE WITH (LOB_COMPACTION = ON)')
+                cursor.execute(f'UPDATE STATISTICS {table}')
+        finally:
+            conn.autocommit = False
+
+
+def compact():
+    pending = []
+    for db_name in db.SCHEMA:
+        if db.is_azure():
+            _compact_azure(db_name)
+        elif not _compact_sqlite(db_name):
+            pending.append(db_name)
+    if pending:
+        return {'note': f"free pages kept in {', '.join(pending)}; run 'flask maintenance --full-vacuum' once"}
+    return {}
+
+
+def full_vacuum():
+    """Rewrite each SQLite database with VACUUM, switching it to incremental auto-vacuum.
+
+    Writers wait for the whole rewrite, so this runs only on request.
+    Returns ``{db_name: {'before': bytes, 'after': bytes}}``, or None when
+    another process is running maintenance.
+    """
+    with exclusive() as acquired:
+        if not acquired:
+            return None
+        sizes = {}
+        for db_name in db.SCHEMA:
+            before = database_bytes(db_name)
+            with db.connection(db_name, site='maintenance_vacuum') as conn:
+                conn.commit()
+                conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                conn.execute('VACUUM')
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+            sizes[db_name] = {'before': before, 'after': database_bytes(db_name)}
+        return sizes
+
+
+# (name, function) pairs in run order; compaction comes last
+STEPS = [
+    ('logs', expire_logs),
+    ('movement', rollup_movement),
+    ('movement_chunks', expire_movement_chunks),
+    ('purchases', expire_purchases),
+    ('recordings', expire_recordings),
+    ('wavs', trim_wavs),
+    ('qrcodes', prune_qrcodes),
+    ('uploads', prune_uploads),
+    ('compact', compact),
+]
+
+
+# --- Runs and reports ---
+def run(only=None):
+    """Run the maintenance steps (all, or those named in ``only``) and return the report.
+
+    A failing step is recorded in the report and the remaining steps still run.
+    The database step's ``bytes`` is the storage the databases shrank by.
+    """
+    started_at = datetime.datetime.now()
+    size_before = {db_name: database_bytes(db_name) for db_name in db.SCHEMA}
+    steps = []
+    for name, step in STEPS:
+        if only and name not in only:
+            continue
+        started = time.perf_counter()
+        entry = {'step': name, 'rows': 0, 'files': 0, 'bytes': 0}
+        try:
+            entry.update(step() or {})
+        except Exception as exc:
+            logger.exception(f'Maintenance step {name} failed')
+            entry['error'] = f'{type(exc).__name__}: {exc}'
+        entry['seconds'] = round(time.perf_counter() - started, 3)
+        steps.append(entry)
+    databases = {
+        db_name: {'before': size_before[db_name], 'after': database_bytes(db_name)} for db_name in db.SCHEMA
+    }
+    db_freed = sum(max(0, s['before'] - s['after']) for s in databases.values())
+    steps.append({'step': 'databases', 'rows': 0, 'files': 0, 'bytes': db_freed, 'seconds': 0})
+    for entry in steps:
+        metrics.inc('maintenance_bytes_reclaimed_total', entry['bytes'], step=entry['step'])
+        metrics.inc('maintenance_rows_deleted_total', entry['rows'], step=entry['step'])
+    finished_at = datetime.datetime.now()
+    report = {
+        'started_at': started_at.isoformat(),
+        'finished_at': finished_at.isoformat(),
+        'seconds': round((finished_at - started_at).total_seconds(), 3),
+        'bytes_reclaimed': sum(entry['bytes'] for entry in steps),
+        'steps': steps,
+        'databases': databases,
+    }
+    _save_report(report)
+    return report
+
+
+def _save_report(report):
+    tmp_path = f'{MAINTENANCE_REPORT}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    os.replace(tmp_path, MAINTENANCE_REPORT)
+
+
+def last_report():
+    """Return the report of the most recent run on this host, or None."""
+    try:
+        with open(MAINTENANCE_REPORT) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def format_report(report):
+    lines = []
+    for entry in report['steps']:
+        line = f"  {entry['step']:16} {entry['rows']:>9} rows {entry['files']:>7} files {_size(entry['bytes']):>10}"
+        if 'error' in entry:
+            line += f"  FAILED: {entry['error']}"
+        elif 'note' in entry:
+            line += f"  ({entry['note']})"
+        lines.append(line)
+    lines.append(f"Reclaimed {_size(report['bytes_reclaimed'])} in {report['seconds']}s")
+    return '\n'.join(lines)
+
+
+def _size(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n) < 1024 or unit == 'GB':
+            return f'{n:.0f} {unit}' if unit == 'B' else f'{n:.1f} {unit}'
+        n /= 1024.0
+
+
+def seconds_until_due():
+    report = last_report()
+    if report is None:
+        return 0
+    finished = datetime.datetime.fromisoformat(report['finished_at'])
+    due = finished + datetime.timedelta(hours=MAINTENANCE_INTERVAL_HOURS)
+    return max(0.0, (due - datetime.datetime.now()).total_seconds())
+
+
+@contextmanager
+def exclusive():
+    """Hold the host-wide maintenance lock; yields False if another process has it."""
+    with open(f'{MAINTENANCE_REPORT}.lock', 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+
+def run_exclusive(only=None, if_due=False):
+    """Run unless another process on this host is already running maintenance.
+
+    With ``if_due`` the run is also skipped when the last one is recent.
+    Returns the report, or None when skipped.
+    """
+    with exclusive() as acquired:
+        if not acquired or (if_due and seconds_until_due() > 0):
+            return None
+        return run(only)
+
+
+# --- Scheduler ---
+_scheduler_pid = None
+_scheduler_lock = threading.Lock()
+
+
+def _schedule_loop():
+    time.sleep(MAINTENANCE_START_DELAY)
+    while True:
+        wait = seconds_until_due()
+        if wait > 0:
+            time.sleep(min(wait, 3600))
+            continue
+        try:
+            run_exclusive(if_due=True)
+        except Exception:
+            # Try again at the next interval rather than in a tight loop
+            pass
+        time.sleep(60)
+
+
+def start_scheduler():
+    """Start the maintenance thread for this process when scheduling is enabled."""
+    global _scheduler_pid
+    if not MAINTENANCE_INTERVAL_HOURS or _scheduler_pid == os.getpid():
+        return
+    with _scheduler_lock:
+        if _scheduler_pid == os.getpid():
+            return
+        threading.Thread(target=_schedule_loop, name='maintenance', daemon=True).start()
+        _scheduler_pid = os.getpid()
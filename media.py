@@ -0,0 +1,98 @@
+"""Serving recorded media and QR images.
+
+Files go out through ``send_file`` with conditional responses enabled, so
+``Range`` requests get ``206`` partial content and ``If-None-Match`` /
+``If-Modified-Since`` get ``304``.  The body is a file wrapper, which lets
+gunicorn use ``sendfile``.  With a front-end web server the transfer can be
+handed off entirely:
+
+* ``MEDIA_SENDFILE=x-sendfile`` sets ``X-Sendfile`` (Apache, lighttpd).
+* ``MEDIA_SENDFILE=x-accel-redirect`` sets ``X-Accel-Redirect`` to
+  ``MEDIA_ACCEL_PREFIX/<root>/<file>`` for an nginx ``internal`` location.
+"""
+
+import os
+
+from flask import Response, abort, send_file
+from werkzeug.security import safe_join
+
+import derived
+
+MEDIA_SENDFILE = os.environ.get('MEDIA_SENDFILE', '').lower()
+MEDIA_ACCEL_PREFIX = os.environ.get('MEDIA_ACCEL_PREFIX', '/protected-media').rstrip('/')
+# Recordings are never rewritten but may be deleted, so they are revalidated
+# after a day; content-addressed files are cached for a year.
+MEDIA_MAX_AGE = int(os.environ.get('MEDIA_MAX_AGE', '86400'))
+IMMUTABLE_MAX_AGE = 31536000
+
+# URL name -> (directory, allowed extensions, content addressed)
+ROOTS = {
+    'recordings': (os.path.join('recordings'), ('.webm', '.wav'), False),
+    'videos': (os.path.join('recordings', 'videos'), ('.webm',), False),
+    'qrcodes': (os.path.join('static', 'qrcodes'), ('.png',), True),
+    'derived': (derived.DERIVED_DIR, ('.wav',), False),
+}
+
+_MIMETYPES = {
+    '.webm': None,  # decided by the root: audio or video
+    '.wav': 'audio/wav',
+    '.png': 'image/png',
+}
+
+
+def resolve(root, filename):
+    """Return the absolute path of a media file, or None if it is not servable."""
+    if root not in ROOTS:
+        return None
+    directory, extensions, _ = ROOTS[root]
+    if '/' in filename or os.path.splitext(filename)[1] not in extensions:
+        return None
+    path = safe_join(os.path.abspath(directory), filename)
+    if path is None or not os.path.isfile(path):
+        return None
+    return path
+
+
+def _mimetype(root, filename):
+    ext = os.path.splitext(filename)[1]
+    if ext == '.webm':
+        return 'video/webm' if root == 'videos' else 'audio/webm'
+    return _MIMETYPES[ext]
+
+
+def _cache_control(root):
+    if ROOTS[root][2]:
+        return f'private, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    return f'private, max-age={MEDIA_MAX_AGE}'
+
+
+def etag_for(root, filename, st):
+    """Strong validator: the name for content-addressed files, else size and mtime."""
+    if ROOTS[root][2]:
+        return os.path.splitext(filename)[0]
+    return f'{st.st_size:x}-{st.st_mtime_ns:x}'
+
+
+def send_media(root, filename):
+    """Build the response for ``GET /media/<root>/<filename>``; 404s if missing."""
+    path = resolve(root, filename)
+    if path is None:
+        abort(404)
+    st = os.stat(path)
+    if MEDIA_SENDFILE == 'x-accel-redirect':
+        # nginx answers ranges and conditionals from the internal location
+        return Response(headers={
+            'X-Accel-Redirect': f'{MEDIA_ACCEL_PREFIX}/{root}/{filename}',
+            'Content-Type': _mimetype(root, filename),
+            'Cache-Control': _cache_control(root),
+        })
+    response = send_file(
+        path,
+        mimetype=_mimetype(root, filename),
+        conditional=True,
+        etag=etag_for(root, filename, st),
+        last_modified=st.st_mtime,
+        max_age=MEDIA_MAX_AGE,
+    )
+    response.headers['Cache-Control'] = _cache_control(root)
+    return response
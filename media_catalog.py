@@ -0,0 +1,259 @@
+"""Catalog of uploaded media files in the Media table.
+
+Rows are written when a recording is stored, so listings are index lookups
+instead of directory scans.  ``reconcile`` rebuilds the catalog from disk
+after files were added or removed by hand; ``backfill`` runs it once at
+startup while the catalog is still empty.
+"""
+
+import datetime
+import fcntl
+import os
+import re
+import struct
+import wave
+
+import concurrency
+import db
+import response_cache
+
+# kind -> (media root name used in /media URLs, directory)
+KINDS = {
+    'video': ('videos', os.path.join('recordings', 'videos')),
+    'audio': ('recordings', os.path.join('recordings')),
+}
+MEDIA_EXTENSION = '.webm'
+# WebM stores CodecID strings such as V_VP8 or A_OPUS in the track header
+_CODEC_RE = re.compile(rb'[VA]_[A-Z0-9]+(?:/[A-Z0-9]+)*')
+_PROBE_BYTES = 4096
+# Held while one process backfills, so workers starting together scan once
+_BACKFILL_LOCK = 'media_catalog.lock'
+
+# Matroska/WebM element ids read by the duration probe
+_EBML_MAGIC = b'\x1a\x45\xdf\xa3'
+_SEGMENT = 0x18538067
+_INFO = 0x1549A966
+_TIMECODE_SCALE = 0x2AD7B1
+_DURATION = 0x4489
+_CLUSTER = 0x1F43B675
+_CLUSTER_TIMECODE = 0xE7
+_BLOCK_GROUP = 0xA0
+_BLOCK = 0xA1
+_SIMPLE_BLOCK = 0xA3
+# Elements whose children are walked instead of skipped
+_CONTAINERS = {_SEGMENT, _INFO, _CLUSTER, _BLOCK_GROUP}
+_UNKNOWN_SIZE = object()
+
+_INSERT_SQL = (
+    'INSERT INTO Media (kind, path, bytes, duration, codec, created_at, recording_id) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?)'
+)
+
+
+def catalog_path(path):
+    """Normalise a file path to the form stored in Media.path."""
+    return os.path.relpath(path).replace(os.sep, '/')
+
+
+def _read_vint(fh, keep_marker):
+    """Read an EBML variable-length integer; None at end of file."""
+    first = fh.read(1)
+    if not first:
+        return None, 0
+    length = 9 - first[0].bit_length()
+    if length > 8:
+        raise ValueError('invalid EBML length')
+    rest = fh.read(length - 1)
+    if len(rest) != length - 1:
+        return None, 0
+    value = first[0] if keep_marker else first[0] & (0xFF >> length)
+    for byte in rest:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        return _UNKNOWN_SIZE, length
+    return value, length
+
+
+def webm_duration(path):
+    """Return the duration of a WebM file in seconds without decoding it.
+
+    Uses the Segment Info duration when the muxer wrote one.  Browser
+    MediaRecorder files usually have none, so the timestamps of the last
+    blocks are used instead; only element headers are read and payloads are
+    skipped with seeks.
+    """
+    scale = 1000000  # nanoseconds per timestamp tick
+    duration = None
+    cluster_time = 0
+    last_time = previous_time = None
+    try:
+        with open(path, 'rb', buffering=65536) as fh:
+            file_size = os.fstat(fh.fileno()).st_size
+            if fh.read(4) != _EBML_MAGIC:
+                return None
+            fh.seek(0)
+            while True:
+                element_id, _ = _read_vint(fh, keep_marker=True)
+                if element_id is None:
+                    break
+                size, _ = _read_vint(fh, keep_marker=False)
+                if size is None:
+                    break
+                if element_id in _CONTAINERS:
+                    if element_id == _CLUSTER and duration is not None:
+                        break
+                    continue
+                if size is _UNKNOWN_SIZE:
+                    break
+                start = fh.tell()
+                if start + size > file_size:
+                    break
+                if element_id == _TIMECODE_SCALE:
+                    scale = int.from_bytes(fh.read(size), 'big')
+                elif element_id == _DURATION and size in (4, 8):
+                    duration = struct.unpack('>f' if size == 4 else '>d', fh.read(size))[0]
+                elif element_id == _CLUSTER_TIMECODE:
+                    cluster_time = int.from_bytes(fh.read(size), 'big')
+                elif element_id in (_SIMPLE_BLOCK, _BLOCK):
+                    _read_vint(fh, keep_marker=False)  # track number
+                    relative = struct.unpack('>h', fh.read(2))[0]
+                    block_time = cluster_time + relative
+                    if last_time is None or block_time > last_time:
+                        previous_time, last_time = last_time, block_time
+                fh.seek(start + size)
+    except (OSError, ValueError, struct.error):
+        return None
+    if duration:
+        ticks = duration
+    elif last_time is not None:
+        # The last block lasts about as long as the gap before it
+        ticks = last_time + (last_time - previous_time if previous_time is not None else 0)
+    else:
+        return None
+    if ticks <= 0:
+        return None
+    return round(ticks * scale / 1e9, 2)
+
+
+def probe(path):
+    """Return ``(duration, codec)`` read cheaply from the file's container metadata."""
+    if path.endswith('.wav'):
+        try:
+            with wave.open(path, 'rb') as wf:
+                duration = round(wf.getnframes() / float(wf.getframerate()), 2)
+                return duration, f'pcm_s{8 * wf.getsampwidth()}le'
+        except (OSError, wave.Error, EOFError):
+            return None, None
+    try:
+        with open(path, 'rb') as fh:
+            header = fh.read(_PROBE_BYTES)
+    except OSError:
+        return None, None
+    codecs = []
+    for match in _CODEC_RE.findall(header):
+        codec = match.decode('ascii')
+        if codec not in codecs:
+            codecs.append(codec)
+    return webm_duration(path), ','.join(codecs) or None
+
+
+def _row(kind, path, st, created_at, recording_id, probed=None):
+    duration, codec = probed or probe(path)
+    return (kind, catalog_path(path), st.st_size, duration, codec, created_at, recording_id)
+
+
+def add(kind, path, recording_id=None, probed=None):
+    """Catalog a freshly stored file and return its Media id.
+
+    ``probed`` is a ``probe(path)`` result the caller already has.
+    """
+    st = os.stat(path)
+    row = _row(kind, path, st, datetime.datetime.now().isoformat(), recording_id, probed)
+    with db.connection('Recordings') as conn:
+        media_id = db.insert_returning_id(conn.cursor(), _INSERT_SQL, row)
+        conn.commit()
+    response_cache.bump('media')
+    return media_id
+
+
+def set_duration(recording_id, duration):
+    """Record a duration measured later, e.g. by the conversion job."""
+    with db.connection('Recordings') as conn:
+        conn.cursor().execute('UPDATE Media SET duration = ? WHERE recording_id = ?', (duration, recording_id))
+        conn.commit()
+    response_cache.bump('media')
+
+
+def remove(path):
+    with db.connection('Recordings') as conn:
+        conn.cursor().execute('DELETE FROM Media WHERE path = ?', (catalog_path(path),))
+        conn.commit()
+    response_cache.bump('media')
+
+
+def reconcile():
+    """Bring the catalog in line with the files on disk.
+
+    Each media directory is scanned once; missing files are inserted in one
+    batch (oldest first, so ids follow recency), changed sizes are updated
+    and rows for deleted files are removed.  Returns the counts.
+    """
+    on_disk = {}
+    for kind, (_, directory) in KINDS.items():
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(MEDIA_EXTENSION):
+                on_disk[catalog_path(entry.path)] = (kind, entry.path, entry.stat())
+    with db.connection('Recordings') as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, path, bytes FROM Media')
+        cataloged = {path: (media_id, size) for media_id, path, size in cursor.fetchall()}
+        cursor.execute('SELECT id, filename FROM Recordings')
+        recording_ids = {filename: recording_id for recording_id, filename in cursor.fetchall()}
+
+        missing = sorted((p for p in on_disk if p not in cataloged), key=lambda p: on_disk[p][2].st_mtime)
+        inserts = []
+        for key in missing:
+            kind, path, st = on_disk[key]
+            created_at = datetime.datetime.fromtimestamp(st.st_mtime).isoformat()
+            recording_id = recording_ids.get(os.path.basename(path)) if kind == 'audio' else None
+            inserts.append(_row(kind, path, st, created_at, recording_id))
+        updates = [
+            (on_disk[path][2].st_size, media_id)
+            for path, (media_id, size) in cataloged.items()
+            if path in on_disk and on_disk[path][2].st_size != size
+        ]
+        deletes = [(media_id,) for path, (media_id, _) in cataloged.items() if path not in on_disk]
+        if inserts:
+            cursor.executemany(_INSERT_SQL, inserts)
+        if updates:
+            cursor.executemany('UPDATE Media SET bytes = ? WHERE id = ?', updates)
+        if deletes:
+            cursor.executemany('DELETE FROM Media WHERE id = ?', deletes)
+        # Durations measured by the conversion job live on Recordings
+        cursor.execute(
+            'UPDATE Media SET duration = (SELECT length FROM Recordings WHERE Recordings.id = Media.recording_id) '
+            'WHERE duration IS NULL AND recording_id IS NOT NULL'
+        )
+        conn.commit()
+    response_cache.bump('media')
+    return {'added': len(inserts), 'updated': len(updates), 'removed': len(deletes), 'files': len(on_disk)}
+
+
+def backfill():
+    """Catalog existing files when the Media table is empty, e.g. after upgrading.
+
+    Returns the ``reconcile`` counts, or None when the catalog had rows.
+    """
+    with open(_BACKFILL_LOCK, 'a') as lock:
+        concurrency.offload(fcntl.flock, lock, fcntl.LOCK_EX)
+        with db.connection('Recordings') as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT MAX(id) FROM Media')
+            (last_id,) = cursor.fetchone()
+        if last_id is not None:
+            return None
+        return reconcile()
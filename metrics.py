@@ -0,0 +1,280 @@
+"""In-process metrics in Prometheus text format, plus an opt-in sampling profiler.
+
+Counters and histograms are plain dicts behind one lock, so recording a
+sample costs a few microseconds.  Gauges are callbacks evaluated at scrape
+time (queue depths and the like).
+
+Each gunicorn worker has its own registry.  When ``METRICS_DIR`` is set,
+every process writes a snapshot there every ``METRICS_FLUSH_INTERVAL``
+seconds and ``/metrics`` merges them; otherwise only the worker that answers
+the scrape is reported.
+"""
+
+import bisect
+import collections
+import glob
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+# Requests may ask for a profile with the X-Profile header only when enabled
+METRICS_PROFILE = os.environ.get('METRICS_PROFILE', '0') == '1'
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '1'))
+PROFILE_KEEP = 20
+
+# Seconds; covers sub-millisecond queries up to slow conversions
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Registry:
+    """Counters, histograms and gauge callbacks keyed by name and labels."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._counters = collections.defaultdict(float)
+        self._histograms = {}
+        self._gauges = {}
+        self._flusher_pid = None
+
+    def describe(self, name, kind, help_text, buckets=DEFAULT_BUCKETS):
+        self._meta[name] = (kind, help_text, tuple(buckets))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name, seconds, **labels):
+        buckets = self._meta.get(name, (None, None, DEFAULT_BUCKETS))[2]
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(buckets, seconds)
+        with self._lock:
+            state = self._histograms.get(key)
+            if state is None:
+                state = self._histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += seconds
+            state[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the duration of a ``with`` block, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def gauge(self, name, fn, help_text=''):
+        """Register ``fn()`` returning a number or a ``{labels_tuple: value}`` dict."""
+        self._meta[name] = ('gauge', help_text, ())
+        self._gauges[name] = fn
+
+    # --- Snapshots ---
+    def snapshot(self):
+        with self._lock:
+            counters = [[name, list(labels), value] for (name, labels), value in self._counters.items()]
+            histograms = [
+                [name, list(labels), list(state[0]), state[1], state[2]]
+                for (name, labels), state in self._histograms.items()
+            ]
+        gauges = []
+        for name, fn in list(self._gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            if isinstance(value, dict):
+                gauges.extend([name, list(labels), v] for labels, v in value.items())
+            else:
+                gauges.append([name, [], value])
+        return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def _write_snapshot(self):
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f'{os.getpid()}.json')
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(self.snapshot(), fh)
+        os.replace(tmp_path, path)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                self._write_snapshot()
+            except OSError:
+                pass
+
+    def ensure_flusher(self):
+        """Start the snapshot writer for this process when METRICS_DIR is set."""
+        if not METRICS_DIR or self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            threading.Thread(target=self._flush_loop, name='metrics-flusher', daemon=True).start()
+            self._flusher_pid = os.getpid()
+
+    def _collect(self):
+        if not METRICS_DIR:
+            return [self.snapshot()]
+        self.ensure_flusher()
+        self._write_snapshot()
+        snapshots = []
+        # Counters of exited workers are kept; their gauges are not
+        fresh_after = time.time() - 3 * METRICS_FLUSH_INTERVAL
+        for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+            try:
+                with open(path) as fh:
+                    snap = json.load(fh)
+                if os.path.getmtime(path) < fresh_after:
+                    snap['gauges'] = []
+            except (OSError, ValueError):
+                continue
+            snapshots.append(snap)
+        return snapshots
+
+    # --- Exposition ---
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        counters = collections.defaultdict(float)
+        gauges = collections.defaultdict(float)
+        histograms = {}
+        for snap in self._collect():
+            for name, labels, value in snap['counters']:
+                counters[(name, _labels_key(labels))] += value
+            for name, labels, value in snap['gauges']:
+                gauges[(name, _labels_key(labels))] += value
+            for name, labels, buckets, total, count in snap['histograms']:
+                key = (name, _labels_key(labels))
+                state = histograms.get(key)
+                if state is None:
+                    histograms[key] = [list(buckets), total, count]
+                else:
+                    state[0] = [a + b for a, b in zip(state[0], buckets)]
+                    state[1] += total
+                    state[2] += count
+        lines = []
+        self._render_simple(lines, counters, 'counter')
+        self._render_simple(lines, gauges, 'gauge')
+        for name in sorted({name for name, _ in histograms}):
+            kind, help_text, bounds = self._meta.get(name, ('histogram', '', DEFAULT_BUCKETS))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, n in zip(list(bounds) + ['+Inf'], buckets):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+                lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def _render_simple(self, lines, values, default_kind):
+        for name in sorted({name for name, _ in values}):
+            kind, help_text, _ = self._meta.get(name, (default_kind, '', ()))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+
+
+def _labels_key(labels):
+    return tuple(tuple(pair) for pair in labels)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+gauge = registry.gauge
+describe = registry.describe
+
+describe('http_request_duration_seconds', 'histogram', 'Request latency by route, method and status.')
+describe('db_connect_seconds', 'histogram', 'Time to borrow a pooled connection.')
+describe('db_query_seconds', 'histogram', 'Time a connection is in use (queries and commit) per call site.')
+describe('db_errors_total', 'counter', 'Database blocks that raised, per call site.')
+describe('btc_rate_fetch_seconds', 'histogram', 'Duration of upstream BTC rate requests.')
+describe('btc_rate_fetch_errors_total', 'counter', 'Failed upstream BTC rate requests.')
+describe('ffmpeg_seconds', 'histogram', 'ffmpeg conversion time in the job workers.')
+describe('qr_render_seconds', 'histogram', 'Time to render a QR code on a cache miss.')
+describe('job_duration_seconds', 'histogram', 'Job time from submission to completion by kind and status.')
+
+
+# --- Sampling profiler ---
+class SamplingProfiler:
+    """Samples one thread's stack at a fixed interval into collapsed stacks.
+
+    The output (``frame;frame;frame count`` lines) loads directly into
+    flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, thread_id, interval_ms=PROFILE_INTERVAL_MS):
+        self.thread_id = thread_id
+        self.interval = interval_ms / 1000.0
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return '\n'.join(f'{stack} {count}' for stack, count in self.stacks.most_common()) + '\n'
+
+
+_profiles = collections.OrderedDict()
+_profiles_lock = threading.Lock()
+
+
+def save_profile(text):
+    """Keep a finished profile in memory and return its id."""
+    profile_id = uuid.uuid4().hex
+    with _profiles_lock:
+        _profiles[profile_id] = text
+        while len(_profiles) > PROFILE_KEEP:
+            _profiles.popitem(last=False)
+    return profile_id
+
+
+def get_profile(profile_id):
+    with _profiles_lock:
+        return _profiles.get(profile_id)
@@ -0,0 +1,123 @@
+"""Validation and storage of movement (GPS/accelerometer) samples."""
+
+import math
+import os
+import time
+import uuid
+
+import db
+import movement_analytics
+import movement_blocks
+import response_cache
+
+MOVEMENT_COLUMNS = ('timestamp', 'lat', 'lon', 'gx', 'gy', 'gz')
+# Rows per executemany call; bounds driver buffers for very large uploads
+MOVEMENT_CHUNK_SIZE = int(os.environ.get('MOVEMENT_CHUNK_SIZE', '1000'))
+# 'rows' (one Movement row per sample), 'blocks' (compressed MovementBlocks) or 'both'
+MOVEMENT_STORAGE = os.environ.get('MOVEMENT_STORAGE', 'rows')
+
+# Timestamps are stored as signed 64-bit integers (SQLite INTEGER, BIGINT)
+TIMESTAMP_MIN = -2 ** 63
+TIMESTAMP_MAX = 2 ** 63 - 1
+
+_INSERT_SQL = (
+    'INSERT INTO Movement (timestamp, lat, lon, gx, gy, gz, session_id) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?)'
+)
+
+
+class MovementValidationError(ValueError):
+    """Raised when a posted movement payload cannot be stored."""
+
+
+def _as_float(value, field, index, low=None, high=None):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise MovementValidationError(f'data[{index}].{field} must be a number')
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise MovementValidationError(f'data[{index}].{field} must be a number')
+    if not math.isfinite(value):
+        raise MovementValidationError(f'data[{index}].{field} must be finite')
+    if low is not None and not low <= value <= high:
+        raise MovementValidationError(f'data[{index}].{field} must be between {low} and {high}')
+    return value
+
+
+def coerce_samples(data, session_id=None):
+    """Validate a posted ``data`` array and return rows ready for insertion.
+
+    The whole payload is checked before anything is written, so a bad sample
+    rejects the upload instead of leaving a partial recording behind.
+    """
+    if not isinstance(data, list):
+        raise MovementValidationError('data must be a list')
+    rows = []
+    for index, entry in enumerate(data):
+        if not isinstance(entry, dict):
+            raise MovementValidationError(f'data[{index}] must be an object')
+        timestamp = entry.get('timestamp')
+        if isinstance(timestamp, bool):
+            raise MovementValidationError(f'data[{index}].timestamp must be an integer')
+        try:
+            timestamp = int(timestamp)
+        except (TypeError, ValueError, OverflowError):
+            raise MovementValidationError(f'data[{index}].timestamp must be an integer')
+        if not TIMESTAMP_MIN <= timestamp <= TIMESTAMP_MAX:
+            raise MovementValidationError(
+                f'data[{index}].timestamp must be between {TIMESTAMP_MIN} and {TIMESTAMP_MAX}')
+        rows.append((
+            timestamp,
+            _as_float(entry.get('lat'), 'lat', index, -90.0, 90.0),
+            _as_float(entry.get('lon'), 'lon', index, -180.0, 180.0),
+            _as_float(entry.get('gx'), 'gx', index),
+            _as_float(entry.get('gy'), 'gy', index),
+            _as_float(entry.get('gz'), 'gz', index),
+            session_id,
+        ))
+    return rows
+
+
+def insert_samples(conn, rows, chunk_size=MOVEMENT_CHUNK_SIZE):
+    """Store rows according to ``MOVEMENT_STORAGE``. The caller commits.
+
+    Returns the number of executemany chunks plus blocks written.
+    """
+    chunks = 0
+    if MOVEMENT_STORAGE in ('rows', 'both'):
+        cursor = conn.cursor()
+        if db.is_azure():
+            cursor.fast_executemany = True
+        for start in range(0, len(rows), chunk_size):
+            cursor.executemany(_INSERT_SQL, rows[start:start + chunk_size])
+            chunks += 1
+    if MOVEMENT_STORAGE in ('blocks', 'both') and rows:
+        chunks += movement_blocks.insert_blocks(conn, rows)
+    return chunks
+
+
+def new_session_id():
+    """Return an identifier for a new recording session."""
+    return uuid.uuid4().hex
+
+
+def store_samples(data, session_id=None):
+    """Validate and store a payload in one transaction and report what was done."""
+    started = time.perf_counter()
+    session_id = session_id or new_session_id()
+    rows = coerce_samples(data, session_id)
+    chunks = 0
+    if rows:
+        with db.connection('Recordings') as conn:
+            chunks = insert_samples(conn, rows)
+            conn.commit()
+        movement_analytics.invalidate([session_id])
+        response_cache.bump('movement')
+    return {
+        'session_id': session_id,
+        'rows': len(rows),
+        'chunks': chunks,
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 2),
+    }
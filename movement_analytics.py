@@ -0,0 +1,196 @@
+"""Vectorized per-session movement statistics.
+
+A session's samples are loaded into NumPy arrays (from MovementBlocks when the
+session has any, otherwise from the Movement rows) and summarized: haversine
+distance, instantaneous speed, |g| magnitude and percentile statistics, with
+optional LTTB or min/max downsampling for charts.  Results are memoized per
+session; an entry is reused only while the session's storage fingerprint (row
+count and highest id) is unchanged, and write paths drop entries eagerly.
+NumPy is imported on first use, so write paths that only call
+:func:`invalidate` do not load it.
+"""
+
+import collections
+import threading
+
+import db
+import movement_blocks
+
+EARTH_RADIUS_M = 6371008.8
+DOWNSAMPLE_METHODS = ('lttb', 'minmax')
+_CACHE_LIMIT = 128
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _fingerprint(cursor, session_id):
+    cursor.execute(
+        'SELECT COUNT(*), MAX(id) FROM MovementBlocks WHERE session_id = ?', (session_id,))
+    blocks = tuple(cursor.fetchone())
+    cursor.execute(
+        'SELECT COUNT(*), MAX(id) FROM Movement WHERE session_id = ?', (session_id,))
+    return blocks + tuple(cursor.fetchone())
+
+
+def load_session(session_id):
+    """Return ``(fingerprint, columns)`` with float64 NumPy arrays per column."""
+    import numpy as np
+    with db.connection('Recordings') as conn:
+        cursor = conn.cursor()
+        fingerprint = _fingerprint(cursor, session_id)
+        if fingerprint[0]:
+            columns = None
+        else:
+            cursor.execute(
+                'SELECT timestamp, lat, lon, gx, gy, gz FROM Movement '
+                'WHERE session_id = ? ORDER BY timestamp',
+                (session_id,),
+            )
+            rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 6)
+            columns = {name: rows[:, i] for i, name in enumerate(
+                ('timestamp', 'lat', 'lon', 'gx', 'gy', 'gz'))}
+    if columns is None:
+        blocks = movement_blocks.read_range(session_id)
+        columns = {name: np.frombuffer(values, dtype=values.typecode).astype(np.float64)
+                   for name, values in blocks.items()}
+    return fingerprint, columns
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance in metres between arrays of points in degrees."""
+    import numpy as np
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def describe(values):
+    """Min/max/mean and p50/p95/p99 of the finite values."""
+    import numpy as np
+    values = values[np.isfinite(values)]
+    if not values.size:
+        return None
+    p50, p95, p99 = np.percentile(values, (50, 95, 99))
+    return {
+        'min': float(values.min()),
+        'max': float(values.max()),
+        'mean': float(values.mean()),
+        'p50': float(p50),
+        'p95': float(p95),
+        'p99': float(p99),
+    }
+
+
+def lttb(x, y, points):
+    """Largest-Triangle-Three-Buckets: indices of ``points`` representative samples."""
+    import numpy as np
+    n = len(x)
+    if points >= n:
+        return np.arange(n)
+    if points < 3:
+        # No buckets between the end points
+        return np.asarray([0, n - 1])
+    every = (n - 2) / (points - 2)
+    selected = [0]
+    a = 0
+    for i in range(points - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected.append(a)
+    selected.append(n - 1)
+    return np.asarray(selected)
+
+
+def minmax(y, points):
+    """Indices of the minimum and maximum of ``points // 2`` equal buckets."""
+    import numpy as np
+    n = len(y)
+    if points >= n or points < 2:
+        return np.arange(n)
+    indices = []
+    for bucket in np.array_split(np.arange(n), points // 2):
+        values = y[bucket]
+        indices.extend((bucket[np.argmin(values)], bucket[np.argmax(values)]))
+    return np.unique(indices)
+
+
+def _as_list(values):
+    import numpy as np
+    return [None if not np.isfinite(v) else float(v) for v in values]
+
+
+def summarize(columns, points=None, method='lttb'):
+    """Compute distance, speed and g-force statistics for one session."""
+    import numpy as np
+    timestamps = columns['timestamp']
+    lat, lon = columns['lat'], columns['lon']
+    n = len(timestamps)
+    speed = np.full(n, np.nan)
+    distance = 0.0
+    gps = np.flatnonzero(np.isfinite(lat) & np.isfinite(lon))
+    if gps.size > 1:
+        steps = haversine(lat[gps[:-1]], lon[gps[:-1]], lat[gps[1:]], lon[gps[1:]])
+        dt = np.diff(timestamps[gps]) / 1000.0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed[gps[1:]] = np.where(dt > 0, steps / dt, np.nan)
+        distance = float(steps.sum())
+    g = np.sqrt(columns['gx'] ** 2 + columns['gy'] ** 2 + columns['gz'] ** 2)
+    g_stats = describe(g)
+    result = {
+        'samples': n,
+        'duration_s': float((timestamps[-1] - timestamps[0]) / 1000.0) if n else 0.0,
+        'distance_m': distance,
+        'speed_mps': describe(speed),
+        'g': g_stats,
+        'peak_g': g_stats['max'] if g_stats else None,
+    }
+    if points:
+        target = np.nan_to_num(g if g_stats else speed)
+        if method == 'minmax':
+            index = minmax(target, points)
+        else:
+            index = lttb(timestamps, target, points)
+        result['series'] = {
+            'timestamp': [int(t) for t in timestamps[index]],
+            'lat': _as_list(lat[index]),
+            'lon': _as_list(lon[index]),
+            'speed': _as_list(speed[index]),
+            'g': _as_list(g[index]),
+        }
+    return result
+
+
+def session_analytics(session_id, points=None, method='lttb'):
+    """Return memoized analytics for a session, recomputing after new samples."""
+    key = (session_id, points, method)
+    with _cache_lock:
+        cached = _cache.get(key)
+    if cached is not None:
+        with db.connection('Recordings') as conn:
+            if _fingerprint(conn.cursor(), session_id) == cached[0]:
+                with _cache_lock:
+                    if key in _cache:
+                        _cache.move_to_end(key)
+                return cached[1]
+    fingerprint, columns = load_session(session_id)
+    result = {'session_id': session_id, **summarize(columns, points, method)}
+    with _cache_lock:
+        _cache[key] = (fingerprint, result)
+        _cache.move_to_end(key)
+        while len(_cache) > _CACHE_LIMIT:
+            _cache.popitem(last=False)
+    return result
+
+
+def invalidate(session_ids):
+    """Forget cached analytics for the given sessions."""
+    session_ids = set(session_ids)
+    with _cache_lock:
+        for key in [key for key in _cache if key[0] in session_ids]:
+            del _cache[key]
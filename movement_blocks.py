@@ -0,0 +1,207 @@
+"""Compressed columnar storage for movement time series.
+
+A block holds up to ``MOVEMENT_BLOCK_SAMPLES`` samples of one session:
+
+* ``timestamp`` as delta-encoded int64
+* ``lat`` and ``lon`` as float64
+* ``gx``, ``gy`` and ``gz`` as float32
+
+Each column is byte-shuffled (all first bytes, then all second bytes, ...) so
+slowly changing values compress well, and the whole block is zlib-compressed
+into the ``payload`` blob of the MovementBlocks table.  Missing values are
+stored as NaN.  Decoding returns ``array.array`` columns that can be handed to
+NumPy with ``numpy.frombuffer`` without copying.
+"""
+
+import array
+import bisect
+import math
+import os
+import struct
+import sys
+import zlib
+
+import db
+
+MOVEMENT_BLOCK_SAMPLES = int(os.environ.get('MOVEMENT_BLOCK_SAMPLES', '4096'))
+
+_MAGIC = b'MVB1'
+_HEADER = struct.Struct('<4sI')
+# (column, array typecode) in storage order
+BLOCK_COLUMNS = (
+    ('timestamp', 'q'),
+    ('lat', 'd'),
+    ('lon', 'd'),
+    ('gx', 'f'),
+    ('gy', 'f'),
+    ('gz', 'f'),
+)
+
+_INSERT_SQL = (
+    'INSERT INTO MovementBlocks (session_id, start_ts, end_ts, sample_count, '
+    'min_lat, max_lat, min_lon, max_lon, payload) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+)
+
+
+def _shuffle(raw, itemsize):
+    return b''.join(raw[i::itemsize] for i in range(itemsize))
+
+
+def _unshuffle(data, itemsize, count):
+    out = bytearray(len(data))
+    for i in range(itemsize):
+        out[i::itemsize] = data[i * count:(i + 1) * count]
+    return out
+
+
+def _little_endian(values):
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def encode_block(rows):
+    """Encode ``(timestamp, lat, lon, gx, gy, gz, ...)`` rows into a payload."""
+    rows = sorted(rows, key=lambda row: row[0])
+    timestamps = [row[0] for row in rows]
+    deltas = array.array('q', [timestamps[0]] if timestamps else [])
+    deltas.extend(b - a for a, b in zip(timestamps, timestamps[1:]))
+    columns = [deltas]
+    for index, (_, typecode) in enumerate(BLOCK_COLUMNS[1:], 1):
+        columns.append(array.array(
+            typecode, [math.nan if row[index] is None else row[index] for row in rows]))
+    parts = [_shuffle(_little_endian(col).tobytes(), col.itemsize) for col in columns]
+    return _HEADER.pack(_MAGIC, len(rows)) + zlib.compress(b''.join(parts), 6)
+
+
+def decode_block(payload):
+    """Decode a payload into a dict of ``array.array`` columns."""
+    magic, count = _HEADER.unpack_from(payload)
+    if magic != _MAGIC:
+        raise ValueError('Not a movement block')
+    raw = zlib.decompress(bytes(payload[_HEADER.size:]))
+    columns = {}
+    offset = 0
+    for name, typecode in BLOCK_COLUMNS:
+        values = array.array(typecode)
+        size = values.itemsize * count
+        values.frombytes(bytes(_unshuffle(raw[offset:offset + size], values.itemsize, count)))
+        columns[name] = _little_endian(values)
+        offset += size
+    timestamps = columns['timestamp']
+    for i in range(1, count):
+        timestamps[i] += timestamps[i - 1]
+    return columns
+
+
+def _bounds(values):
+    present = [v for v in values if v is not None]
+    return (min(present), max(present)) if present else (None, None)
+
+
+def insert_blocks(conn, rows, block_samples=MOVEMENT_BLOCK_SAMPLES):
+    """Pack rows (with ``session_id`` as their 7th field) into blocks. The caller commits."""
+    by_session = {}
+    for row in rows:
+        by_session.setdefault(row[6], []).append(row)
+    cursor = conn.cursor()
+    blocks = 0
+    for session_id, session_rows in by_session.items():
+        session_rows.sort(key=lambda row: row[0])
+        for start in range(0, len(session_rows), block_samples):
+            chunk = session_rows[start:start + block_samples]
+            min_lat, max_lat = _bounds(row[1] for row in chunk)
+            min_lon, max_lon = _bounds(row[2] for row in chunk)
+            cursor.execute(_INSERT_SQL, (
+                session_id, chunk[0][0], chunk[-1][0], len(chunk),
+                min_lat, max_lat, min_lon, max_lon, encode_block(chunk),
+            ))
+            blocks += 1
+    return blocks
+
+
+def _select_blocks(cursor, session_id, start_ts, end_ts, columns='id, payload'):
+    conditions, params = ['session_id = ?'], [session_id]
+    if start_ts is not None:
+        conditions.append('end_ts >= ?')
+        params.append(start_ts)
+    if end_ts is not None:
+        conditions.append('start_ts <= ?')
+        params.append(end_ts)
+    cursor.execute(
+        f"SELECT {columns} FROM MovementBlocks WHERE {' AND '.join(conditions)} ORDER BY start_ts, id",
+        params,
+    )
+    return cursor
+
+
+def read_range(session_id, start_ts=None, end_ts=None):
+    """Return the session's columns between two epoch-ms timestamps (inclusive)."""
+    result = {name: array.array(typecode) for name, typecode in BLOCK_COLUMNS}
+    with db.connection('Recordings') as conn:
+        for _, payload in _select_blocks(conn.cursor(), session_id, start_ts, end_ts):
+            block = decode_block(payload)
+            timestamps = block['timestamp']
+            lo = 0 if start_ts is None else bisect.bisect_left(timestamps, start_ts)
+            hi = len(timestamps) if end_ts is None else bisect.bisect_right(timestamps, end_ts)
+            for name, _ in BLOCK_COLUMNS:
+                result[name].extend(block[name][lo:hi])
+    return result
+
+
+def compact_session(session_id, block_samples=MOVEMENT_BLOCK_SAMPLES):
+    """Merge a session's small blocks (e.g. from streamed chunks) into full ones."""
+    with db.connection('Recordings') as conn:
+        cursor = _select_blocks(conn.cursor(), session_id, None, None, 'id, sample_count, payload')
+        blocks = cursor.fetchall()
+        if sum(1 for _, count, _ in blocks if count < block_samples) < 2:
+            return 0
+        rows = []
+        for _, _, payload in blocks:
+            columns = decode_block(payload)
+            for values in zip(*(columns[name] for name, _ in BLOCK_COLUMNS)):
+                rows.append(tuple(None if isinstance(v, float) and math.isnan(v) else v
+                                  for v in values) + (session_id,))
+        cursor.executemany('DELETE FROM MovementBlocks WHERE id = ?', [(block_id,) for block_id, _, _ in blocks])
+        written = insert_blocks(conn, rows, block_samples)
+        conn.commit()
+    return written
+
+
+def pack_rows(session_id=None):
+    """Copy row-per-sample Movement data into blocks, one session at a time.
+
+    Sessions that already have blocks are skipped.  Returns the number of
+    sessions packed.
+    """
+    with db.connection('Recordings') as conn:
+        cursor = conn.cursor()
+        if session_id is None:
+            cursor.execute(
+                'SELECT DISTINCT session_id FROM Movement WHERE session_id IS NOT NULL '
+                'AND session_id NOT IN (SELECT session_id FROM MovementBlocks)'
+            )
+            sessions = [row[0] for row in cursor.fetchall()]
+        else:
+            cursor.execute('SELECT 1 FROM MovementBlocks WHERE session_id = ?', (session_id,))
+            sessions = [] if cursor.fetchone() else [session_id]
+        for sid in sessions:
+            cursor.execute(
+                'SELECT timestamp, lat, lon, gx, gy, gz, session_id FROM Movement '
+                'WHERE session_id = ? ORDER BY timestamp',
+                (sid,),
+            )
+            insert_blocks(conn, [tuple(row) for row in cursor.fetchall()])
+            conn.commit()
+    return len(sessions)
+
+
+def columns_to_json(columns):
+    """Turn decoded columns into JSON-safe lists (NaN becomes null)."""
+    out = {}
+    for name, values in columns.items():
+        if name == 'timestamp':
+            out[name] = list(values)
+        else:
+            out[name] = [None if math.isnan(v) else v for v in values]
+    return out
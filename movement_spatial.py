@@ -0,0 +1,186 @@
+"""Bounding-box queries and per-tile point counts over Movement.
+
+Movement points are indexed by an R*Tree (``MovementRtree``) on SQLite and by
+a spatial index on the persisted ``geo`` column on Azure SQL.  The database
+maintains both on every insert and delete, whichever path wrote the rows.
+``bbox_conditions`` adds the index lookup to a page query, and ``grid``
+counts points per Web Mercator map tile at a zoom level, so a map view costs
+the points inside the viewport instead of the whole history.  Without either
+index the same queries filter on lat/lon.  Sessions stored only as
+MovementBlocks are not indexed.
+"""
+
+import collections
+import math
+import os
+import sqlite3
+
+import db
+import pagination
+
+MOVEMENT_GRID_MAX_CELLS = int(os.environ.get('MOVEMENT_GRID_MAX_CELLS', '4096'))
+MAX_ZOOM = 24
+# Web Mercator tiles end at this latitude
+MAX_MERCATOR_LAT = 85.0511287798066
+
+_spatial_backend = None
+
+
+def spatial_backend():
+    """Return ``'rtree'``, ``'spatial'`` or ``'scan'`` for this database."""
+    global _spatial_backend
+    if _spatial_backend is None:
+        with db.connection('Recordings') as conn:
+            cursor = conn.cursor()
+            if db.is_azure():
+                cursor.execute("SELECT 1 FROM sys.spatial_indexes WHERE name = 'sx_movement_geo'")
+                _spatial_backend = 'spatial' if cursor.fetchone() else 'scan'
+            else:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='MovementRtree'")
+                _spatial_backend = 'rtree' if cursor.fetchone() else 'scan'
+    return _spatial_backend
+
+
+def parse_bbox(value):
+    """Parse ``west,south,east,north`` in degrees.
+
+    ``west`` greater than ``east`` is a box crossing the antimeridian.
+    """
+    if not value:
+        raise pagination.PaginationError('bbox is required as west,south,east,north')
+    try:
+        west, south, east, north = (float(part) for part in value.split(','))
+    except ValueError:
+        raise pagination.PaginationError('bbox must be four numbers: west,south,east,north')
+    if not (-180.0 <= west <= 180.0 and -180.0 <= east <= 180.0):
+        raise pagination.PaginationError('bbox longitudes must be between -180 and 180')
+    if not -90.0 <= south <= north <= 90.0:
+        raise pagination.PaginationError('bbox latitudes must be between -90 and 90 with south <= north')
+    return west, south, east, north
+
+
+def _lon_ranges(west, east):
+    return [(west, east)] if west <= east else [(west, 180.0), (-180.0, east)]
+
+
+def _wkt(south, north, ranges):
+    rings = [f'(({w} {south}, {e} {south}, {e} {north}, {w} {north}, {w} {south}))' for w, e in ranges]
+    if len(rings) == 1:
+        return f'POLYGON{rings[0]}'
+    return f"MULTIPOLYGON({', '.join(rings)})"
+
+
+def bbox_conditions(bbox):
+    """Return ``(conditions, params)`` selecting Movement rows inside ``bbox``."""
+    west, south, east, north = bbox
+    ranges = _lon_ranges(west, east)
+    conditions, params = [], []
+    backend = spatial_backend()
+    if backend == 'rtree':
+        lookup = ' UNION ALL '.join(
+            ['SELECT id FROM MovementRtree WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?']
+            * len(ranges)
+        )
+        conditions.append(f'id IN ({lookup})')
+        for low, high in ranges:
+            params.extend((south, north, low, high))
+    elif backend == 'spatial':
+        conditions.append('geo.STIntersects(geometry::STGeomFromText(?, 0)) = 1')
+        params.append(_wkt(south, north, ranges))
+    # Exact bounds: the R*Tree stores 32-bit floats rounded outwards
+    conditions.append('lat BETWEEN ? AND ?')
+    params.extend((south, north))
+    conditions.append('(' + ' OR '.join(['lon BETWEEN ? AND ?'] * len(ranges)) + ')')
+    for low, high in ranges:
+        params.extend((low, high))
+    return conditions, params
+
+
+# --- Tiles ---
+def tile_x(lon, zoom):
+    n = 2 ** zoom
+    return min(max(int(math.floor((lon + 180.0) / 360.0 * n)), 0), n - 1)
+
+
+def tile_y(lat, zoom):
+    n = 2 ** zoom
+    lat = min(max(lat, -MAX_MERCATOR_LAT), MAX_MERCATOR_LAT)
+    y = (1.0 - math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)) / math.pi) / 2.0 * n
+    return min(max(int(math.floor(y)), 0), n - 1)
+
+
+def tile_bounds(zoom, x, y):
+    """Return ``[west, south, east, north]`` of a tile in degrees."""
+    n = 2 ** zoom
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return [x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)]
+
+
+def _cell_sql(lat, lon, zoom):
+    """SQL expressions for a point's tile x and y, as in ``tile_x``/``tile_y``."""
+    n = f'{2 ** zoom}.0'
+    ln = 'LOG' if db.is_azure() else 'ln'
+    x = f'FLOOR(({lon} + 180.0) / 360.0 * {n})'
+    y = f'FLOOR((1.0 - {ln}(TAN(PI() / 4 + RADIANS({lat}) / 2)) / PI()) / 2.0 * {n})'
+    return x, y
+
+
+def _ensure_math(conn):
+    """Register SQL math functions on SQLite builds compiled without them."""
+    try:
+        conn.execute('SELECT ln(1), tan(0), pi(), radians(0), floor(0.5)').fetchall()
+    except sqlite3.OperationalError:
+        for name, fn in (('ln', math.log), ('tan', math.tan), ('radians', math.radians), ('floor', math.floor)):
+            conn.create_function(name, 1, fn, deterministic=True)
+        conn.create_function('pi', 0, lambda: math.pi, deterministic=True)
+
+
+def grid(bbox, zoom, start_ms=None, end_ms=None):
+    """Count points per tile at ``zoom`` inside ``bbox``.
+
+    Returns ``[(x, y, count)]`` for the tiles that have points, sorted by
+    ``(x, y)``.  Boxes spanning more than ``MOVEMENT_GRID_MAX_CELLS`` tiles
+    are refused.
+    """
+    if not 0 <= zoom <= MAX_ZOOM:
+        raise pagination.PaginationError(f'zoom must be between 0 and {MAX_ZOOM}')
+    west, south, east, north = bbox
+    south, north = max(south, -MAX_MERCATOR_LAT), min(north, MAX_MERCATOR_LAT)
+    ranges = _lon_ranges(west, east)
+    columns = sum(tile_x(high, zoom) - tile_x(low, zoom) + 1 for low, high in ranges)
+    rows = tile_y(south, zoom) - tile_y(north, zoom) + 1
+    if columns * rows > MOVEMENT_GRID_MAX_CELLS:
+        raise pagination.PaginationError(
+            f'bbox spans {columns * rows} tiles at zoom {zoom}; '
+            f'the limit is {MOVEMENT_GRID_MAX_CELLS}, use a lower zoom'
+        )
+    time_conditions, time_params = [], []
+    if start_ms is not None:
+        time_conditions.append('timestamp >= ?')
+        time_params.append(start_ms)
+    if end_ms is not None:
+        time_conditions.append('timestamp <= ?')
+        time_params.append(end_ms)
+
+    counts = collections.Counter()
+    x, y = _cell_sql('lat', 'lon', zoom)
+    with db.connection('Recordings') as conn:
+        cursor = conn.cursor()
+        if not db.is_azure():
+            _ensure_math(conn)
+        for low, high in ranges:
+            # The index finds candidate rows; Movement has the exact coordinates
+            conditions, params = bbox_conditions((low, south, high, north))
+            sql = (
+                f'SELECT x, y, COUNT(*) FROM (SELECT {x} AS x, {y} AS y FROM Movement '
+                f"WHERE {' AND '.join(conditions + time_conditions)}) AS cells GROUP BY x, y"
+            )
+            cursor.execute(sql, params + time_params)
+            n = 2 ** zoom
+            for cell_x, cell_y, count in cursor.fetchall():
+                # Points exactly on the east or south edge of the world
+                counts[(min(int(cell_x), n - 1), min(max(int(cell_y), 0), n - 1))] += count
+    return sorted((x, y, count) for (x, y), count in counts.items())
@@ -0,0 +1,272 @@
+"""Incremental movement uploads: numbered chunks per recording session.
+
+Clients post small chunks while recording, each tagged with a session id and a
+sequence number.  Accepted chunks are kept in a write-behind buffer and written
+in one transaction per flush, either every ``MOVEMENT_FLUSH_INTERVAL_MS`` or as
+soon as ``MOVEMENT_BUFFER_ROWS`` samples are waiting.  The MovementChunks table
+records which sequence numbers were stored, so resent chunks are ignored even
+when they reach a different worker.
+
+When a flush fails its chunks are written one transaction each, so one chunk
+cannot hold back the others.  A chunk that still fails is retried on later
+flushes; after ``MOVEMENT_CHUNK_MAX_ATTEMPTS`` it is appended to
+``MOVEMENT_PARKED_FILE`` and logged instead.
+"""
+
+import atexit
+import collections
+import datetime
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import db
+import movement
+import movement_analytics
+import response_cache
+
+MOVEMENT_FLUSH_INTERVAL_MS = int(os.environ.get('MOVEMENT_FLUSH_INTERVAL_MS', '1000'))
+MOVEMENT_BUFFER_ROWS = int(os.environ.get('MOVEMENT_BUFFER_ROWS', '5000'))
+# Largest chunk a single request may carry
+MOVEMENT_MAX_CHUNK_SAMPLES = int(os.environ.get('MOVEMENT_MAX_CHUNK_SAMPLES', '2000'))
+# Failed writes of one chunk before it is parked
+MOVEMENT_CHUNK_MAX_ATTEMPTS = int(os.environ.get('MOVEMENT_CHUNK_MAX_ATTEMPTS', '10'))
+MOVEMENT_PARKED_FILE = os.environ.get('MOVEMENT_PARKED_FILE', 'movement_parked.ndjson')
+# Recently accepted (session, seq) pairs remembered for fast duplicate replies
+_SEEN_LIMIT = 10000
+
+logger = logging.getLogger(__name__)
+
+_SESSION_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+_CLAIM_SQL = (
+    'INSERT INTO MovementChunks (session_id, seq, row_count, received_at) '
+    'SELECT ?, ?, ?, ? WHERE NOT EXISTS '
+    '(SELECT 1 FROM MovementChunks WHERE session_id = ? AND seq = ?)'
+)
+
+
+def validate_session_id(session_id):
+    if not isinstance(session_id, str) or not _SESSION_RE.match(session_id):
+        raise movement.MovementValidationError('session_id must be 1-64 letters, digits, "-" or "_"')
+    return session_id
+
+
+def validate_seq(seq):
+    if isinstance(seq, bool):
+        raise movement.MovementValidationError('seq must be a non-negative integer')
+    try:
+        seq = int(seq)
+    except (TypeError, ValueError):
+        raise movement.MovementValidationError('seq must be a non-negative integer')
+    if seq < 0:
+        raise movement.MovementValidationError('seq must be a non-negative integer')
+    return seq
+
+
+def check_chunk_size(samples):
+    if isinstance(samples, list) and len(samples) > MOVEMENT_MAX_CHUNK_SAMPLES:
+        raise movement.MovementValidationError(
+            f'a chunk may hold at most {MOVEMENT_MAX_CHUNK_SAMPLES} samples')
+    return samples
+
+
+def parse_ndjson(lines):
+    """Decode an NDJSON body of samples, one JSON object per line."""
+    samples = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            samples.append(json.loads(line))
+        except ValueError:
+            raise movement.MovementValidationError(f'line {number} is not valid JSON')
+        check_chunk_size(samples)
+    return samples
+
+
+class MovementFlushError(Exception):
+    """Raised by ``flush`` when chunks could not be written.
+
+    ``retrying`` and ``parked`` hold the ``(session_id, seq)`` of chunks that
+    stay queued and of chunks that were given up on.
+    """
+
+    def __init__(self, retrying, parked):
+        super().__init__(f'{len(retrying) + len(parked)} movement chunk(s) could not be written')
+        self.retrying = retrying
+        self.parked = parked
+
+    def seqs(self, session_id, parked=False):
+        return [seq for sid, seq in (self.parked if parked else self.retrying) if sid == session_id]
+
+
+class MovementBuffer:
+    """Write-behind buffer for movement chunks with background flushing."""
+
+    def __init__(self, flush_interval_ms=MOVEMENT_FLUSH_INTERVAL_MS, max_rows=MOVEMENT_BUFFER_ROWS):
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_rows = max_rows
+        self.flushed_chunks = 0
+        self.duplicate_chunks = 0
+        self.failed_flushes = 0
+        self.parked_chunks = 0
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._pending = []
+        self._pending_rows = 0
+        self._seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_flusher(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run, name='movement-flusher', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def add(self, session_id, seq, samples):
+        """Validate and queue a chunk. Returns False if it was already accepted.
+
+        Raises ``MovementValidationError`` before anything is queued, so the
+        client that sent a bad chunk gets the error.
+        """
+        session_id = validate_session_id(session_id)
+        seq = validate_seq(seq)
+        rows = movement.coerce_samples(check_chunk_size(samples), session_id)
+        self._ensure_flusher()
+        key = (session_id, seq)
+        with self._lock:
+            if key in self._seen:
+                self.duplicate_chunks += 1
+                return False
+            self._seen[key] = None
+            if len(self._seen) > _SEEN_LIMIT:
+                self._seen.popitem(last=False)
+            self._pending.append((session_id, seq, rows, 0))
+            self._pending_rows += len(rows)
+            full = self._pending_rows >= self.max_rows
+        if full:
+            # Back-pressure: the request that fills the buffer pays for the flush
+            try:
+                self.flush()
+            except Exception:
+                pass
+        return True
+
+    def pending_rows(self):
+        return self._pending_rows
+
+    def flush(self):
+        """Write every pending chunk, in one transaction while that succeeds.
+
+        Returns the number of chunks written.  Raises ``MovementFlushError``
+        listing the chunks that failed; the others are stored regardless.
+        """
+        with self._flush_lock:
+            with self._lock:
+                chunks, self._pending, self._pending_rows = self._pending, [], 0
+            if not chunks:
+                return 0
+            retrying, parked = [], []
+            try:
+                written = self._write(chunks)
+            except Exception:
+                self.failed_flushes += 1
+                written = 0
+                for chunk in chunks:
+                    try:
+                        written += self._write([chunk])
+                    except Exception as exc:
+                        if self._retry_or_park(chunk, exc):
+                            retrying.append(chunk[:2])
+                        else:
+                            parked.append(chunk[:2])
+            self.flushed_chunks += written
+            if retrying or parked:
+                raise MovementFlushError(retrying, parked)
+            return written
+
+    def _retry_or_park(self, chunk, exc):
+        """Requeue a chunk whose write failed; returns False once it is parked."""
+        session_id, seq, rows, attempts = chunk
+        attempts += 1
+        if attempts < MOVEMENT_CHUNK_MAX_ATTEMPTS:
+            with self._lock:
+                self._pending.append((session_id, seq, rows, attempts))
+                self._pending_rows += len(rows)
+            return True
+        logger.error(f'Parking movement chunk {session_id}/{seq} after {attempts} failed writes: {exc!r}')
+        with open(MOVEMENT_PARKED_FILE, 'a') as fh:
+            fh.write(json.dumps({
+                'session_id': session_id, 'seq': seq, 'error': repr(exc),
+                'data': [dict(zip(movement.MOVEMENT_COLUMNS, row)) for row in rows],
+            }) + '\n')
+        self.parked_chunks += 1
+        with self._lock:
+            # A resend of the chunk is accepted again
+            self._seen.pop((session_id, seq), None)
+        return False
+
+    def _write(self, chunks):
+        now = datetime.datetime.now().isoformat()
+        written = 0
+        with db.connection('Recordings') as conn:
+            cursor = conn.cursor()
+            rows = []
+            for session_id, seq, chunk_rows, _ in chunks:
+                cursor.execute(_CLAIM_SQL, (session_id, seq, len(chunk_rows), now, session_id, seq))
+                if cursor.rowcount == 0:
+                    self.duplicate_chunks += 1
+                    continue
+                rows.extend(chunk_rows)
+                written += 1
+            movement.insert_samples(conn, rows)
+            conn.commit()
+        movement_analytics.invalidate(chunk[0] for chunk in chunks)
+        response_cache.bump('movement')
+        return written
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                # Failed chunks stay queued and are retried on the next tick
+                pass
+
+    def close(self):
+        if self._pid == os.getpid():
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+
+buffer = MovementBuffer()
+atexit.register(buffer.close)
+
+
+def session_summary(session_id):
+    """Return stored sample and chunk counts for a session."""
+    with db.connection('Recordings') as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT COUNT(*), COALESCE(SUM(row_count), 0), MAX(seq) FROM MovementChunks WHERE session_id = ?',
+            (session_id,),
+        )
+        chunks, rows, last_seq = cursor.fetchone()
+    return {'session_id': session_id, 'chunks': chunks, 'rows': rows, 'last_seq': last_seq}
@@ -0,0 +1,135 @@
+"""Checkout orders, one Purchases row per order.
+
+``create`` inserts the order once, at checkout, under a random order id.
+``reprice`` updates the BTC amount, rate and tx_hash of that row in place,
+so repeated "update payment" clicks never add rows.  The tx_hash is derived
+from the order id and the BTC amount: repricing at an unchanged amount
+returns the same hash, and only a new rate is stored.  Unique indexes on ``order_id`` and
+``tx_hash`` make both lookups index seeks.
+"""
+
+import datetime
+import hashlib
+import re
+import uuid
+
+import db
+
+PRICES_EUR = {'apples': 1, 'bananas': 2}
+MAX_QUANTITY = 10000
+
+_ORDER_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+_TX_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+_COLUMNS = (
+    'order_id', 'timestamp', 'updated_at', 'apples', 'bananas', 'name', 'address', 'email',
+    'total_eur', 'total_btc', 'btc_rate', 'tx_hash',
+)
+_SELECT_SQL = f"SELECT {', '.join(_COLUMNS)} FROM Purchases WHERE "
+
+
+class OrderError(Exception):
+    """Raised for invalid order input or unknown orders."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def quantity(value, field):
+    try:
+        value = int(value or 0)
+    except (TypeError, ValueError):
+        raise OrderError(f'{field} must be a whole number')
+    if not 0 <= value <= MAX_QUANTITY:
+        raise OrderError(f'{field} must be between 0 and {MAX_QUANTITY}')
+    return value
+
+
+def validate_order_id(order_id):
+    if not isinstance(order_id, str) or not _ORDER_ID_RE.match(order_id):
+        raise OrderError('order_id must be 32 hexadecimal characters')
+    return order_id
+
+
+def validate_tx_hash(tx_hash):
+    if not isinstance(tx_hash, str) or not _TX_HASH_RE.match(tx_hash):
+        raise OrderError('tx_hash must be 64 hexadecimal characters')
+    return tx_hash
+
+
+def total_btc(total_eur, rate):
+    return round(total_eur / rate, 8)
+
+
+def tx_hash_for(order_id, amount_btc):
+    return hashlib.sha256(f'{order_id}|{amount_btc:.8f}'.encode()).hexdigest()
+
+
+def create(apples, bananas, name, address, email, rate):
+    """Store a new order priced at ``rate`` and return it as a dict."""
+    now = datetime.datetime.now().isoformat()
+    order_id = uuid.uuid4().hex
+    total_eur = apples * PRICES_EUR['apples'] + bananas * PRICES_EUR['bananas']
+    amount_btc = total_btc(total_eur, rate)
+    order = dict(zip(_COLUMNS, (
+        order_id, now, now, apples, bananas, name, address, email,
+        total_eur, amount_btc, rate, tx_hash_for(order_id, amount_btc),
+    )))
+    with db.connection('Purchases') as conn:
+        conn.cursor().execute(
+            f"INSERT INTO Purchases ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})",
+            tuple(order.values()),
+        )
+        conn.commit()
+    return order
+
+
+def reprice(order_id, rate):
+    """Update amount, rate and tx_hash of an order in place.
+
+    Returns ``(order, changed)``, where ``changed`` means the amount and so
+    the tx_hash moved.  A new rate at the same amount is stored but does not
+    count as a change; nothing is written when neither differs.
+    """
+    validate_order_id(order_id)
+    with db.connection('Purchases') as conn:
+        cursor = conn.cursor()
+        order = _fetch(cursor, 'order_id = ?', order_id)
+        if order is None:
+            raise OrderError(f'unknown order {order_id}', status=404)
+        amount_btc = total_btc(order['total_eur'], rate)
+        changed = amount_btc != order['total_btc']
+        if not changed and rate == order['btc_rate']:
+            return order, False
+        order.update(
+            total_btc=amount_btc,
+            btc_rate=rate,
+            tx_hash=tx_hash_for(order_id, amount_btc) if changed else order['tx_hash'],
+            updated_at=datetime.datetime.now().isoformat(),
+        )
+        cursor.execute(
+            'UPDATE Purchases SET total_btc = ?, btc_rate = ?, tx_hash = ?, updated_at = ? WHERE order_id = ?',
+            (order['total_btc'], order['btc_rate'], order['tx_hash'], order['updated_at'], order_id),
+        )
+        conn.commit()
+    return order, changed
+
+
+def _fetch(cursor, where, value):
+    cursor.execute(_SELECT_SQL + where, (value,))
+    row = cursor.fetchone()
+    return dict(zip(_COLUMNS, row)) if row is not None else None
+
+
+def get(order_id):
+    """Return the order with this id, or None."""
+    validate_order_id(order_id)
+    with db.connection('Purchases') as conn:
+        return _fetch(conn.cursor(), 'order_id = ?', order_id)
+
+
+def find_by_tx_hash(tx_hash):
+    """Return the order currently holding ``tx_hash``, or None."""
+    validate_tx_hash(tx_hash)
+    with db.connection('Purchases') as conn:
+        return _fetch(conn.cursor(), 'tx_hash = ?', tx_hash)
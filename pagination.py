@@ -0,0 +1,109 @@
+"""Keyset pagination and streamed JSON responses for list endpoints."""
+
+import datetime
+import json
+import sys
+
+from flask import Response
+
+import db
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+# Rows pulled from the cursor per fetchmany call while streaming
+FETCH_SIZE = 256
+
+
+class PaginationError(ValueError):
+    """Raised for malformed pagination or filter query arguments."""
+
+
+def int_arg(args, name, default=None):
+    """Return an integer query argument, rejecting malformed values."""
+    value = args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise PaginationError(f'{name} must be an integer')
+
+
+def parse_page_args(args, default_limit=DEFAULT_PAGE_SIZE, max_limit=MAX_PAGE_SIZE):
+    """Return ``(before_id, limit)`` from ``?before_id=&limit=``."""
+    before_id = int_arg(args, 'before_id')
+    limit = int_arg(args, 'limit', default_limit)
+    if limit < 1:
+        raise PaginationError('limit must be positive')
+    return before_id, min(limit, max_limit)
+
+
+def parse_time_arg(value, name):
+    """Parse epoch milliseconds or an ISO 8601 string into a datetime."""
+    if value is None or value == '':
+        return None
+    try:
+        millis = int(value)
+    except ValueError:
+        millis = None
+    try:
+        if millis is not None:
+            return datetime.datetime.fromtimestamp(millis / 1000.0)
+        moment = datetime.datetime.fromisoformat(value)
+        # Callers convert back to epoch milliseconds
+        moment.timestamp()
+        return moment
+    except (ValueError, OverflowError, OSError):
+        raise PaginationError(f'{name} must be epoch milliseconds or an ISO 8601 timestamp in range')
+
+
+def epoch_ms(moment):
+    """Convert a naive local datetime into epoch milliseconds."""
+    return int(moment.timestamp() * 1000)
+
+
+def page_sql(columns, table, conditions, limit):
+    """Build a dialect-specific ``SELECT`` for one page ordered by id descending."""
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+    cols = ', '.join(columns)
+    if db.is_azure():
+        return f'SELECT TOP {int(limit)} {cols} FROM {table}{where} ORDER BY id DESC'
+    return f'SELECT {cols} FROM {table}{where} ORDER BY id DESC LIMIT {int(limit)}'
+
+
+def stream_page(db_name, sql, params, columns, limit, key='records'):
+    """Execute ``sql`` and stream its rows as ``{key: [...], next_before_id: n}``.
+
+    Rows are serialized as they are fetched, so memory use does not depend on
+    the page size.  ``columns`` must start with ``id``; it drives the cursor
+    for the next page, which is ``null`` once the last page is reached.
+    """
+    ctx = db.connection(db_name, site=sys._getframe(1).f_code.co_name)
+    conn = ctx.__enter__()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+    except BaseException:
+        ctx.__exit__(*sys.exc_info())
+        raise
+
+    def generate():
+        yield f'{{{json.dumps(key)}:['
+        count = 0
+        last_id = None
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            parts = []
+            for row in rows:
+                parts.append(json.dumps(dict(zip(columns, row)), default=str))
+            last_id = rows[-1][0]
+            yield (',' if count else '') + ','.join(parts)
+            count += len(rows)
+        next_before_id = last_id if count == limit else None
+        yield f'],"next_before_id":{json.dumps(next_before_id)}}}'
+
+    response = Response(generate(), mimetype='application/json')
+    response.call_on_close(lambda: ctx.__exit__(None, None, None))
+    return response
@@ -0,0 +1,223 @@
+"""Content-addressed cache of rendered QR code PNGs.
+
+Images are keyed by a SHA-256 of (payload, error correction, box size,
+border), so identical payloads are rendered once.  Recently used images are
+kept in a size-bounded in-memory LRU; every image is also written to
+``static/qrcodes/<key>.png``, and the directory is trimmed back to
+``QR_DISK_CACHE_BYTES`` by evicting the least recently used files.
+"""
+
+import collections
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+
+import metrics
+
+QR_DIR = os.path.join('static', 'qrcodes')
+QR_MEMORY_CACHE_BYTES = int(os.environ.get('QR_MEMORY_CACHE_BYTES', str(8 * 1024 * 1024)))
+QR_DISK_CACHE_BYTES = int(os.environ.get('QR_DISK_CACHE_BYTES', str(64 * 1024 * 1024)))
+# Temp files older than this were left behind by an interrupted write
+_TMP_MAX_AGE = 3600
+
+# Level -> qrcode.constants name; qrcode (and PIL) load on the first render
+ERROR_CORRECTION = {
+    'L': 'ERROR_CORRECT_L',
+    'M': 'ERROR_CORRECT_M',
+    'Q': 'ERROR_CORRECT_Q',
+    'H': 'ERROR_CORRECT_H',
+}
+
+
+def create_qr_code(data, error_correction='H', box_size=10, border=4):
+    """Render a QR code and return it as PNG bytes."""
+    import qrcode
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=getattr(qrcode.constants, ERROR_CORRECTION[error_correction]),
+        box_size=box_size,
+        border=border,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    out = io.BytesIO()
+    img.save(out, format='PNG')
+    return out.getvalue()
+
+
+def cache_key(data, error_correction='H', box_size=10, border=4):
+    """Return the content address for a QR code rendering."""
+    material = json.dumps([data, error_correction, box_size, border], ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class QRCache:
+    """Two-level (memory LRU + disk) cache of QR PNGs with hit/miss counters."""
+
+    def __init__(self, directory=QR_DIR, memory_bytes=QR_MEMORY_CACHE_BYTES, disk_bytes=QR_DISK_CACHE_BYTES):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory = collections.OrderedDict()
+        self._memory_size = 0
+        self._disk_size = None
+        self._lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.png')
+
+    def _remember(self, key, png):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = png
+            self._memory_size += len(png)
+            while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+                _, old = self._memory.popitem(last=False)
+                self._memory_size -= len(old)
+                self.stats['memory_evictions'] += 1
+
+    def memory(self, key):
+        """Return PNG bytes for ``key`` from the memory LRU only, or None."""
+        with self._lock:
+            png = self._memory.get(key)
+            if png is not None:
+                self._memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+            return png
+
+    def lookup(self, key):
+        """Return cached PNG bytes for ``key`` or None, without rendering."""
+        png = self.memory(key)
+        if png is not None:
+            return png
+        try:
+            with open(self.path(key), 'rb') as fh:
+                png = fh.read()
+            # Refresh mtime so disk eviction is least-recently-used
+            os.utime(self.path(key))
+        except OSError:
+            return None
+        self.stats['disk_hits'] += 1
+        self._remember(key, png)
+        return png
+
+    def touch(self, key):
+        """Mark the disk copy of ``key`` as used; return False if it is not on disk."""
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            return False
+        self.stats['disk_hits'] += 1
+        return True
+
+    def get(self, data, error_correction='H', box_size=10, border=4):
+        """Return ``(key, png_bytes)``, rendering and storing on a miss."""
+        key = cache_key(data, error_correction, box_size, border)
+        png = self.lookup(key)
+        if png is not None:
+            return key, png
+        self.stats['misses'] += 1
+        with metrics.timer('qr_render_seconds'):
+            png = create_qr_code(data, error_correction, box_size, border)
+        self._remember(key, png)
+        self._write(key, png)
+        return key, png
+
+    def _write(self, key, png):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f'{self.path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as fh:
+            fh.write(png)
+        os.replace(tmp_path, self.path(key))
+        with self._lock:
+            if self._disk_size is not None:
+                self._disk_size += len(png)
+            over = self._disk_size is None or self._disk_size > self.disk_bytes
+        if over:
+            self.evict_disk()
+
+    def evict_disk(self):
+        """Delete least recently used PNGs until the directory fits the cap."""
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+        for name in names:
+            if not name.endswith('.png'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        if total > self.disk_bytes:
+            # Trim to 90% so the next few writes do not trigger another scan
+            target = self.disk_bytes * 0.9
+            for _, size, name in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                total -= size
+                self.stats['disk_evictions'] += 1
+        with self._lock:
+            self._disk_size = total
+
+    def prune(self, max_idle_seconds):
+        """Delete PNGs not served for ``max_idle_seconds`` and stray temp files.
+
+        Disk lookups refresh a file's mtime and images in the memory LRU are
+        kept, so only images nobody asked for in that time are removed.
+        Returns ``(files_removed, bytes_freed)``.
+        """
+        removed = freed = 0
+        now = time.time()
+        with self._lock:
+            in_memory = {f'{key}.png' for key in self._memory}
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return 0, 0
+        for entry in entries:
+            if entry.name in in_memory:
+                continue
+            if entry.name.endswith('.png'):
+                max_age = max_idle_seconds
+            elif entry.name.endswith('.tmp'):
+                max_age = _TMP_MAX_AGE
+            else:
+                continue
+            try:
+                st = entry.stat()
+                if now - st.st_mtime < max_age:
+                    continue
+                os.remove(entry.path)
+            except OSError:
+                continue
+            removed += 1
+            freed += st.st_size
+        self.evict_disk()
+        return removed, freed
+
+    def metrics(self):
+        with self._lock:
+            return {
+                **self.stats,
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_size,
+                'disk_bytes': self._disk_size,
+            }
+
+
+cache = QRCache()
@@ -0,0 +1,306 @@
+"""Cache of rendered read-route responses, invalidated by write versions.
+
+Routes decorated with ``cached(*scopes)`` are keyed by endpoint, query
+arguments and the current version of each scope they read.  Write paths call
+``bump(scope)`` after committing, which increments a counter in
+``RESPONSE_VERSION_FILE``.  Every worker reads the same file (one ``pread``
+per request), so no worker serves a listing from before a write it depends
+on; outdated entries are never looked up again and age out of the LRU.
+
+Each entry keeps the body, a strong ETag over it and its compressed variants,
+made once on first use: gzip always, brotli when the ``brotli`` package is
+installed.  A matching ``If-None-Match`` is answered with ``304``.
+"""
+
+import collections
+import fcntl
+import gzip
+import hashlib
+import os
+import struct
+import threading
+from functools import wraps
+
+from flask import Response, make_response, request
+
+import metrics
+
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', '1') == '1'
+RESPONSE_CACHE_BYTES = int(os.environ.get('RESPONSE_CACHE_BYTES', str(32 * 1024 * 1024)))
+# Larger bodies are served but not kept
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRY_BYTES', str(4 * 1024 * 1024)))
+# Smaller bodies are sent uncompressed
+RESPONSE_COMPRESS_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESS_MIN_BYTES', '1024'))
+RESPONSE_VERSION_FILE = os.environ.get('RESPONSE_VERSION_FILE', 'response_versions.bin')
+
+# One 8-byte counter per scope, at a fixed offset in the version file
+SCOPES = ('recordings', 'media', 'movement')
+_SLOT = struct.Struct('<Q')
+
+metrics.describe('response_cache_requests_total', 'counter', 'Cached-route requests by result (hit, miss, not_modified, bypass).')
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+# Content-Encoding -> compress(bytes); br is offered only when brotli imports
+ENCODERS = {
+    'br': lambda body: _brotli().compress(body, quality=5),
+    'gzip': lambda body: gzip.compress(body, compresslevel=6, mtime=0),
+}
+
+
+# --- Versions ---
+class VersionFile:
+    """Per-scope write counters in a small file shared by all workers."""
+
+    def __init__(self, path=RESPONSE_VERSION_FILE, scopes=SCOPES):
+        self.path = path
+        self.scopes = scopes
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # flock does not exclude threads sharing the descriptor
+        self._bump_lock = threading.Lock()
+
+    def _open(self):
+        if self._pid == os.getpid():
+            return self._fd
+        with self._lock:
+            if self._pid != os.getpid():
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                size = _SLOT.size * len(self.scopes)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    have = os.fstat(fd).st_size
+                    if have < size:
+                        # Random starting points: a recreated file never
+                        # repeats versions that older workers cached under
+                        os.pwrite(fd, os.urandom(size - have), have)
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                # flock is per open file description: a descriptor inherited
+                # across fork would share the parent's lock, so reopen
+                if self._fd is not None:
+                    os.close(self._fd)
+                self._fd, self._pid = fd, os.getpid()
+        return self._fd
+
+    def read(self, scopes=None):
+        """Return the current versions of ``scopes`` (default: all) as a tuple."""
+        data = os.pread(self._open(), _SLOT.size * len(self.scopes), 0)
+        versions = dict(zip(self.scopes, (v for (v,) in _SLOT.iter_unpack(data))))
+        return tuple(versions[scope] for scope in (scopes or self.scopes))
+
+    def bump(self, scope):
+        """Invalidate every cached response that depends on ``scope``."""
+        fd = self._open()
+        offset = self.scopes.index(scope) * _SLOT.size
+        with self._bump_lock:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                (value,) = _SLOT.unpack(os.pread(fd, _SLOT.size, offset))
+                os.pwrite(fd, _SLOT.pack((value + 1) & 0xFFFFFFFFFFFFFFFF), offset)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+versions = VersionFile()
+
+
+def bump(*scopes):
+    """Call after committing a write to the tables behind ``scopes``."""
+    for scope in scopes:
+        versions.bump(scope)
+
+
+# --- Entries ---
+class Entry:
+    """A response body with its ETag and lazily built compressed variants."""
+
+    def __init__(self, body, mimetype):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(body).hexdigest()
+        self._variants = {}
+
+    @property
+    def size(self):
+        return len(self.body) + sum(len(body) for body in self._variants.values())
+
+    def variant(self, encoding):
+        """Return ``(body, etag)`` for ``encoding`` (None for identity)."""
+        if encoding is None:
+            return self.body, self.etag
+        body = self._variants.get(encoding)
+        if body is None:
+            body = self._variants[encoding] = ENCODERS[encoding](self.body)
+        return body, f'{self.etag}-{encoding}'
+
+    def respond(self):
+        """Build the response for the current request, or a 304."""
+        encoding = negotiate(len(self.body))
+        body, etag = self.variant(encoding)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype=self.mimetype)
+            if encoding is not None:
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        # Clients revalidate each time; unchanged listings cost a 304
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+def negotiate(size):
+    """Pick the Content-Encoding for a body of ``size`` bytes, or None."""
+    if size < RESPONSE_COMPRESS_MIN_BYTES:
+        return None
+    accepted = request.accept_encodings
+    if accepted['br'] and _brotli() is not None:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+class ResponseCache:
+    """Size-bounded in-process LRU of ``Entry`` objects."""
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old.size
+            self._entries[key] = entry
+            self._size += entry.size
+            self._evict()
+
+    def grew(self, key, entry, before):
+        """Account for variants added to ``entry`` since it had size ``before``."""
+        with self._lock:
+            if self._entries.get(key) is not entry:
+                return
+            self._size += entry.size - before
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            _, old = self._entries.popitem(last=False)
+            self._size -= old.size
+            self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def info(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._size, **self.stats}
+
+
+cache = ResponseCache()
+
+
+def _read_bounded(response, max_bytes):
+    """Return the body of ``response``, or None once a stream exceeds ``max_bytes``.
+
+    In that case ``response`` is left streaming: the chunks read so far are
+    sent first, then the rest of the original iterable.
+    """
+    if not response.is_streamed:
+        try:
+            return response.get_data()
+        finally:
+            response.close()
+    original = response.response
+    chunks = response.iter_encoded()
+    read = []
+    size = 0
+    for chunk in chunks:
+        read.append(chunk)
+        size += len(chunk)
+        if size > max_bytes:
+            response.response = _resume(read, chunks, original)
+            return None
+    response.close()
+    return b''.join(read)
+
+
+def _resume(read, rest, original):
+    try:
+        yield from read
+        yield from rest
+    finally:
+        close = getattr(original, 'close', None)
+        if close is not None:
+            close()
+
+
+def cached(*scopes):
+    """Serve a GET route from the cache while ``scopes`` have not changed.
+
+    Only 200 responses are stored; errors and other statuses pass through.
+    Streamed bodies are read up to ``RESPONSE_CACHE_MAX_ENTRY_BYTES``; a
+    longer one is sent on as a stream without being cached.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not RESPONSE_CACHE_ENABLED:
+                return func(*args, **kwargs)
+            key = (
+                request.endpoint,
+                tuple(sorted(request.args.items(multi=True))),
+                tuple(sorted(kwargs.items())),
+                versions.read(scopes),
+            )
+            entry = cache.get(key)
+            if entry is None:
+                response = make_response(func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                body = _read_bounded(response, RESPONSE_CACHE_MAX_ENTRY_BYTES)
+                if body is None:
+                    cache.stats['bypass'] += 1
+                    metrics.inc('response_cache_requests_total', result='bypass')
+                    return response
+                entry = Entry(body, response.mimetype)
+                if len(body) <= RESPONSE_CACHE_MAX_ENTRY_BYTES:
+                    cache.put(key, entry)
+                result = 'miss'
+            else:
+                result = 'hit'
+            before = entry.size
+            response = entry.respond()
+            if entry.size != before:
+                cache.grew(key, entry, before)
+            if response.status_code == 304:
+                result = 'not_modified'
+            cache.stats[result] += 1
+            metrics.inc('response_cache_requests_total', result=result)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,231 @@
+"""Warm worker processes for the demo script endpoints.
+
+Instead of starting a new interpreter per request, scripts run with
+``runpy.run_path`` inside long-lived worker processes that are started once
+and reused, with stdout/stderr captured.  Each call has a timeout (the worker
+is killed and replaced when it expires) and each worker has an address-space
+limit.  Callers beyond ``SCRIPT_WORKERS`` wait in a bounded queue; beyond
+``SCRIPT_QUEUE_LIMIT`` they are refused.  Output of scripts listed in
+``SCRIPT_MEMOIZE`` is cached by (path, mtime, args).
+"""
+
+import atexit
+import collections
+import contextlib
+import io
+import multiprocessing
+import os
+import queue
+import runpy
+import sys
+import threading
+import traceback
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SCRIPT_WORKERS = int(os.environ.get('SCRIPT_WORKERS', '2'))
+SCRIPT_QUEUE_LIMIT = int(os.environ.get('SCRIPT_QUEUE_LIMIT', '16'))
+SCRIPT_TIMEOUT = float(os.environ.get('SCRIPT_TIMEOUT', '10'))
+SCRIPT_MEMORY_MB = int(os.environ.get('SCRIPT_MEMORY_MB', '512'))
+# Workers are replaced after this many calls to bound leaks between scripts
+SCRIPT_MAX_CALLS = int(os.environ.get('SCRIPT_MAX_CALLS', '500'))
+SCRIPT_MEMOIZE = [
+    name for name in os.environ.get('SCRIPT_MEMOIZE', 'script_no_args.py,script_with_args.py').split(',') if name
+]
+SCRIPT_CACHE_ENTRIES = int(os.environ.get('SCRIPT_CACHE_ENTRIES', '256'))
+
+
+class ScriptPoolBusy(Exception):
+    """Raised when the pool's queue is full."""
+
+
+class ScriptTimeout(Exception):
+    """Raised when a script does not finish within its timeout."""
+
+
+# --- Worker process ---
+def _run(path, args):
+    stdout, stderr = io.StringIO(), io.StringIO()
+    exit_code, recycle = 0, False
+    saved_argv = sys.argv
+    sys.argv = [path, *args]
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            runpy.run_path(path, run_name='__main__')
+    except SystemExit as exc:
+        if exc.code is None or isinstance(exc.code, int):
+            exit_code = exc.code or 0
+        else:
+            stderr.write(f'{exc.code}\n')
+            exit_code = 1
+    except MemoryError:
+        stderr.write('MemoryError: script exceeded the memory limit\n')
+        exit_code, recycle = 1, True
+    except BaseException:
+        stderr.write(traceback.format_exc())
+        exit_code = 1
+    finally:
+        sys.argv = saved_argv
+    return {'stdout': stdout.getvalue(), 'stderr': stderr.getvalue(), 'exit_code': exit_code, 'recycle': recycle}
+
+
+def _worker_main(conn, memory_bytes):
+    # A pipe made under gevent is non-blocking; this process is not patched
+    os.set_blocking(conn.fileno(), True)
+    if memory_bytes and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        conn.send(_run(*request))
+
+
+class _Worker:
+    def __init__(self, context, memory_bytes):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child, memory_bytes), daemon=True)
+        self.process.start()
+        child.close()
+        self.calls = 0
+
+    def call(self, path, args, timeout):
+        self.calls += 1
+        self.conn.send((path, list(args)))
+        if not self.conn.poll(timeout):
+            raise ScriptTimeout(f'{path} did not finish within {timeout}s')
+        return self.conn.recv()
+
+    def stop(self, kill=False):
+        try:
+            if kill:
+                self.process.kill()
+            else:
+                self.conn.send(None)
+            self.process.join(1)
+        except (OSError, ValueError):
+            pass
+        self.conn.close()
+
+
+# --- Pool ---
+class ScriptPool:
+    """Dispatches script runs to warm worker processes."""
+
+    def __init__(self, workers=SCRIPT_WORKERS, queue_limit=SCRIPT_QUEUE_LIMIT, timeout=SCRIPT_TIMEOUT,
+                 memory_mb=SCRIPT_MEMORY_MB, memoize=SCRIPT_MEMOIZE, cache_entries=SCRIPT_CACHE_ENTRIES):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.memory_bytes = memory_mb * 1024 * 1024 if memory_mb else 0
+        self.memoize = {os.path.abspath(name) for name in memoize}
+        self.cache_entries = cache_entries
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._pid = None
+        self._lock = threading.Lock()
+        self._idle = queue.Queue()
+        self._all = []
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_limit)
+        self._cache = collections.OrderedDict()
+        self.counters = collections.Counter()
+
+    def start(self):
+        """Start the worker processes for this process if not running yet."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._context = multiprocessing.get_context('spawn')
+            for _ in range(self.workers):
+                self._add_worker()
+            self._pid = os.getpid()
+
+    def _add_worker(self):
+        worker = _Worker(self._context, self.memory_bytes)
+        self._all.append(worker)
+        self._idle.put(worker)
+
+    def _replace(self, worker, kill):
+        self._all.remove(worker)
+        worker.stop(kill=kill)
+        self.counters['recycled'] += 1
+        # Spawning takes a moment; do it off the request thread
+        threading.Thread(target=self._add_worker, daemon=True).start()
+
+    def _cache_key(self, path, args):
+        path = os.path.abspath(path)
+        if path not in self.memoize:
+            return None
+        return path, os.stat(path).st_mtime_ns, tuple(args)
+
+    def run(self, path, args=(), timeout=None):
+        """Run a script and return ``{'stdout', 'stderr', 'exit_code', 'cached'}``."""
+        timeout = self.timeout if timeout is None else timeout
+        key = self._cache_key(path, args)
+        if key is not None:
+            with self._lock:
+                hit = self._cache.get(key)
+                if hit is not None:
+                    self._cache.move_to_end(key)
+            if hit is not None:
+                self.counters['cache_hits'] += 1
+                return {**hit, 'cached': True}
+        self.start()
+        if not self._slots.acquire(blocking=False):
+            self.counters['rejected'] += 1
+            raise ScriptPoolBusy(f'{self.workers + self.queue_limit} script runs already pending')
+        try:
+            try:
+                worker = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                self.counters['timeouts'] += 1
+                raise ScriptTimeout('no script worker became free in time')
+            try:
+                result = worker.call(path, args, timeout)
+            except (ScriptTimeout, EOFError, OSError):
+                # Killed, crashed or hung: its state is unknown
+                self.counters['timeouts'] += 1
+                self._replace(worker, kill=True)
+                raise
+            if result.pop('recycle') or worker.calls >= SCRIPT_MAX_CALLS:
+                self._replace(worker, kill=False)
+            else:
+                self._idle.put(worker)
+        finally:
+            self._slots.release()
+        self.counters['runs'] += 1
+        if key is not None and result['exit_code'] == 0:
+            with self._lock:
+                self._cache[key] = result
+                while len(self._cache) > self.cache_entries:
+                    self._cache.popitem(last=False)
+        return {**result, 'cached': False}
+
+    def busy(self):
+        """Number of workers currently running a script."""
+        return len(self._all) - self._idle.qsize()
+
+    def stats(self):
+        return {**self.counters, 'workers': len(self._all), 'idle': self._idle.qsize()}
+
+    def shutdown(self):
+        if self._pid != os.getpid():
+            return
+        for worker in list(self._all):
+            worker.stop()
+        self._all = []
+        self._pid = None
+
+
+pool = ScriptPool()
+atexit.register(pool.shutdown)
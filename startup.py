@@ -0,0 +1,87 @@
+"""Cold-start measurement: import-time breakdown plus warm-up step timings.
+
+``python app.py --startup-report`` imports the app in a fresh interpreter
+under ``python -X importtime`` and then runs its warm-up there.  It prints the
+modules that cost the most, whether the heavy optional dependencies were
+loaded at import, and how long each warm-up step takes.  With
+``STARTUP_BUDGET_MS`` set it exits non-zero when importing the app exceeds
+the budget.
+"""
+
+import json
+import os
+import re
+import subprocess
+import sys
+
+STARTUP_BUDGET_MS = float(os.environ.get('STARTUP_BUDGET_MS', '0'))
+# Dependencies that should only load on first use
+HEAVY_MODULES = ('pyodbc', 'qrcode', 'PIL', 'requests', 'speech_recognition', 'numpy', 'ffmpeg')
+
+_LINE_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+# Run in the measured interpreter after the import; prints warm-up timings
+_WARM_UP_CODE = """
+import json, sys, time
+import {module}
+started = time.perf_counter()
+{module}.migrate_schema()
+timings = {{'schema': time.perf_counter() - started}}
+timings.update({module}.warm_up())
+sys.stdout.write(json.dumps(timings))
+"""
+
+
+def measure(module='app'):
+    """Import ``module`` in a fresh interpreter and warm it up.
+
+    Returns ``(imports, warm_up)``: ``[(name, self_us, cumulative_us, depth)]``
+    from ``-X importtime`` and the seconds per warm-up step.
+    """
+    env = dict(os.environ, WARMUP_ON_START='0', DB_MIGRATE_ON_START='0')
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _WARM_UP_CODE.format(module=module)],
+        capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f'importing {module} failed:\n{proc.stderr[-2000:]}')
+    imports = []
+    for line in proc.stderr.splitlines():
+        match = _LINE_RE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        depth = (len(indent) - 1) // 2
+        if depth == 0 and name != module:
+            # Interpreter startup or the harness itself, not the app
+            imports = []
+            continue
+        imports.append((name, int(self_us), int(cumulative_us), depth))
+        if name == module and depth == 0:
+            # Everything after this line was loaded by the warm-up
+            break
+    return imports, json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def report(module='app', top=15):
+    """Return ``(text, total_ms)`` describing import and warm-up cost."""
+    entries, warm_up = measure(module)
+    total_us = next((cum for name, _, cum, depth in entries if name == module and depth == 0), 0)
+    lines = [f'Importing {module}: {total_us / 1000:.1f} ms', '', f'Slowest modules (cumulative, top {top}):']
+    for name, self_us, cumulative_us, depth in sorted(entries, key=lambda e: -e[2])[:top]:
+        lines.append(f'  {cumulative_us / 1000:9.1f} ms  {self_us / 1000:8.1f} ms self  {name}')
+    loaded = {name for name, _, _, _ in entries}
+    lines.append('')
+    lines.append('Heavy dependencies imported at startup:')
+    for name in HEAVY_MODULES:
+        lines.append(f"  {name:20} {'yes' if name in loaded else 'no (lazy)'}")
+    lines.append('')
+    lines.append('Warm-up steps (after import, off the request path):')
+    for step, seconds in warm_up.items():
+        lines.append(f'  {seconds * 1000:9.1f} ms  {step}')
+    if STARTUP_BUDGET_MS:
+        verdict = 'within' if total_us / 1000 <= STARTUP_BUDGET_MS else 'OVER'
+        lines.append('')
+        lines.append(f'Import budget {STARTUP_BUDGET_MS:.0f} ms: {verdict}')
+    return '\n'.join(lines), total_us / 1000
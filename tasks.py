@@ -0,0 +1,84 @@
+"""CPU-heavy work executed in job worker processes.
+
+Functions here run in a separate interpreter, so they must be importable at
+module level, take only picklable arguments and must not touch the database;
+the job queue in the web process records their results.
+"""
+
+import importlib
+import json
+import os
+import time
+import wave
+
+
+# Marks a conversion still being written; ffmpeg picks the format from the
+# final extension, so it goes before it
+PARTIAL_SUFFIX = '.partial'
+
+
+def convert_recording(webm_path, wav_path):
+    """Transcode an uploaded webm to wav.
+
+    The wav is written under a temporary name and renamed when complete, so
+    readers never see a partial file.  Returns ``{'wav': path, 'length':
+    seconds, 'ffmpeg_seconds': seconds}``.
+    """
+    import ffmpeg
+    root, ext = os.path.splitext(wav_path)
+    partial_path = f'{root}.{os.getpid()}{PARTIAL_SUFFIX}{ext}'
+    started = time.perf_counter()
+    try:
+        (
+            ffmpeg
+            .input(webm_path)
+            .output(partial_path)
+            .run(overwrite_output=True, quiet=True)
+        )
+        ffmpeg_seconds = time.perf_counter() - started
+        if not os.path.exists(partial_path):
+            raise RuntimeError(f'ffmpeg wrote no output for {webm_path}')
+        with wave.open(partial_path, 'rb') as wf:
+            frames = wf.getnframes()
+            rate = wf.getframerate()
+            length = round(frames / float(rate), 2)
+        os.replace(partial_path, wav_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return {'wav': wav_path, 'length': length, 'ffmpeg_seconds': ffmpeg_seconds}
+
+
+# Offline recognizers provided by speech_recognition
+_RECOGNIZERS = {
+    'sphinx': 'recognize_sphinx',
+    'vosk': 'recognize_vosk',
+}
+
+
+def _recognizer(backend):
+    if backend in _RECOGNIZERS:
+        method = _RECOGNIZERS[backend]
+
+        def recognize(wav_path, offset, duration):
+            import speech_recognition as sr
+            r = sr.Recognizer()
+            with sr.AudioFile(wav_path) as source:
+                audio = r.record(source, offset=offset, duration=duration)
+            try:
+                text = getattr(r, method)(audio)
+            except sr.UnknownValueError:
+                return ''
+            if backend == 'vosk':
+                # recognize_vosk returns the recognizer's raw JSON result
+                text = json.loads(text).get('text', '')
+            return text
+        return recognize
+    # 'package.module:function', e.g. a stub recognizer in tests
+    module, _, name = backend.partition(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def transcribe_chunk(wav_path, offset, duration, backend):
+    """Transcribe ``duration`` seconds of a wav starting at ``offset``."""
+    return _recognizer(backend)(wav_path, offset, duration) or ''
@@ -0,0 +1,34 @@
+"""Shared fixtures: the app runs against SQLite files in a temporary directory."""
+
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """Import the app once, with its databases and files under a temp dir.
+
+    The working directory is not restored: background writers flush at exit.
+    """
+    os.chdir(tmp_path_factory.mktemp('app'))
+    os.environ.update({
+        'WARMUP_ON_START': '0',
+        'TRANSCRIBE_ON_UPLOAD': '0',
+        'MOVEMENT_FLUSH_INTERVAL_MS': '3600000',
+    })
+    import app
+    app.migrate_schema()
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    client = app_module.app.test_client()
+    with client.session_transaction() as session:
+        session['authenticated'] = True
+    return client
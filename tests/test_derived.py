@@ -0,0 +1,18 @@
+import os
+import wave
+
+import derived
+
+
+def test_cache_hit_reports_the_wav_length(app_module, monkeypatch, tmp_path):
+    monkeypatch.setattr(derived, 'DERIVED_DIR', str(tmp_path))
+    webm_path = os.path.join('recordings', 'message.webm')
+    with wave.open(derived.wav_path(webm_path), 'wb') as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(16000)
+        wf.writeframes(b'\0\0' * 40000)
+
+    results = []
+    assert derived.submit(webm_path, on_done=results.append) is None
+    assert results == [{'wav': derived.wav_path(webm_path), 'length': 2.5, 'ffmpeg_seconds': 0.0}]
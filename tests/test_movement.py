@@ -0,0 +1,26 @@
+import pytest
+
+SAMPLE = {'lat': 52.0, 'lon': 4.8, 'gx': 0.0, 'gy': 0.0, 'gz': 9.8}
+
+
+@pytest.mark.parametrize('timestamp', [10 ** 30, -10 ** 30, 1e30, 2 ** 63])
+def test_batch_rejects_out_of_range_timestamp(client, timestamp):
+    response = client.post('/record_movement', json={'data': [{**SAMPLE, 'timestamp': timestamp}]})
+    assert response.status_code == 400
+    assert 'timestamp' in response.get_json()['error']
+
+
+@pytest.mark.parametrize('timestamp', [10 ** 30, 1e30])
+def test_stream_rejects_out_of_range_timestamp(client, timestamp):
+    response = client.post('/record_movement/stream', json={
+        'session_id': 'oversized', 'seq': 0, 'data': [{**SAMPLE, 'timestamp': timestamp}],
+    })
+    assert response.status_code == 400
+    assert 'timestamp' in response.get_json()['error']
+
+
+def test_batch_accepts_int64_bounds(client):
+    response = client.post('/record_movement', json={'data': [
+        {**SAMPLE, 'timestamp': -2 ** 63}, {**SAMPLE, 'timestamp': 2 ** 63 - 1},
+    ]})
+    assert response.status_code == 200
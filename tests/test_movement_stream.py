@@ -0,0 +1,53 @@
+import json
+
+import movement_stream
+
+SAMPLE = {'lat': 52.0, 'lon': 4.8, 'gx': 0.0, 'gy': 0.0, 'gz': 9.8}
+
+
+def post_chunk(client, session_id, seq, timestamp):
+    return client.post('/record_movement/stream', json={
+        'session_id': session_id, 'seq': seq, 'data': [{**SAMPLE, 'timestamp': timestamp}],
+    })
+
+
+def test_failing_chunk_does_not_block_other_sessions(client, monkeypatch, tmp_path):
+    parked = tmp_path / 'parked.ndjson'
+    monkeypatch.setattr(movement_stream, 'MOVEMENT_CHUNK_MAX_ATTEMPTS', 2)
+    monkeypatch.setattr(movement_stream, 'MOVEMENT_PARKED_FILE', str(parked))
+    buffer = movement_stream.buffer
+    # A row the database refuses, as if it had slipped past validation
+    with buffer._lock:
+        buffer._pending.append(('poisoned', 0, [(10 ** 30, 52.0, 4.8, 0.0, 0.0, 9.8, 'poisoned')], 0))
+    assert post_chunk(client, 'healthy', 0, 1700000000000).status_code == 202
+
+    # The healthy session is stored although the flush hit the bad chunk
+    response = client.post('/record_movement/stream/healthy/finish')
+    assert response.status_code == 200
+    assert response.get_json()['rows'] == 1
+    assert buffer.pending_rows() == 1
+
+    # Its second failed write parks the chunk and the client is told to resend
+    response = client.post('/record_movement/stream/poisoned/finish')
+    assert response.status_code == 500
+    assert response.get_json()['failed_seqs'] == [0]
+    assert buffer.pending_rows() == 0
+    record = json.loads(parked.read_text())
+    assert (record['session_id'], record['seq']) == ('poisoned', 0)
+
+    assert post_chunk(client, 'poisoned', 0, 1700000000000).get_json()['status'] == 'accepted'
+    assert client.post('/record_movement/stream/poisoned/finish').get_json()['rows'] == 1
+    assert post_chunk(client, 'healthy', 1, 1700000001000).status_code == 202
+    assert client.post('/record_movement/stream/healthy/finish').get_json()['rows'] == 2
+
+
+def test_retried_chunk_answers_busy(client):
+    buffer = movement_stream.buffer
+    with buffer._lock:
+        buffer._pending.append(('retrying', 0, [(10 ** 30, 52.0, 4.8, 0.0, 0.0, 9.8, 'retrying')], 0))
+    response = client.post('/record_movement/stream/retrying/finish')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    with buffer._lock:
+        buffer._pending.clear()
+        buffer._pending_rows = 0
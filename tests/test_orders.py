@@ -0,0 +1,18 @@
+import orders
+
+
+def test_reprice_reports_changed_only_when_the_hash_moves(app_module):
+    order = orders.create(1, 0, 'Ann', 'Street 1', 'ann@example.com', 50000.0)
+
+    # A rate move too small to change the rounded amount keeps the hash
+    repriced, changed = orders.reprice(order['order_id'], 50000.0001)
+    assert not changed
+    assert repriced['tx_hash'] == order['tx_hash']
+    assert orders.get(order['order_id'])['btc_rate'] == 50000.0001
+
+    repriced, changed = orders.reprice(order['order_id'], 40000.0)
+    assert changed
+    assert repriced['tx_hash'] != order['tx_hash']
+    assert orders.find_by_tx_hash(repriced['tx_hash'])['order_id'] == order['order_id']
+
+    assert orders.reprice(order['order_id'], 40000.0) == (repriced, False)
@@ -0,0 +1,40 @@
+from flask import Response
+
+import response_cache
+
+
+def streamed_view(produced, parts):
+    def body():
+        for part in parts:
+            produced.append(part)
+            yield part
+
+    @response_cache.cached('media')
+    def view():
+        return Response(body(), mimetype='application/json')
+    return view
+
+
+def test_short_stream_is_cached(app_module):
+    produced = []
+    view = streamed_view(produced, [b'[', b'1', b']'])
+    with app_module.app.test_request_context('/streamed?size=short'):
+        assert view().get_data() == b'[1]'
+        assert view().get_data() == b'[1]'
+    assert produced == [b'[', b'1', b']']
+
+
+def test_long_stream_is_passed_through_unbuffered(app_module, monkeypatch):
+    monkeypatch.setattr(response_cache, 'RESPONSE_CACHE_MAX_ENTRY_BYTES', 4)
+    produced = []
+    view = streamed_view(produced, [b'[1,', b'2,', b'3,', b'4]'])
+    before = response_cache.cache.info()
+    with app_module.app.test_request_context('/streamed?size=long'):
+        response = view()
+        assert response.is_streamed
+        # Only the chunks up to the bound were read before responding
+        assert produced == [b'[1,', b'2,']
+        assert response.get_data() == b'[1,2,3,4]'
+    after = response_cache.cache.info()
+    assert after['entries'] == before['entries']
+    assert after['bypass'] == before.get('bypass', 0) + 1
@@ -0,0 +1,169 @@
+"""Offline transcription of recordings into Recordings.transcription.
+
+Wavs are split into overlapping chunks that are transcribed in parallel on the
+job process pool and stitched back together, dropping words repeated in the
+overlap.  The recognizer is chosen with ``TRANSCRIBE_BACKEND``: ``sphinx`` or
+``vosk`` (through speech_recognition) or ``module:function`` for a stub that is
+called as ``function(wav_path, offset, duration)``.
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import time
+import wave
+
+import db
+import derived
+import jobs
+import response_cache
+import tasks
+
+TRANSCRIBE_BACKEND = os.environ.get('TRANSCRIBE_BACKEND', 'sphinx')
+TRANSCRIBE_CHUNK_SECONDS = float(os.environ.get('TRANSCRIBE_CHUNK_SECONDS', '30'))
+TRANSCRIBE_OVERLAP_SECONDS = float(os.environ.get('TRANSCRIBE_OVERLAP_SECONDS', '1.5'))
+# Off by default: the recognizers are optional dependencies that are not in requirements.txt
+TRANSCRIBE_ON_UPLOAD = os.environ.get('TRANSCRIBE_ON_UPLOAD', '0') == '1'
+# Longest run of words looked for when de-duplicating chunk overlaps
+_MAX_OVERLAP_WORDS = 8
+
+_totals_lock = threading.Lock()
+totals = {'recordings': 0, 'audio_seconds': 0.0, 'wall_seconds': 0.0}
+
+
+def wav_duration(wav_path):
+    with wave.open(wav_path, 'rb') as wf:
+        return wf.getnframes() / float(wf.getframerate())
+
+
+def plan_chunks(duration, chunk_seconds=TRANSCRIBE_CHUNK_SECONDS, overlap=TRANSCRIBE_OVERLAP_SECONDS):
+    """Return ``(offset, duration)`` pairs covering ``duration`` seconds."""
+    if duration <= chunk_seconds:
+        return [(0.0, duration)]
+    step = chunk_seconds - overlap
+    chunks = []
+    offset = 0.0
+    while offset < duration:
+        chunks.append((offset, min(chunk_seconds, duration - offset)))
+        if offset + chunk_seconds >= duration:
+            break
+        offset += step
+    return chunks
+
+
+def merge_transcripts(parts, max_overlap_words=_MAX_OVERLAP_WORDS):
+    """Join chunk transcripts, skipping words repeated across an overlap."""
+    words = []
+    for text in parts:
+        new = text.split()
+        skip = 0
+        for k in range(min(max_overlap_words, len(words), len(new)), 0, -1):
+            if [w.lower() for w in words[-k:]] == [w.lower() for w in new[:k]]:
+                skip = k
+                break
+        words.extend(new[skip:])
+    return ' '.join(words)
+
+
+def chunk_args(wav_path, backend=TRANSCRIBE_BACKEND):
+    """Return ``(audio_seconds, [transcribe_chunk args, ...])`` for a wav."""
+    duration = wav_duration(wav_path)
+    return duration, [(wav_path, offset, length, backend) for offset, length in plan_chunks(duration)]
+
+
+def save_transcription(recording_id, text):
+    with db.connection('Recordings') as conn:
+        conn.cursor().execute('UPDATE Recordings SET transcription = ? WHERE id = ?', (text, recording_id))
+        conn.commit()
+    response_cache.bump('recordings')
+
+
+def _record_throughput(audio_seconds, wall_seconds):
+    with _totals_lock:
+        totals['recordings'] += 1
+        totals['audio_seconds'] += audio_seconds
+        totals['wall_seconds'] += wall_seconds
+
+
+def _report(audio_seconds, wall_seconds):
+    return {
+        'audio_seconds': round(audio_seconds, 2),
+        'wall_seconds': round(wall_seconds, 3),
+        'audio_seconds_per_second': round(audio_seconds / wall_seconds, 2) if wall_seconds else None,
+    }
+
+
+def submit(recording_id, wav_path, backend=TRANSCRIBE_BACKEND):
+    """Queue transcription of one recording on the job queue and return the job id."""
+    audio_seconds, args = chunk_args(wav_path, backend)
+    started = time.monotonic()
+
+    def finish(parts):
+        text = merge_transcripts(parts)
+        save_transcription(recording_id, text)
+        wall_seconds = time.monotonic() - started
+        _record_throughput(audio_seconds, wall_seconds)
+        return {'transcription': text, 'chunks': len(parts), **_report(audio_seconds, wall_seconds)}
+
+    return jobs.queue.submit_many('transcribe', tasks.transcribe_chunk, args,
+                                  recording_id=recording_id, on_done=finish)
+
+
+def backfill(workers=jobs.JOB_WORKERS, limit=None, backend=TRANSCRIBE_BACKEND, recordings_dir='recordings'):
+    """Transcribe every recording whose transcription is empty.
+
+    Missing wavs are derived into the cache first; all chunks of all recordings then share one
+    process pool.  Returns a throughput report.
+    """
+    with db.connection('Recordings') as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, filename FROM Recordings WHERE transcription IS NULL OR transcription = '' ORDER BY id"
+        )
+        rows = cursor.fetchall()
+    if limit is not None:
+        rows = rows[:limit]
+    started = time.monotonic()
+    audio_seconds = 0.0
+    done = failed = 0
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        wavs = {}
+        conversions = {}
+        for recording_id, filename in rows:
+            webm_path = os.path.join(recordings_dir, filename)
+            # Older uploads keep their wav next to the webm
+            legacy_wav = os.path.splitext(webm_path)[0] + '.wav'
+            wav_path = legacy_wav if os.path.exists(legacy_wav) else derived.cached_wav(webm_path)
+            if wav_path is not None:
+                wavs[recording_id] = wav_path
+            elif os.path.exists(webm_path):
+                os.makedirs(derived.DERIVED_DIR, exist_ok=True)
+                future = pool.submit(tasks.convert_recording, webm_path, derived.wav_path(webm_path))
+                conversions[future] = recording_id
+            else:
+                failed += 1
+        for future in concurrent.futures.as_completed(conversions):
+            try:
+                wavs[conversions[future]] = future.result()['wav']
+            except Exception:
+                failed += 1
+        pending = {}
+        for recording_id, wav_path in wavs.items():
+            try:
+                seconds, args = chunk_args(wav_path, backend)
+            except (OSError, wave.Error, EOFError):
+                failed += 1
+                continue
+            audio_seconds += seconds
+            pending[recording_id] = [pool.submit(tasks.transcribe_chunk, *a) for a in args]
+        for recording_id, futures in pending.items():
+            try:
+                save_transcription(recording_id, merge_transcripts(f.result() for f in futures))
+                done += 1
+            except Exception:
+                failed += 1
+    derived.trim()
+    wall_seconds = time.monotonic() - started
+    return {'transcribed': done, 'failed': failed, **_report(audio_seconds, wall_seconds)}
@@ -0,0 +1,210 @@
+"""Resumable, chunked uploads written straight to disk.
+
+Protocol:
+
+1. ``POST /uploads`` with ``{"kind": "video" | "audio"}`` creates an upload.
+2. ``PUT /uploads/<id>?offset=N`` appends the raw request body at byte ``N``.
+   The ``X-Chunk-Sha256`` header must carry the hex SHA-256 of the body.
+   ``N`` has to equal the bytes received so far, so a client that lost its
+   connection asks ``GET /uploads/<id>`` for the offset and resumes there.
+3. ``POST /uploads/<id>/finalize`` moves the file to its destination.  The
+   response of a successful finalize is kept, so a client that lost it can
+   finalize again and gets the same answer.
+
+State lives next to the data in ``recordings/uploads`` (``<id>.part`` plus a
+small ``<id>.json``), so any worker can continue an upload.
+"""
+
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import re
+import uuid
+
+UPLOAD_DIR = os.path.join('recordings', 'uploads')
+UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', str(512 * 1024 * 1024)))
+UPLOAD_CHUNK_MAX_BYTES = int(os.environ.get('UPLOAD_CHUNK_MAX_BYTES', str(16 * 1024 * 1024)))
+KINDS = ('video', 'audio')
+# Bytes read from the request per write; bounds memory regardless of chunk size
+_COPY_BUFFER = 64 * 1024
+
+_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadError(Exception):
+    """An upload request that cannot be honoured; carries an HTTP status."""
+
+    def __init__(self, message, status=400, **extra):
+        super().__init__(message)
+        self.status = status
+        self.extra = extra
+
+
+def _paths(upload_id):
+    if not _ID_RE.match(upload_id or ''):
+        raise UploadError('unknown upload', 404)
+    base = os.path.join(UPLOAD_DIR, upload_id)
+    return base + '.part', base + '.json'
+
+
+def create(kind):
+    """Start an upload and return its state."""
+    if kind not in KINDS:
+        raise UploadError(f'kind must be one of {KINDS}')
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    upload_id = uuid.uuid4().hex
+    part_path, meta_path = _paths(upload_id)
+    open(part_path, 'xb').close()
+    with open(meta_path, 'w') as fh:
+        json.dump({'kind': kind, 'created_at': datetime.datetime.now().isoformat()}, fh)
+    return {'upload_id': upload_id, 'kind': kind, 'offset': 0}
+
+
+def _meta(upload_id, finished_ok=False):
+    part_path, meta_path = _paths(upload_id)
+    try:
+        with open(meta_path) as fh:
+            meta = json.load(fh)
+    except FileNotFoundError:
+        raise UploadError('unknown upload', 404)
+    if 'result' in meta and not finished_ok:
+        raise UploadError('upload is already finalized', 409, finalized=True)
+    return meta
+
+
+def _save_meta(meta_path, meta):
+    tmp_path = f'{meta_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as fh:
+        json.dump(meta, fh)
+    os.replace(tmp_path, meta_path)
+
+
+def _same_file(fh, path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    return os.path.samestat(st, os.fstat(fh.fileno()))
+
+
+def status(upload_id):
+    """Return the upload's kind and the offset the next chunk must start at."""
+    meta = _meta(upload_id)
+    part_path, _ = _paths(upload_id)
+    return {'upload_id': upload_id, 'kind': meta['kind'], 'offset': os.path.getsize(part_path)}
+
+
+def write_chunk(upload_id, offset, stream, length, checksum):
+    """Append ``length`` bytes from ``stream`` at ``offset`` and return the new offset.
+
+    The chunk is hashed while it is written; on a checksum mismatch or a short
+    read the file is truncated back to ``offset`` so the chunk can be resent.
+    """
+    _meta(upload_id)
+    part_path, _ = _paths(upload_id)
+    if not checksum or not re.match(r'^[0-9a-fA-F]{64}$', checksum):
+        raise UploadError('X-Chunk-Sha256 header with the chunk SHA-256 is required')
+    if length is None:
+        raise UploadError('Content-Length is required', 411)
+    if length > UPLOAD_CHUNK_MAX_BYTES:
+        raise UploadError(f'chunks may be at most {UPLOAD_CHUNK_MAX_BYTES} bytes', 413)
+    try:
+        fh = open(part_path, 'r+b')
+    except FileNotFoundError:
+        raise UploadError('upload is already finalized', 409, finalized=True)
+    with fh:
+        # One writer per upload; a concurrent retry waits instead of interleaving
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        if not _same_file(fh, part_path):
+            # finalize moved the file while this chunk waited for the lock
+            raise UploadError('upload is already finalized', 409, finalized=True)
+        size = os.fstat(fh.fileno()).st_size
+        if offset != size:
+            raise UploadError('offset does not match received bytes', 409, offset=size)
+        if size + length > UPLOAD_MAX_BYTES:
+            raise UploadError(f'uploads may be at most {UPLOAD_MAX_BYTES} bytes', 413)
+        fh.seek(offset)
+        digest = hashlib.sha256()
+        received = 0
+        while received < length:
+            data = stream.read(min(_COPY_BUFFER, length - received))
+            if not data:
+                break
+            digest.update(data)
+            fh.write(data)
+            received += len(data)
+        if received != length or digest.hexdigest() != checksum.lower():
+            fh.truncate(offset)
+            reason = 'incomplete chunk' if received != length else 'checksum mismatch'
+            raise UploadError(reason, 422, offset=offset)
+        fh.flush()
+        os.fsync(fh.fileno())
+        return offset + received
+
+
+def finalize(upload_id, store):
+    """Hand a completed upload to ``store(kind, part_path)`` once.
+
+    ``store`` moves the file to its destination and returns ``(body, status)``.
+    A 2xx result is saved with the upload's state and returned again by later
+    calls.  On any other status ``store`` must leave the file at ``part_path``
+    so the client can retry.  Runs under the same lock as ``write_chunk``.
+    """
+    part_path, meta_path = _paths(upload_id)
+    try:
+        fh = open(part_path, 'rb')
+    except FileNotFoundError:
+        # Already moved away: only the saved result is left
+        fh = None
+    try:
+        if fh is not None:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+        meta = _meta(upload_id, finished_ok=True)
+        if 'result' in meta:
+            return meta['result'], meta['status']
+        if fh is None:
+            raise UploadError('unknown upload', 404)
+        if os.fstat(fh.fileno()).st_size == 0:
+            raise UploadError('upload is empty')
+        body, status_code = store(meta['kind'], part_path)
+        if 200 <= status_code < 300:
+            _save_meta(meta_path, {**meta, 'result': body, 'status': status_code})
+        return body, status_code
+    finally:
+        if fh is not None:
+            fh.close()
+
+
+def prune_stale(max_idle_seconds):
+    """Delete uploads that received no chunk for ``max_idle_seconds``.
+
+    Returns ``(uploads_removed, bytes_freed)``.
+    """
+    removed = freed = 0
+    cutoff = datetime.datetime.now().timestamp() - max_idle_seconds
+    try:
+        entries = list(os.scandir(UPLOAD_DIR))
+    except FileNotFoundError:
+        return 0, 0
+    for entry in entries:
+        upload_id, ext = os.path.splitext(entry.name)
+        if ext != '.json' or not _ID_RE.match(upload_id):
+            continue
+        part_path, meta_path = _paths(upload_id)
+        try:
+            st = os.stat(part_path)
+        except FileNotFoundError:
+            st = entry.stat()
+        if st.st_mtime >= cutoff:
+            continue
+        for path in (part_path, meta_path):
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            freed += size
+        removed += 1
+    return removed, freed